@@ -0,0 +1,70 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from pathlib import Path
+
+# Same as in main.py: embeddable Python doesn't support PYTHONPATH, so make sure
+# that the local packages and modules can be imported.
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+if scriptdir not in sys.path:
+    sys.path.insert(0, scriptdir)
+
+from batch_engine import make_batch_tasks, merge_batch_results, run_batch_task, BATCH_CHUNK_SEC
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run engine pipelines over an NWB recording as fast as the CPU allows, '
+                    'and write the results to disk.')
+
+    parser.add_argument('pipelines',
+                        help='JSON file with either one pipeline (the same JSON that POST /pipelines accepts) '
+                             'or a list of pipelines. Use "electrodes[*].ac" to run a pipeline on every electrode.')
+    parser.add_argument('recording', help='NWB file to process')
+    parser.add_argument('output_dir', help='Directory for the results; one HDF5 file per pipeline')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--chunk-sec', type=float, default=BATCH_CHUNK_SEC,
+                        help=f'Length of the chunks read from the recording (default: {BATCH_CHUNK_SEC} sec)')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log = logging.getLogger(__name__)
+
+    pipelines_json = json.loads(Path(args.pipelines).read_text())
+
+    # A single pipeline is a list of steps. Wrap it so that we always have a list of pipelines.
+    if len(pipelines_json) > 0 and not isinstance(pipelines_json[0], list):
+        pipelines_json = [pipelines_json]
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    tasks = make_batch_tasks(args.recording, args.output_dir, pipelines_json, args.chunk_sec, args.workers)
+    num_workers = max(1, min(args.workers, len(tasks)))
+    log.info(f'Running {sum(len(task.pipeline_nums) for task in tasks)} pipelines '
+             f'in {len(tasks)} groups on {num_workers} workers')
+
+    started_at = time.time()
+
+    if num_workers == 1:
+        for task in tasks:
+            run_batch_task(task)
+    else:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            for _ in pool.imap_unordered(run_batch_task, tasks):
+                pass
+
+    merge_batch_results(tasks)
+    log.info(f'Done in {time.time() - started_at:.1f} sec')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,388 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Set, Union
+
+import h5py
+import numpy as np
+
+from constants import EVENTS_STEP_NAME
+from devices.nwb_file.nwb_file_device import make_device_props
+from devices.nwb_file.segmented_nwb_file_reader import open_recording
+from devices.recording_device import RecordingDevice
+from engine import EngineException
+from engine_pipeline import EnginePipeline
+from engine_step import EngineStep
+from sample_clock import SampleClock
+from filters.add_another_series_filter import AddAnotherSeriesFilter
+from filters.rescaling_filter import RescalingFilter
+from sources_and_sinks.nwb_file_writer import NwbFileWriter
+from sources_and_sinks.triggered_nwb_file_writer import TriggeredNwbFileWriter
+from util import electrode_name
+from web_server import get_step
+
+# Batch runs read the recording in chunks of this many seconds. Larger chunks
+# mean fewer HDF5 reads, but more memory per worker process.
+BATCH_CHUNK_SEC = 10
+
+# Pipelines with these steps write their own files, so they can't be split into time ranges.
+FILE_WRITING_STEPS = [NwbFileWriter.name, TriggeredNwbFileWriter.name]
+
+# These steps don't keep any state between samples, so pipelines made only of them give the
+# same results when they're split into time ranges. The other steps (filters, subsampling, ...)
+# would start from a different state, or from a different bin, at each range boundary.
+TIME_RANGE_STEPS = [RescalingFilter.name, AddAnotherSeriesFilter.name]
+
+# Pipelines that start from e.g. "electrodes[*].ac" are run once for every electrode.
+ELECTRODE_WILDCARD = '[*]'
+
+ALL_ELECTRODES_STEP = 'electrodes'
+
+
+class BatchEngine:
+    """
+    Headless counterpart of `Engine`. It runs the same pipeline steps, but it's fed
+    with large chunks of recorded data as fast as they can be processed instead of
+    with the real-time device stream, and it doesn't send anything to the UI.
+    """
+    def __init__(self, device_props: Dict):
+        self.device = RecordingDevice(device_props)
+        self.published_steps: Dict[str, EngineStep] = dict()
+        self.pipelines: List[EnginePipeline] = []
+
+        # Unlike the live engine, we don't need DataBuffers here: the pipelines are
+        # created before the first chunk is processed, so they never need to catch up.
+        for i in range(self.device.num_electrodes()):
+            self.published_steps[electrode_name(i, 'ac')] = EngineStep()
+            self.published_steps[electrode_name(i, 'dc')] = EngineStep()
+
+        self.published_steps[ALL_ELECTRODES_STEP] = EngineStep()
+
+        # Recordings don't have events (yet), but steps that read them can still be run.
+        self.published_steps[EVENTS_STEP_NAME] = EngineStep()
+        self.sample_clock = SampleClock()
+
+    def get_published_step(self, name: str):
+        if name in self.published_steps:
+            return self.published_steps[name]
+        else:
+            raise EngineException(f'Could not find published step named "{name}"')
+
+    def add_pipeline(self, steps_json: List[Union[str, Dict]]) -> EnginePipeline:
+        steps = [get_step(self, step_json) for step_json in steps_json]
+        pipeline = EnginePipeline(steps)
+        self.pipelines.append(pipeline)
+        return pipeline
+
+    def do_step(self, data: Dict[str, np.ndarray]) -> List[Optional[np.ndarray]]:
+        for step in self.published_steps.values():
+            step.result = None
+
+        self.published_steps[ALL_ELECTRODES_STEP].result = data
+
+        for key, samples in data.items():
+            self.published_steps[key].result = samples
+
+        return [pipeline.do_step() for pipeline in self.pipelines]
+
+    def finalize(self):
+        for pipeline in self.pipelines:
+            pipeline.finalize()
+
+
+class BatchTask:
+    """
+    A group of pipelines that will be run by one worker process, over the whole recording
+    or over the samples in [from_sample, to_sample). The results of a time range are
+    written as numbered parts, which `merge_batch_results` puts together.
+    """
+    def __init__(self,
+                 recording_path: str,
+                 output_dir: str,
+                 pipeline_nums: List[int],
+                 pipelines_json: List[List[Union[str, Dict]]],
+                 series_names: List[str],
+                 chunk_sec: float,
+                 from_sample: int = 0,
+                 to_sample: Optional[int] = None,
+                 part_num: Optional[int] = None):
+        self.recording_path = recording_path
+        self.output_dir = output_dir
+        self.pipeline_nums = pipeline_nums
+        self.pipelines_json = pipelines_json
+        self.series_names = series_names
+        self.chunk_sec = chunk_sec
+        self.from_sample = from_sample
+        self.to_sample = to_sample
+        self.part_num = part_num
+
+
+class ResultWriter:
+    """
+    Appends the results of one pipeline to a resizable dataset in its own HDF5 file.
+    The file is only created once the pipeline produces results, so pipelines that
+    end in a sink (e.g. NwbFileWriter) don't leave empty files behind.
+    """
+    def __init__(self, file_path: str, pipeline_json: List[Union[str, Dict]], recording_path: str):
+        self.file_path = file_path
+        self.pipeline_json = pipeline_json
+        self.recording_path = recording_path
+        self.file = None
+        self.dataset = None
+
+    def append(self, result: np.ndarray):
+        if self.file is None:
+            self.file = h5py.File(self.file_path, 'w')
+            self.file.attrs['pipeline'] = json.dumps(self.pipeline_json)
+            self.file.attrs['recording'] = self.recording_path
+            self.dataset = self.file.create_dataset('result',
+                                                    shape=(0,),
+                                                    maxshape=(None,),
+                                                    chunks=True,
+                                                    dtype=result.dtype)
+
+        old_length = self.dataset.shape[0]
+        new_length = old_length + len(result)
+        self.dataset.resize((new_length,))
+        self.dataset[old_length:new_length] = result
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def result_path(output_dir: str, pipeline_num: int, part_num: Optional[int] = None) -> str:
+    if part_num is None:
+        return os.path.join(output_dir, f'pipeline_{pipeline_num:04d}.h5')
+
+    return os.path.join(output_dir, f'pipeline_{pipeline_num:04d}_part{part_num:04d}.h5')
+
+
+def expand_pipelines(pipelines_json: List[List[Union[str, Dict]]], num_electrodes: int):
+    """Replace each pipeline that uses the electrode wildcard with one pipeline per electrode."""
+    expanded = []
+
+    for pipeline_json in pipelines_json:
+        pipeline_str = json.dumps(pipeline_json)
+
+        if ELECTRODE_WILDCARD not in pipeline_str:
+            expanded.append(pipeline_json)
+            continue
+
+        for i in range(num_electrodes):
+            expanded.append(json.loads(pipeline_str.replace(ELECTRODE_WILDCARD, f'[{i}]')))
+
+    return expanded
+
+
+def required_series(pipeline_json: List[Union[str, Dict]], device_props: Dict) -> Set[str]:
+    """Find the recorded series that a pipeline reads."""
+    names = set()
+
+    for step_json in pipeline_json:
+        if isinstance(step_json, str):
+            name = step_json
+        elif step_json.get('name') == AddAnotherSeriesFilter.name:
+            name = step_json['addSeriesName']
+        else:
+            continue
+
+        if name == ALL_ELECTRODES_STEP:
+            for i in range(device_props['numElectrodes']):
+                names.add(electrode_name(i, 'ac'))
+
+                if device_props['canSampleDC']:
+                    names.add(electrode_name(i, 'dc'))
+        else:
+            names.add(name)
+
+    return names
+
+
+def writes_files(pipeline_json: List[Union[str, Dict]]) -> bool:
+    return any(isinstance(step_json, dict) and step_json.get('name') in FILE_WRITING_STEPS
+               for step_json in pipeline_json)
+
+
+def can_split_by_time(pipeline_json: List[Union[str, Dict]]) -> bool:
+    return all(isinstance(step_json, str) or step_json.get('name') in TIME_RANGE_STEPS
+               for step_json in pipeline_json)
+
+
+def make_batch_tasks(recording_path: str,
+                     output_dir: str,
+                     pipelines_json: List[List[Union[str, Dict]]],
+                     chunk_sec: float = BATCH_CHUNK_SEC,
+                     num_workers: int = 1) -> List[BatchTask]:
+    """
+    Split the pipelines into tasks that can run in parallel. Pipelines that read the same
+    series are run together so that each series is read from the file only once.
+
+    In the matrix layout, reading any series reads the samples of all of them, so the
+    pipelines that can be split are split by time range instead: each task runs them over
+    its part of the recording, and reads each chunk once.
+    """
+    reader = open_recording(recording_path)
+    reader.close()
+
+    device_props = make_device_props(reader.stored_props)
+    pipelines_json = expand_pipelines(pipelines_json, device_props['numElectrodes'])
+    pipeline_nums = list(range(len(pipelines_json)))
+
+    if not reader.is_matrix_layout:
+        return make_series_tasks(recording_path, output_dir, pipelines_json, pipeline_nums, device_props, chunk_sec)
+
+    split_nums = [num for num in pipeline_nums
+                  if can_split_by_time(pipelines_json[num]) and not writes_files(pipelines_json[num])]
+    series_nums = [num for num in pipeline_nums if num not in split_nums]
+
+    tasks = make_series_tasks(recording_path, output_dir, pipelines_json, series_nums, device_props, chunk_sec)
+
+    if len(split_nums) > 0:
+        chunk_size = max(1, int(round(chunk_sec * reader.samples_per_sec)))
+        tasks += make_time_range_tasks(recording_path, output_dir, pipelines_json, split_nums, device_props,
+                                       chunk_sec, reader.num_samples, chunk_size, max(1, num_workers - len(tasks)))
+
+    return tasks
+
+
+def make_series_tasks(recording_path: str,
+                      output_dir: str,
+                      pipelines_json: List[List[Union[str, Dict]]],
+                      pipeline_nums: List[int],
+                      device_props: Dict,
+                      chunk_sec: float) -> List[BatchTask]:
+    """Group the pipelines that read the same series into one task over the whole recording."""
+    tasks_by_series: Dict[frozenset, BatchTask] = dict()
+
+    for pipeline_num in pipeline_nums:
+        pipeline_json = pipelines_json[pipeline_num]
+        series_names = frozenset(required_series(pipeline_json, device_props))
+
+        if series_names not in tasks_by_series:
+            tasks_by_series[series_names] = BatchTask(recording_path,
+                                                      output_dir,
+                                                      [],
+                                                      [],
+                                                      sorted(series_names),
+                                                      chunk_sec)
+
+        task = tasks_by_series[series_names]
+        task.pipeline_nums.append(pipeline_num)
+        task.pipelines_json.append(pipeline_json)
+
+    return list(tasks_by_series.values())
+
+
+def make_time_range_tasks(recording_path: str,
+                          output_dir: str,
+                          pipelines_json: List[List[Union[str, Dict]]],
+                          pipeline_nums: List[int],
+                          device_props: Dict,
+                          chunk_sec: float,
+                          num_samples: int,
+                          chunk_size: int,
+                          num_ranges: int) -> List[BatchTask]:
+    """
+    Split the recording into about `num_ranges` time ranges of whole chunks, with one task
+    that runs all the given pipelines for each range.
+    """
+    def make_task(from_sample: int = 0, to_sample: Optional[int] = None,
+                  part_num: Optional[int] = None) -> BatchTask:
+        task_pipelines = [pipelines_json[pipeline_num] for pipeline_num in pipeline_nums]
+        series_names = set().union(*[required_series(pipeline_json, device_props) for pipeline_json in task_pipelines])
+        return BatchTask(recording_path, output_dir, pipeline_nums, task_pipelines, sorted(series_names), chunk_sec,
+                         from_sample, to_sample, part_num)
+
+    num_chunks = -(-num_samples // chunk_size)
+    num_ranges = max(1, min(num_ranges, num_chunks))
+
+    if num_ranges == 1:
+        return [make_task()]
+
+    tasks = []
+    chunk_boundaries = np.linspace(0, num_chunks, num_ranges + 1).round().astype(int)
+
+    for part_num in range(num_ranges):
+        tasks.append(make_task(int(chunk_boundaries[part_num]) * chunk_size,
+                               min(int(chunk_boundaries[part_num + 1]) * chunk_size, num_samples),
+                               part_num))
+
+    return tasks
+
+
+def run_batch_task(task: BatchTask) -> Dict:
+    """Run a group of pipelines over the whole recording. This is the entry point of the worker processes."""
+    log = logging.getLogger(__name__)
+    started_at = time.time()
+
+    reader = open_recording(task.recording_path)
+
+    try:
+        engine = BatchEngine(make_device_props(reader.stored_props))
+        result_writers = []
+
+        for pipeline_num, pipeline_json in zip(task.pipeline_nums, task.pipelines_json):
+            engine.add_pipeline(pipeline_json)
+            result_writers.append(ResultWriter(result_path(task.output_dir, pipeline_num, task.part_num),
+                                               pipeline_json,
+                                               task.recording_path))
+
+        to_sample = reader.num_samples if task.to_sample is None else min(task.to_sample, reader.num_samples)
+        num_samples = max(0, to_sample - task.from_sample)
+        chunk_size = max(1, int(round(task.chunk_sec * reader.samples_per_sec)))
+
+        for chunk_from in range(task.from_sample, to_sample, chunk_size):
+            chunk_to = min(chunk_from + chunk_size, to_sample)
+            data = reader.read(task.series_names, chunk_from, chunk_to)
+
+            results = engine.do_step(data)
+
+            for result_writer, result in zip(result_writers, results):
+                if result is not None and len(result) > 0:
+                    result_writer.append(result)
+
+        engine.finalize()
+
+        for result_writer in result_writers:
+            result_writer.close()
+
+    finally:
+        reader.close()
+
+    elapsed = time.time() - started_at
+    log.info(f'Pipelines {task.pipeline_nums}: processed {num_samples} samples in {elapsed:.1f} sec')
+
+    return {
+        'pipelines': task.pipeline_nums,
+        'numSamples': num_samples,
+        'elapsedSec': elapsed,
+    }
+
+
+def merge_batch_results(tasks: List[BatchTask]):
+    """Put the results of the time ranges of each pipeline together into one file, in order."""
+    part_tasks = sorted([task for task in tasks if task.part_num is not None], key=lambda task: task.part_num)
+
+    if len(part_tasks) == 0:
+        return
+
+    output_dir = part_tasks[0].output_dir
+
+    for pipeline_num, pipeline_json in zip(part_tasks[0].pipeline_nums, part_tasks[0].pipelines_json):
+        result_writer = ResultWriter(result_path(output_dir, pipeline_num), pipeline_json, part_tasks[0].recording_path)
+
+        for task in part_tasks:
+            part_path = result_path(output_dir, pipeline_num, task.part_num)
+
+            # Parts without results have no file.
+            if not os.path.isfile(part_path):
+                continue
+
+            with h5py.File(part_path, 'r') as part_file:
+                result_writer.append(part_file['result'][:])
+
+            os.remove(part_path)
+
+        result_writer.close()
@@ -0,0 +1,244 @@
+import argparse
+import csv
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Make the engine modules importable when this is run as a script.
+enginedir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if enginedir not in sys.path:
+    sys.path.insert(0, enginedir)
+
+from batch_engine import BatchEngine
+from devices.common.packet_decoder import AC_OFFSET, AC_CONVERSION, DC_OFFSET, DC_CONVERSION
+from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig, available_compressions, \
+    LAYOUTS, SAMPLE_FORMATS, DEFAULT_COMPRESSION_LEVEL
+from util import electrode_name
+
+# The engine hands the samples to the writer in steps of about this length.
+STEP_SEC = 0.01
+
+# Synthetic data is generated for this many seconds and then repeated. Repeats are
+# much farther apart than an HDF5 chunk, so they don't make compression look better.
+SYNTHETIC_BLOCK_SEC = 5
+
+
+def make_synthetic_codes(num_electrodes: int, samples_per_sec: int, seed: int = 0):
+    """
+    ADC codes that look roughly like an MEA recording: ~10 uV of noise, 50 Hz mains hum
+    and a few spikes per second on each electrode, and slowly drifting DC levels.
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = SYNTHETIC_BLOCK_SEC * samples_per_sec
+    t = np.arange(num_samples) / samples_per_sec
+
+    ac_volts = rng.normal(0, 10e-6, (num_samples, num_electrodes))
+    ac_volts += 20e-6 * np.sin(2 * np.pi * 50 * t + rng.uniform(0, 2 * np.pi, num_electrodes)[:, np.newaxis]).T
+
+    spike_samples = int(samples_per_sec / 1000)
+    spike_shape = -80e-6 * np.sin(np.linspace(0, np.pi, spike_samples)) ** 2
+
+    for i in range(num_electrodes):
+        for spike_at in rng.integers(0, num_samples - spike_samples, 5 * SYNTHETIC_BLOCK_SEC):
+            ac_volts[spike_at:spike_at + spike_samples, i] += spike_shape
+
+    ac_codes = np.clip(np.rint(ac_volts / AC_CONVERSION - AC_OFFSET), 0, 65535)
+    dc_codes = np.clip(np.rint(512 + np.cumsum(rng.normal(0, 0.01, (num_samples, num_electrodes)), axis=0)), 0, 1023)
+
+    return ac_codes, dc_codes
+
+
+def run_benchmark(out_dir: str,
+                  num_electrodes: int,
+                  can_sample_dc: bool,
+                  samples_per_sec: int,
+                  seconds: float,
+                  layout: str,
+                  sample_format: str,
+                  compression,
+                  compression_level: int,
+                  shuffle: bool,
+                  chunk_samples: Optional[int],
+                  ac_volts: np.ndarray,
+                  dc_volts: np.ndarray) -> Dict:
+    file_path = os.path.join(out_dir, f'benchmark_{layout}_{sample_format}_{compression}.nwb')
+
+    engine = BatchEngine({
+        'name': 'Benchmark',
+        'numElectrodes': num_electrodes,
+        'canSampleDC': can_sample_dc,
+    })
+
+    config = NwbFileWriterConfig.from_json({
+        'filePath': file_path,
+        'offset': AC_OFFSET,
+        'conversion': AC_CONVERSION,
+        'resolution': AC_CONVERSION,
+        'dcOffset': DC_OFFSET,
+        'dcConversion': DC_CONVERSION,
+        'samplesPerSec': samples_per_sec,
+        'numElectrodes': num_electrodes,
+        'layout': layout,
+        'sampleFormat': sample_format,
+        'compression': compression,
+        'compressionLevel': compression_level,
+        'shuffle': shuffle,
+        'chunkSamples': chunk_samples,
+    })
+
+    step_samples = int(STEP_SEC * samples_per_sec)
+    total_samples = int(seconds * samples_per_sec)
+    block_samples = len(ac_volts)
+
+    writer = NwbFileWriter()
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    max_step_sec = 0.
+
+    writer.configure(config, engine)
+
+    for step_from in range(0, total_samples, step_samples):
+        block_from = step_from % block_samples
+        block_to = min(block_from + step_samples, block_samples)
+
+        data = dict()
+        for i in range(num_electrodes):
+            data[electrode_name(i, 'ac')] = ac_volts[block_from:block_to, i]
+
+            if can_sample_dc:
+                data[electrode_name(i, 'dc')] = dc_volts[block_from:block_to, i]
+
+        # The time spent in do_step() holds up the engine thread, and with it the UI.
+        step_started_at = time.perf_counter()
+        writer.do_step(data)
+        max_step_sec = max(max_step_sec, time.perf_counter() - step_started_at)
+
+    writer.finalize()
+
+    elapsed = time.perf_counter() - started_at
+    cpu_elapsed = time.process_time() - cpu_started_at
+    input_bytes = total_samples * num_electrodes * (2 if can_sample_dc else 1) * 4
+    file_size = os.path.getsize(file_path)
+
+    os.remove(file_path)
+
+    return {
+        'layout': layout,
+        'format': sample_format,
+        'compression': compression if compression in ('none', 'lzf') else f'{compression}:{compression_level}',
+        'shuffle': shuffle,
+        'chunkSamples': chunk_samples or 'default',
+        'MB/s': input_bytes / elapsed / 1e6,
+        'xRealTime': seconds / elapsed,
+        'cpuSec': cpu_elapsed,
+        'cpuPerRecordedSec': cpu_elapsed / seconds,
+        'maxStepMs': max_step_sec * 1000,
+        'fileMB': file_size / 1e6,
+        'ratio': input_bytes / file_size,
+    }
+
+
+def parse_compression(value: str):
+    """'gzip:4' -> ('gzip', 4); '32015' -> (32015, default level)."""
+    name, _, level = value.partition(':')
+    level = int(level) if level else DEFAULT_COMPRESSION_LEVEL
+
+    if name.isdigit():
+        return int(name), level
+
+    return name, level
+
+
+def parse_args():
+    default_compressions = ['none', 'lzf', 'gzip:1', 'gzip:4']
+
+    for plugin_compression in ['zstd:3', 'blosc-lz4:5']:
+        if plugin_compression.split(':')[0] in available_compressions():
+            default_compressions.append(plugin_compression)
+
+    parser = argparse.ArgumentParser(
+        description='Measure the write throughput, CPU use and file size of NwbFileWriter settings '
+                    'on synthetic MEA data.')
+
+    parser.add_argument('--electrodes', type=int, default=64, help='Number of electrodes (default: 64)')
+    parser.add_argument('--no-dc', action='store_true', help='Record AC samples only')
+    parser.add_argument('--rate', type=int, default=40_000, help='Samples per second (default: 40000)')
+    parser.add_argument('--seconds', type=float, default=30, help='Length of each recording (default: 30)')
+    parser.add_argument('--layouts', default=','.join(LAYOUTS),
+                        help=f'Comma-separated layouts (default: {",".join(LAYOUTS)})')
+    parser.add_argument('--formats', default=','.join(SAMPLE_FORMATS),
+                        help=f'Comma-separated sample formats (default: {",".join(SAMPLE_FORMATS)})')
+    parser.add_argument('--compressions', default=','.join(default_compressions),
+                        help='Comma-separated compressions, with an optional level after a colon, '
+                             f'or numeric HDF5 filter IDs (default: {",".join(default_compressions)}). '
+                             f'Available here: {", ".join(available_compressions())}')
+    parser.add_argument('--shuffle', choices=['on', 'off', 'both'], default='on',
+                        help='HDF5 byte shuffle (default: on)')
+    parser.add_argument('--chunk-samples', default='',
+                        help='Comma-separated HDF5 chunk lengths in samples (default: the layout default)')
+    parser.add_argument('--out-dir', help='Directory for the temporary recordings (default: system temp)')
+    parser.add_argument('--csv', help='Also write the results to this CSV file')
+
+    return parser.parse_args()
+
+
+def print_table(results: List[Dict]):
+    columns = list(results[0].keys())
+    rows = [[f'{value:.2f}' if isinstance(value, float) else str(value) for value in result.values()]
+            for result in results]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def main():
+    args = parse_args()
+    can_sample_dc = not args.no_dc
+
+    layouts = args.layouts.split(',')
+    sample_formats = args.formats.split(',')
+    compressions = [parse_compression(value) for value in args.compressions.split(',')]
+    shuffles = {'on': [True], 'off': [False], 'both': [True, False]}[args.shuffle]
+    chunk_lengths = [int(value) for value in args.chunk_samples.split(',')] if args.chunk_samples else [None]
+
+    ac_codes, dc_codes = make_synthetic_codes(args.electrodes, args.rate)
+    ac_volts = ((ac_codes + AC_OFFSET) * AC_CONVERSION).astype('f4')
+    dc_volts = ((dc_codes + DC_OFFSET) * DC_CONVERSION).astype('f4')
+
+    out_dir = args.out_dir or tempfile.mkdtemp(prefix='nwb_write_benchmark_')
+    os.makedirs(out_dir, exist_ok=True)
+    results = []
+
+    try:
+        for layout, sample_format, (compression, level), shuffle, chunk_samples in \
+                itertools.product(layouts, sample_formats, compressions, shuffles, chunk_lengths):
+            result = run_benchmark(out_dir, args.electrodes, can_sample_dc, args.rate, args.seconds,
+                                   layout, sample_format, compression, level, shuffle, chunk_samples,
+                                   ac_volts, dc_volts)
+            results.append(result)
+            print(f'{result["layout"]} {result["format"]} {result["compression"]}: '
+                  f'{result["MB/s"]:.1f} MB/s, ratio {result["ratio"]:.2f}', file=sys.stderr)
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    print_table(results)
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csv_file:
+            csv_writer = csv.DictWriter(csv_file, fieldnames=list(results[0].keys()))
+            csv_writer.writeheader()
+            csv_writer.writerows(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,10 @@
-OPENMEA_NUM_ELECTRODES = 64
\ No newline at end of file
+OPENMEA_NUM_ELECTRODES = 64
+
+# Published step with the events (stimulation, manual marks) that happened during an engine step.
+EVENTS_STEP_NAME = 'events'
+
+# Kind of the events with a single stimulus (a pulse, or a .wav file being played) in the
+# events step. Besides 'kind', 'time' and 'label', they have the stimulated 'electrodes',
+# the 'amplitude' in amps, the 'duration' in seconds, and the acquisition 'sample' at
+# which the stimulus was meant to start (None if the samples weren't coming in).
+STIMULUS_EVENT_KIND = 'stimulus'
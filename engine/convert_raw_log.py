@@ -0,0 +1,101 @@
+import argparse
+import logging
+import os
+import sys
+import time
+
+# Same as in main.py: embeddable Python doesn't support PYTHONPATH, so make sure
+# that the local packages and modules can be imported.
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+if scriptdir not in sys.path:
+    sys.path.insert(0, scriptdir)
+
+from devices.common.packet_decoder import PacketDecoder, AC_OFFSET, AC_CONVERSION, DC_OFFSET, DC_CONVERSION
+from devices.common.raw_packet_log import RawPacketLogReader
+from devices.common.udp_recorder import RecorderEngine
+from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig, LAYOUTS, LAYOUT_MATRIX, \
+    SAMPLE_FORMATS, SAMPLE_FORMAT_UINT16, DEFAULT_COMPRESSION, DEFAULT_COMPRESSION_LEVEL
+
+# The log is decoded and written in batches of about this many bytes of packets.
+CONVERT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def convert_raw_log(log_path: str,
+                    nwb_path: str,
+                    layout: str = LAYOUT_MATRIX,
+                    sample_format: str = SAMPLE_FORMAT_UINT16,
+                    compression=DEFAULT_COMPRESSION,
+                    compression_level: int = DEFAULT_COMPRESSION_LEVEL) -> int:
+    """Decode a raw packet log and write it as an NWB recording that NwbFileDevice can replay."""
+    reader = RawPacketLogReader(log_path)
+
+    try:
+        metadata = reader.metadata
+        device_props = metadata['deviceProps']
+        decoder = PacketDecoder(metadata['numPorts'],
+                                metadata['channelsPerPort'],
+                                metadata['dwordsPerBatch'],
+                                metadata['extractDC'])
+
+        writer = NwbFileWriter()
+        writer.configure(NwbFileWriterConfig.from_json({
+            'filePath': nwb_path,
+            'offset': AC_OFFSET,
+            'conversion': AC_CONVERSION,
+            'resolution': AC_CONVERSION,
+            'dcOffset': DC_OFFSET,
+            'dcConversion': DC_CONVERSION,
+            'samplesPerSec': metadata['samplesPerSec'],
+            'numElectrodes': device_props['numElectrodes'],
+            'layout': layout,
+            'sampleFormat': sample_format,
+            'compression': compression,
+            'compressionLevel': compression_level,
+        }), RecorderEngine(device_props))
+
+        num_packets = 0
+
+        for batch in reader.batches(CONVERT_BATCH_BYTES):
+            num_packets += len(batch)
+            writer.do_step(decoder.decode([batch]))
+
+        writer.finalize()
+
+    finally:
+        reader.close()
+
+    return num_packets
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert a raw UDP packet log into an NWB recording.')
+
+    parser.add_argument('log', help='Raw packet log to convert')
+    parser.add_argument('output', help='NWB file to write')
+    parser.add_argument('--layout', choices=LAYOUTS, default=LAYOUT_MATRIX,
+                        help=f'Storage layout of the samples (default: {LAYOUT_MATRIX})')
+    parser.add_argument('--sample-format', choices=SAMPLE_FORMATS, default=SAMPLE_FORMAT_UINT16,
+                        help=f'Format of the stored samples (default: {SAMPLE_FORMAT_UINT16})')
+    parser.add_argument('--compression', default=DEFAULT_COMPRESSION,
+                        help=f'Compression of the samples (default: {DEFAULT_COMPRESSION})')
+    parser.add_argument('--compression-level', type=int, default=DEFAULT_COMPRESSION_LEVEL,
+                        help=f'Compression level (default: {DEFAULT_COMPRESSION_LEVEL})')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log = logging.getLogger(__name__)
+
+    compression = int(args.compression) if args.compression.isdigit() else args.compression
+
+    started_at = time.time()
+    num_packets = convert_raw_log(args.log, args.output, args.layout, args.sample_format,
+                                  compression, args.compression_level)
+    log.info(f'Converted {num_packets} packets in {time.time() - started_at:.1f} sec')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
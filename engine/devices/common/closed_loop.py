@@ -0,0 +1,188 @@
+from collections import deque
+from typing import Dict, Optional
+
+import numpy as np
+from scipy.signal import iirfilter, sosfilt
+
+from devices.common.packet_decoder import PacketDecoder
+
+# What triggers a stimulus in closed-loop mode:
+#   * threshold: a sample of the electrode above the upper or below the lower threshold.
+#   * bandPower: the RMS of the electrode in a frequency band, over a sliding window,
+#     above the power threshold.
+CLOSED_LOOP_OFF = 'off'
+CLOSED_LOOP_THRESHOLD = 'threshold'
+CLOSED_LOOP_BAND_POWER = 'bandPower'
+CLOSED_LOOP_MODES = [CLOSED_LOOP_OFF, CLOSED_LOOP_THRESHOLD, CLOSED_LOOP_BAND_POWER]
+
+DEFAULT_UPPER_THRESHOLD = 0.001  # Volts
+DEFAULT_LOWER_THRESHOLD = -0.0009  # Volts
+DEFAULT_LOW_FREQ = 300
+DEFAULT_HIGH_FREQ = 3000
+DEFAULT_WINDOW_MS = 20
+DEFAULT_POWER_THRESHOLD = 0.00005  # Volts RMS
+BAND_FILTER_ORDER = 2
+
+# After a trigger, nothing is detected for this long, so that the artifact of the stimulus
+# doesn't trigger the next one.
+DEFAULT_REFRACTORY_MS = 100
+
+# The latencies are counted in bins of this width, up to MAX_LATENCY_SEC; longer ones
+# all go into the last bin.
+LATENCY_BIN_SEC = 0.0005
+MAX_LATENCY_SEC = 0.05
+
+# Only the latencies of this many latest triggers are kept.
+MAX_LATENCIES = 100_000
+
+
+class ClosedLoopConfig:
+    @staticmethod
+    def from_json(json: Optional[Dict], samples_per_sec: float):
+        config = ClosedLoopConfig()
+        json = json or {}
+
+        config.mode = json.get('mode', CLOSED_LOOP_OFF)
+        config.electrode = int(json.get('electrode', 0))
+        config.samples_per_sec = float(samples_per_sec)
+        config.upper_threshold = json.get('upperThreshold', DEFAULT_UPPER_THRESHOLD)
+        config.lower_threshold = json.get('lowerThreshold', DEFAULT_LOWER_THRESHOLD)
+        config.low_freq = json.get('lowFreq', DEFAULT_LOW_FREQ)
+        config.high_freq = json.get('highFreq', DEFAULT_HIGH_FREQ)
+        config.window_ms = json.get('windowMs', DEFAULT_WINDOW_MS)
+        config.power_threshold = json.get('powerThreshold', DEFAULT_POWER_THRESHOLD)
+        config.refractory_ms = json.get('refractoryMs', DEFAULT_REFRACTORY_MS)
+
+        if config.mode not in CLOSED_LOOP_MODES:
+            raise Exception(f'Unknown closed-loop mode "{config.mode}"')
+
+        return config
+
+    def __init__(self):
+        self.mode = CLOSED_LOOP_OFF
+        self.electrode = 0
+        self.samples_per_sec = 0.
+        self.upper_threshold = DEFAULT_UPPER_THRESHOLD
+        self.lower_threshold = DEFAULT_LOWER_THRESHOLD
+        self.low_freq = DEFAULT_LOW_FREQ
+        self.high_freq = DEFAULT_HIGH_FREQ
+        self.window_ms = DEFAULT_WINDOW_MS
+        self.power_threshold = DEFAULT_POWER_THRESHOLD
+        self.refractory_ms = DEFAULT_REFRACTORY_MS
+
+    def is_enabled(self) -> bool:
+        return self.mode != CLOSED_LOOP_OFF
+
+
+class ClosedLoopDetector:
+    """
+    Detects the events that trigger closed-loop stimuli on one electrode. It runs in the
+    UDP receiving process and gets each packet as soon as it arrives, so that detection
+    doesn't wait for the batching, the engine step or the filters of the display.
+    """
+    def __init__(self, config: ClosedLoopConfig, decoder: PacketDecoder, channels_per_port: int):
+        self.config = config
+        self.decoder = decoder
+        self.port_num = config.electrode // channels_per_port
+        self.channel_in_port = config.electrode % channels_per_port
+
+        # Samples of the electrode so far, and the first one that may trigger again.
+        self.num_samples = 0
+        self.next_allowed_sample = 0
+        self.refractory_samples = int(round(config.refractory_ms / 1000 * config.samples_per_sec))
+
+        if config.mode == CLOSED_LOOP_BAND_POWER:
+            nyquist = config.samples_per_sec / 2
+            self.band_sos = iirfilter(BAND_FILTER_ORDER,
+                                      [config.low_freq, min(config.high_freq, 0.99 * nyquist)],
+                                      btype='bandpass',
+                                      ftype='butter',
+                                      output='sos',
+                                      fs=config.samples_per_sec)
+            self.band_zf = np.zeros((len(self.band_sos), 2))
+            self.window_samples = max(1, int(round(config.window_ms / 1000 * config.samples_per_sec)))
+
+            # The squares of the last window_samples - 1 filtered samples.
+            self.window_tail = np.zeros(self.window_samples - 1)
+
+    def process_packet(self, buffer: bytes, port_num: int, arrival_time: float) -> Optional[float]:
+        """
+        Look for a trigger in a packet that arrived at `arrival_time`. If there's one, return
+        when its sample was acquired, as estimated from the arrival time of the packet.
+        """
+        if port_num != self.port_num:
+            return None
+
+        samples = self.decoder.decode_channel_ac(buffer, self.channel_in_port)
+        packet_start = self.num_samples
+        self.num_samples += len(samples)
+
+        if self.config.mode == CLOSED_LOOP_THRESHOLD:
+            is_trigger = (samples > self.config.upper_threshold) | (samples < self.config.lower_threshold)
+        else:
+            is_trigger = self.band_rms(samples) > self.config.power_threshold
+
+        # The samples in the refractory period can't trigger.
+        is_trigger[:max(0, self.next_allowed_sample - packet_start)] = False
+        trigger_indexes = np.flatnonzero(is_trigger)
+
+        if len(trigger_indexes) == 0:
+            return None
+
+        trigger_index = trigger_indexes[0]
+        self.next_allowed_sample = packet_start + trigger_index + self.refractory_samples
+
+        # The last sample of the packet was acquired just before the packet arrived.
+        return arrival_time - (len(samples) - 1 - trigger_index) / self.config.samples_per_sec
+
+    def band_rms(self, samples: np.ndarray) -> np.ndarray:
+        """The RMS in the band over the window that ends at each of the samples."""
+        filtered, self.band_zf = sosfilt(self.band_sos, samples, zi=self.band_zf)
+        squares = np.concatenate([self.window_tail, filtered ** 2])
+
+        sums = np.cumsum(np.concatenate([[0.], squares]))
+        window_sums = sums[self.window_samples:] - sums[:-self.window_samples]
+        self.window_tail = squares[len(squares) - (self.window_samples - 1):]
+
+        return np.sqrt(np.maximum(window_sums, 0) / self.window_samples)
+
+
+class LatencyHistogram:
+    """The latencies of the closed-loop stimuli, from the detected sample to the stimulus."""
+    def __init__(self):
+        self.latencies = deque(maxlen=MAX_LATENCIES)
+
+    def add(self, latency_sec: float):
+        self.latencies.append(latency_sec)
+
+    def clear(self):
+        self.latencies.clear()
+
+    def to_json(self) -> Dict:
+        latencies = np.array(self.latencies)
+        num_bins = int(round(MAX_LATENCY_SEC / LATENCY_BIN_SEC))
+        bins = np.clip((latencies / LATENCY_BIN_SEC).astype(int), 0, num_bins - 1)
+        counts = np.bincount(bins, minlength=num_bins)
+
+        result = {
+            'binSec': LATENCY_BIN_SEC,
+            'counts': counts.tolist(),
+            'numTriggers': len(latencies),
+        }
+
+        if len(latencies) > 0:
+            result['medianSec'] = float(np.median(latencies))
+            result['p95Sec'] = float(np.percentile(latencies, 95))
+            result['maxSec'] = float(latencies.max())
+
+        return result
+
+    def summary(self) -> str:
+        if len(self.latencies) == 0:
+            return 'no closed-loop stimuli'
+
+        histogram = self.to_json()
+        return f'{histogram["numTriggers"]} closed-loop stimuli, latency ' \
+               f'median {1000 * histogram["medianSec"]:.2f} ms, ' \
+               f'95% {1000 * histogram["p95Sec"]:.2f} ms, ' \
+               f'max {1000 * histogram["maxSec"]:.2f} ms'
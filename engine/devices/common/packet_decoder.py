@@ -0,0 +1,141 @@
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from util import electrode_name
+
+# Samples in volts = (ADC code + offset) * conversion.
+AC_OFFSET = -32768
+AC_CONVERSION = 0.195 / 1000 / 1000
+DC_OFFSET = -512
+DC_CONVERSION = -19.23 / 1000
+
+# A batch of UDP packets, as the receiving process sends them: (packet, port number) pairs.
+PacketBatch = List[Tuple[bytes, int]]
+
+
+class PacketDecoder:
+    """
+    Turns the UDP packets of the device into the AC and DC samples of each electrode.
+    Used both for the live display and for recording directly from the acquisition.
+    """
+    def __init__(self,
+                 num_ports: int,
+                 channels_per_port: int,
+                 dwords_per_batch: int,
+                 extract_dc: bool,
+                 max_samples_per_channel: Optional[int] = None):
+        self.channels_per_port = channels_per_port
+        self.num_channels = channels_per_port * num_ports
+        self.dwords_per_batch = dwords_per_batch
+        self.extract_dc = extract_dc
+
+        # Samples beyond this many per channel and per decode() are dropped. None means
+        # that no samples are ever dropped.
+        self.max_samples_per_channel = max_samples_per_channel
+
+    def decode(self, batches: Iterable[PacketBatch]) -> Dict[str, np.ndarray]:
+        batches = list(batches)
+
+        if self.max_samples_per_channel is None:
+            # Every packet has samples of all the channels of one port, so a port can't
+            # have more samples than all the packets together.
+            num_bytes = sum(len(buffer) for batch in batches for (buffer, _) in batch)
+            buffer_size = num_bytes // 4 // self.dwords_per_batch
+        else:
+            buffer_size = self.max_samples_per_channel
+
+        channel_groups = {
+            'ac': [np.zeros(buffer_size, float) for _ in range(self.num_channels)],
+            'dc': [np.zeros(buffer_size, float) for _ in range(self.num_channels)]
+        }
+
+        num_samples_per_channel = [0 for _ in range(self.num_channels)]
+
+        for batch in batches:
+            for (buffer, port_num) in batch:
+                self.process_message(buffer, port_num, channel_groups, num_samples_per_channel, buffer_size)
+
+        if max(num_samples_per_channel, default=0) == 0:
+            return dict()
+
+        results = dict()
+
+        ac_channels = channel_groups['ac']
+        dc_channels = channel_groups['dc']
+
+        for i in range(self.num_channels):
+            results[electrode_name(i, 'ac')] = ac_channels[i][:num_samples_per_channel[i]]
+            results[electrode_name(i, 'dc')] = dc_channels[i][:num_samples_per_channel[i]]
+
+        return results
+
+    def process_message(self, buffer, port_num, channel_groups, num_samples_per_channel, buffer_size):
+        # Each message consists of one or more 20 4-byte blocks.
+        # Each of these 20 blocks contains:
+        #       * 16 channel samples (in order from 0 to 15)
+        #       * 4 command responses
+
+        # Each 4-byte channel sample:
+        #
+        #       bit id: 3 3 2 2 2 2 2 2 2 2 2 2 1 1 1 1 1 1 1 1 1 1 0 0 0 0 0 0 0 0 0 0
+        #               1 0 9 8 7 6 5 4 3 2 1 0 9 8 7 6 5 4 3 2 1 0 9 8 7 6 5 4 3 2 1 1
+        #              |            AC sample          |      DC sample    | Channel ID|
+
+        # There's a chance that the channel samples are not exactly aligned to the
+        # start of the UDP packet, so we'll have to figure out which channel we should
+        # be starting with.
+        raw_samples = np.frombuffer(buffer, dtype='<u4')
+        channel_ids = raw_samples[0:self.dwords_per_batch] & 0b111111
+        first_channel_offset = np.argmax(channel_ids == 0)
+
+        num_new_samples_per_channel = math.floor(len(raw_samples) / self.dwords_per_batch)
+        raw_samples.shape = (num_new_samples_per_channel, self.dwords_per_batch)
+        raw_ac_samples = raw_samples >> 16
+
+        rescaled_ac_samples = raw_ac_samples.astype('f4')
+        rescaled_ac_samples += AC_OFFSET
+        rescaled_ac_samples *= AC_CONVERSION
+
+        if self.extract_dc:
+            raw_dc_samples = ((raw_samples >> 6) & 0b1111111111)
+            rescaled_dc_samples = raw_dc_samples.astype('f4')
+            rescaled_dc_samples += DC_OFFSET
+            rescaled_dc_samples *= DC_CONVERSION
+
+        from_channel = port_num * self.channels_per_port
+
+        for i in range(self.channels_per_port):
+            channel_position_in_packet = (first_channel_offset + i) % self.dwords_per_batch
+            from_index = num_samples_per_channel[from_channel + i]
+            to_index = from_index + num_new_samples_per_channel
+
+            if to_index > buffer_size:
+                continue
+
+            ac_samples = channel_groups['ac']
+            dc_samples = channel_groups['dc']
+            ac_samples[from_channel + i][from_index:to_index] = \
+                rescaled_ac_samples[:, channel_position_in_packet]
+
+            if self.extract_dc:
+                dc_samples[from_channel + i][from_index:to_index] = \
+                    rescaled_dc_samples[:, channel_position_in_packet]
+            num_samples_per_channel[from_channel + i] += num_new_samples_per_channel
+
+    def decode_channel_ac(self, buffer: bytes, channel_in_port: int) -> np.ndarray:
+        """
+        The AC samples of one channel of the port that sent `buffer`, without decoding
+        the other channels. For when a single channel is needed as soon as a packet arrives.
+        """
+        raw_samples = np.frombuffer(buffer, dtype='<u4')
+        channel_ids = raw_samples[0:self.dwords_per_batch] & 0b111111
+        first_channel_offset = np.argmax(channel_ids == 0)
+
+        num_samples = math.floor(len(raw_samples) / self.dwords_per_batch)
+        channel_position_in_packet = (first_channel_offset + channel_in_port) % self.dwords_per_batch
+        raw_ac_samples = raw_samples[channel_position_in_packet:num_samples * self.dwords_per_batch:
+                                     self.dwords_per_batch] >> 16
+
+        return (raw_ac_samples.astype('f4') + AC_OFFSET) * AC_CONVERSION
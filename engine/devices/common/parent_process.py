@@ -0,0 +1,16 @@
+import os
+
+import psutil
+
+
+def is_parent_alive(parent_pid: int) -> bool:
+    """
+    Check that the engine process that started this one is still running. This is much
+    cheaper than looking for it in psutil.pids(), which lists all processes of the system.
+    """
+    if os.name == 'posix':
+        # When the parent exits, the child gets another parent (init or a subreaper).
+        return os.getppid() == parent_pid
+
+    # On Windows, the parent ID stays the same after the parent exits.
+    return psutil.pid_exists(parent_pid)
@@ -0,0 +1,128 @@
+import json
+import mmap
+import struct
+from typing import Dict, Iterator, List
+
+from devices.common.packet_decoder import PacketBatch
+
+RAW_PACKET_LOG_EXTENSION = '.omraw'
+RAW_PACKET_LOG_MAGIC = b'OMEARAW\0'
+RAW_PACKET_LOG_VERSION = 1
+
+# File layout:
+#   * header: magic, version, header size, end of the data written so far (in bytes from
+#     the start of the file), and then JSON metadata, padded to HEADER_SIZE.
+#   * records: receive timestamp (time.time()), port number, reserved, payload length,
+#     and then the UDP payload as it was received.
+HEADER = struct.Struct('<8sIIQ')
+DATA_END_OFFSET = 16
+HEADER_SIZE = 16_384
+RECORD_HEADER = struct.Struct('<dHHI')
+
+# The file is preallocated, and grown, in steps of this many bytes.
+PREALLOCATE_BYTES = 1 << 30
+
+
+class RawPacketLogWriter:
+    """
+    Appends UDP payloads to a preallocated, memory-mapped file. Writing a packet is a
+    memory copy: there's no decoding, no HDF5, and no system call, except when the
+    file needs to grow.
+
+    The data end in the header is only moved past a record once the record is complete,
+    so if the process dies, the file still ends at the last complete record.
+    """
+    def __init__(self, file_path: str, metadata: Dict, preallocate_bytes: int = PREALLOCATE_BYTES):
+        self.file_path = file_path
+        self.preallocate_bytes = preallocate_bytes
+
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+
+        if HEADER.size + len(metadata_bytes) > HEADER_SIZE:
+            raise Exception('Raw packet log metadata is too large')
+
+        self.file = open(file_path, 'w+b')
+        self.file.truncate(preallocate_bytes)
+        self.mmap = mmap.mmap(self.file.fileno(), preallocate_bytes)
+
+        HEADER.pack_into(self.mmap, 0, RAW_PACKET_LOG_MAGIC, RAW_PACKET_LOG_VERSION, HEADER_SIZE, HEADER_SIZE)
+        self.mmap[HEADER.size:HEADER.size + len(metadata_bytes)] = metadata_bytes
+        self.position = HEADER_SIZE
+
+    def append(self, timestamp: float, port_num: int, payload: bytes):
+        record_end = self.position + RECORD_HEADER.size + len(payload)
+
+        if record_end > len(self.mmap):
+            self.grow(record_end)
+
+        RECORD_HEADER.pack_into(self.mmap, self.position, timestamp, port_num, 0, len(payload))
+        self.mmap[self.position + RECORD_HEADER.size:record_end] = payload
+        self.position = record_end
+
+        struct.pack_into('<Q', self.mmap, DATA_END_OFFSET, self.position)
+
+    def grow(self, min_size: int):
+        new_size = max(min_size, len(self.mmap) + self.preallocate_bytes)
+
+        # A mapping can't be resized on all platforms, so map the file again.
+        self.mmap.close()
+        self.file.truncate(new_size)
+        self.mmap = mmap.mmap(self.file.fileno(), new_size)
+
+    def close(self):
+        self.mmap.flush()
+        self.mmap.close()
+
+        # Give back the preallocated space that wasn't used.
+        self.file.truncate(self.position)
+        self.file.close()
+
+
+class RawPacketLogReader:
+    def __init__(self, file_path: str):
+        self.file = open(file_path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, header_size, data_end = HEADER.unpack_from(self.mmap, 0)
+
+        if magic != RAW_PACKET_LOG_MAGIC:
+            raise Exception(f'{file_path} is not a raw packet log')
+
+        if version != RAW_PACKET_LOG_VERSION:
+            raise Exception(f'Unsupported raw packet log version {version}')
+
+        metadata_bytes = bytes(self.mmap[HEADER.size:header_size]).rstrip(b'\0')
+        self.metadata: Dict = json.loads(metadata_bytes)
+        self.header_size = header_size
+        self.data_end = data_end
+
+    def records(self) -> Iterator[tuple]:
+        """Yield (timestamp, port number, payload) for every packet in the log."""
+        position = self.header_size
+
+        while position < self.data_end:
+            timestamp, port_num, _, length = RECORD_HEADER.unpack_from(self.mmap, position)
+            payload_from = position + RECORD_HEADER.size
+            yield timestamp, port_num, self.mmap[payload_from:payload_from + length]
+            position = payload_from + length
+
+    def batches(self, max_batch_bytes: int) -> Iterator[PacketBatch]:
+        """Group the packets into batches like the ones that the UDP receiving process sends."""
+        batch: List = []
+        batch_bytes = 0
+
+        for _, port_num, payload in self.records():
+            batch.append((payload, port_num))
+            batch_bytes += len(payload)
+
+            if batch_bytes >= max_batch_bytes:
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+        if len(batch) > 0:
+            yield batch
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
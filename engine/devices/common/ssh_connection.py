@@ -1,4 +1,6 @@
+import struct
 import sys
+import threading
 import time
 from io import BytesIO
 from typing import Dict, Optional
@@ -7,6 +9,37 @@ import paramiko
 
 MAX_COMMANDS_PER_LINE = 10_000
 
+# The transport sends a keepalive this often, so that an idle connection isn't dropped
+# along the way, and so that a dead one is noticed without running a command.
+KEEPALIVE_INTERVAL_SEC = 5
+
+# Commands run in one long-lived remote shell instead of a new channel each. The shell
+# prints this, followed by a running number, when a command is done.
+COMMAND_SHELL = 'sh'
+COMMAND_DONE_MARKER = '__openmea_command_done_'
+
+# With a `stim_stream_tool`, chip commands are streamed to one long-lived remote process
+# instead of being uploaded as files for every batch. Each frame is the chip number and
+# the payload length, followed by the payload; a frame for STREAM_END_OF_BATCH without
+# a payload ends a batch. The tool prints STREAM_READY_MESSAGE once it's running.
+STREAM_FRAME_HEADER = struct.Struct('<II')
+STREAM_END_OF_BATCH = 0xffffffff
+STREAM_READY_MESSAGE = 'stim_stream ready'
+STREAM_START_TIMEOUT_SEC = 5
+
+
+class PreloadedChipCommands:
+    """
+    Chip commands that are prepared once and then executed many times with as little work
+    as possible: as a ready-made stream batch, or as command files that stay on the device.
+    """
+    def __init__(self, commands: Dict[int, BytesIO], stream_batch: bytes):
+        self.commands = commands
+        self.stream_batch = stream_batch
+
+        # The uploaded command files by chip, if the commands have been uploaded.
+        self.remote_files: Dict[int, str] = {}
+
 
 class SshConnection:
     def __init__(self, ssh_config: Dict):
@@ -25,7 +58,25 @@ class SshConnection:
         if 'write_evenly_tool' in ssh_config:
             self.write_evenly_tool = ssh_config['write_evenly_tool']
 
+        self.stim_stream_tool = ""
+        if 'stim_stream_tool' in ssh_config:
+            self.stim_stream_tool = ssh_config['stim_stream_tool']
+
         self.ssh = None
+        self.sftp: Optional[paramiko.SFTPClient] = None
+        self.shell: Optional[paramiko.Channel] = None
+        self.shell_stdin = None
+        self.shell_stdout = None
+        self.num_shell_commands = 0
+        self.stim_stream: Optional[paramiko.Channel] = None
+
+        # Set if the streaming tool couldn't be started; the commands are then uploaded
+        # as files until the next connect().
+        self.stim_stream_failed = False
+
+        # The connection is checked from a separate thread, while stimulation commands go
+        # out from the main one; both use the same SFTP session and shell.
+        self.lock = threading.RLock()
 
         self.connect()
 
@@ -38,35 +89,122 @@ class SshConnection:
         return self.ssh is not None
 
     def connect(self):
-        try:
-            self.ssh = paramiko.SSHClient()
-            self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh.connect(self.ssh_config['host'],
-                             port=self.ssh_config['port'],
-                             username=self.ssh_config['username'],
-                             password=self.ssh_config['password'])
-
-        except:
+        with self.lock:
+            self.close()
+            self.stim_stream_failed = False
+
+            try:
+                self.ssh = paramiko.SSHClient()
+                self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+                self.ssh.connect(self.ssh_config['host'],
+                                 port=self.ssh_config['port'],
+                                 username=self.ssh_config['username'],
+                                 password=self.ssh_config['password'])
+                self.ssh.get_transport().set_keepalive(KEEPALIVE_INTERVAL_SEC)
+
+            except:
+                self.ssh = None
+                print(f'Could not connect to {self.ssh_config["host"]}:{self.ssh_config["port"]}')
+
+    def close(self):
+        """Close the SFTP session, the command shell and the connection, if they're open."""
+        with self.lock:
+            for closable in [self.stim_stream, self.sftp, self.shell, self.ssh]:
+                if closable is None:
+                    continue
+
+                try:
+                    closable.close()
+                except Exception:
+                    pass
+
             self.ssh = None
-            print(f'Could not connect to {self.ssh_config["host"]}:{self.ssh_config["port"]}')
+            self.sftp = None
+            self.shell = None
+            self.stim_stream = None
 
     def is_connected(self):
         if self.ssh is None:
             return False
 
-        try:
-            transport = self.ssh.get_transport()
-            if transport is None or not transport.is_active():
-                self.ssh = None
-                return False
+        transport = self.ssh.get_transport()
+        if transport is None or not transport.is_active():
+            self.close()
+            return False
 
-            self.ssh.exec_command('ls', timeout=0.1)
-        except EOFError as e:
-            self.ssh = None
+        try:
+            # An ignore message doesn't start anything on the device and doesn't wait for a
+            # reply, but sending it fails if the connection is gone.
+            transport.send_ignore()
+        except (EOFError, OSError, paramiko.SSHException):
+            self.close()
             return False
 
         return True
 
+    def get_sftp(self) -> paramiko.SFTPClient:
+        """The SFTP session, opened on first use and kept for the next uploads."""
+        if self.sftp is None or self.sftp.get_channel().closed:
+            self.sftp = self.ssh.open_sftp()
+
+        return self.sftp
+
+    def get_shell(self) -> paramiko.Channel:
+        """The remote shell that runs the commands, started on first use or if it has exited."""
+        if self.shell is None or self.shell.closed or self.shell.exit_status_ready():
+            self.shell = self.ssh.get_transport().open_session()
+            self.shell.set_combine_stderr(True)
+            self.shell.exec_command(COMMAND_SHELL)
+            self.shell_stdin = self.shell.makefile('wb')
+            self.shell_stdout = self.shell.makefile('r')
+
+        return self.shell
+
+    def is_streaming(self) -> bool:
+        """Whether chip commands go through the streaming tool, rather than uploaded files."""
+        return len(self.stim_stream_tool) > 0 and not self.stim_stream_failed
+
+    def get_stim_stream(self) -> Optional[paramiko.Channel]:
+        """The channel to the streaming tool, started on first use or if it has exited."""
+        if self.stim_stream is not None and not self.stim_stream.closed \
+                and not self.stim_stream.exit_status_ready():
+            return self.stim_stream
+
+        if self.stim_stream is not None:
+            print(f'Stimulation stream exited: {self.read_available(self.stim_stream)}')
+
+        command_str = self.stim_stream_tool + ''.join(f' {fifo_dev}' for fifo_dev in self.fifo_dev_files)
+
+        channel = self.ssh.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.settimeout(STREAM_START_TIMEOUT_SEC)
+        channel.exec_command(command_str)
+
+        try:
+            ready_line = channel.makefile('r').readline().strip()
+        except OSError:
+            ready_line = ''
+
+        if ready_line != STREAM_READY_MESSAGE:
+            print(f'Could not start the stimulation stream: {ready_line}{self.read_available(channel)}')
+            channel.close()
+            self.stim_stream = None
+            self.stim_stream_failed = True
+            return None
+
+        channel.settimeout(None)
+        self.stim_stream = channel
+        return channel
+
+    @staticmethod
+    def read_available(channel: paramiko.Channel) -> str:
+        output = b''
+
+        while channel.recv_ready():
+            output += channel.recv(65536)
+
+        return output.decode('utf-8', errors='replace')
+
     def exec_chip_commands(self, commands: Dict[int, BytesIO]):
         """Execute Intan chip commands. The keys of the input should be
         the chip IDs, and the values should be the lists of commands to be
@@ -75,21 +213,119 @@ class SshConnection:
             print(f'Could not send commands; SSH client is not connected.')
             return None
 
-        # Upload the groups of commands as files over SFTP
-        sftp = self.ssh.open_sftp()
-        remote_files = {}
+        with self.lock:
+            if self.is_streaming() and self.stream_chip_commands(commands):
+                return
+
+            self.upload_chip_commands(commands)
+
+    def preload_chip_commands(self, commands: Dict[int, BytesIO]) -> PreloadedChipCommands:
+        """
+        Prepare commands for exec_preloaded_chip_commands(). Without the streaming tool, they're
+        uploaded now, so that executing them only takes one command on the device.
+        """
+        preloaded = PreloadedChipCommands(commands, self.make_stream_batch(commands))
+
+        if self.ssh is not None and not self.is_streaming():
+            with self.lock:
+                preloaded.remote_files = self.upload_command_files(commands)
+
+        return preloaded
+
+    def exec_preloaded_chip_commands(self, preloaded: PreloadedChipCommands):
+        if self.ssh is None:
+            print(f'Could not send commands; SSH client is not connected.')
+            return
 
+        with self.lock:
+            if self.is_streaming() and self.send_stream_batch(preloaded.stream_batch):
+                return
+
+            # The streaming tool may have failed since the commands were preloaded.
+            if len(preloaded.remote_files) == 0:
+                preloaded.remote_files = self.upload_command_files(preloaded.commands)
+
+            self.exec_ssh(self.insert_command(preloaded.remote_files, False))
+
+    def remove_preloaded_chip_commands(self, preloaded: PreloadedChipCommands):
+        """Remove the command files of `preloaded` from the device, if it was uploaded."""
+        if self.ssh is None or len(preloaded.remote_files) == 0 or not self.remove_remote_files:
+            return
+
+        self.exec_ssh('rm' + ''.join(f' {remote_file}' for remote_file in preloaded.remote_files.values()))
+        preloaded.remote_files = {}
+
+    def stream_chip_commands(self, commands: Dict[int, BytesIO]) -> bool:
+        """Send the commands to the streaming tool as one batch. Return False if they couldn't be sent."""
+        return self.send_stream_batch(self.make_stream_batch(commands))
+
+    @staticmethod
+    def make_stream_batch(commands: Dict[int, BytesIO]) -> bytes:
+        """The frames of the streaming tool for the commands, or nothing if there are no commands."""
+        frames = BytesIO()
+
+        for chip, chip_commands in commands.items():
+            payload = chip_commands.getvalue()
+            if len(payload) == 0:
+                continue
+
+            frames.write(STREAM_FRAME_HEADER.pack(chip, len(payload)))
+            frames.write(payload)
+
+        if frames.tell() == 0:
+            return b''
+
+        frames.write(STREAM_FRAME_HEADER.pack(STREAM_END_OF_BATCH, 0))
+        return frames.getvalue()
+
+    def send_stream_batch(self, batch: bytes) -> bool:
+        """Send a batch from make_stream_batch() to the streaming tool. Return False if it couldn't be sent."""
+        if len(batch) == 0:
+            return True
+
+        try:
+            stim_stream = self.get_stim_stream()
+            if stim_stream is None:
+                return False
+
+            stim_stream.sendall(batch)
+
+        except (EOFError, OSError, paramiko.SSHException) as e:
+            print(f'Could not stream the stimulation commands: {e}')
+            self.stim_stream = None
+            return False
+
+        return True
+
+    def upload_chip_commands(self, commands: Dict[int, BytesIO]):
         start_upload = time.time()
+        remote_files = self.upload_command_files(commands)
+
+        start_insert = time.time()
+        self.exec_ssh(self.insert_command(remote_files, self.remove_remote_files))
+        now = time.time()
+        print(f'Upload: {start_insert - start_upload}; insert: {now - start_insert}')
+        sys.stdout.flush()
+
+    def upload_command_files(self, commands: Dict[int, BytesIO]) -> Dict[int, str]:
+        """Upload the groups of commands as files over SFTP. Returns the files by chip."""
+        sftp = self.get_sftp()
+        remote_files = {}
+
         for chip, chip_commands in commands.items():
             chip_commands.seek(0)
             if len(chip_commands.getbuffer()) == 0:
                 continue
 
             remote_file = self.make_commands_file(chip)
-            sftp.putfo(chip_commands, remote_file)
+            # Skip the stat() of the uploaded file, which would cost another round trip.
+            sftp.putfo(chip_commands, remote_file, confirm=False)
             remote_files[chip] = remote_file
 
-        # Send the commands into the command FIFO devices for each chip
+        return remote_files
+
+    def insert_command(self, remote_files: Dict[int, str], remove_files: bool) -> str:
+        """The command that sends the uploaded command files into the command FIFO devices for each chip."""
         command_str = '' + self.write_evenly_tool
 
         for remote_file in remote_files.values():
@@ -99,15 +335,11 @@ class SshConnection:
             fifo_dev = self.fifo_dev_files[chip]
             command_str += f' {fifo_dev}'
 
-        if self.remove_remote_files:
+        if remove_files:
             for remote_file in remote_files.values():
                 command_str += f'; rm {remote_file}'
 
-        start_insert = time.time()
-        self.exec_ssh(command_str)
-        now = time.time()
-        print(f'Upload: {start_insert - start_upload}; insert: {now - start_insert}')
-        sys.stdout.flush()
+        return command_str
 
     def exec_same_chip_commands_on_all(self, commands: BytesIO):
         """Execute Intan chip commands on all chips"""
@@ -134,9 +366,34 @@ class SshConnection:
         if (commands is None) or (len(commands) == 0):
             return None
 
-        stdin, stdout, stderr = self.ssh.exec_command(commands)
-        result = stdout.read() + stderr.read()
-        return result.decode('utf-8')
+        with self.lock:
+            self.get_shell()
+            self.num_shell_commands += 1
+            done_marker = f'{COMMAND_DONE_MARKER}{self.num_shell_commands}'
+
+            # The commands mustn't read the shell's own input, which is where the next
+            # commands come from. The marker goes on a line of its own even if the output
+            # doesn't end with a newline.
+            self.shell_stdin.write(f'{{ {commands}\n}} < /dev/null 2>&1; '
+                                   f'printf \'\\n%s\\n\' {done_marker}\n'.encode('utf-8'))
+            self.shell_stdin.flush()
+
+            lines = []
+
+            while True:
+                line = self.shell_stdout.readline()
+
+                # The shell has exited, e.g. because the commands included `exit`.
+                if line == '':
+                    self.shell = None
+                    return ''.join(lines)
+
+                if line.rstrip('\n') == done_marker:
+                    break
+
+                lines.append(line)
+
+            return ''.join(lines)[:-1]
 
     def make_commands_file(self, chip_num):
         timestamp = round(time.time() * 1000)
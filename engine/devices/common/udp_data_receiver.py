@@ -1,31 +1,47 @@
 import logging
-import math
 import os
+import queue
 import select
 import socket
 import threading
 import time
 from multiprocessing import Process, Queue
-from typing import List, Dict, Iterable
+from typing import List, Dict, Iterable, Optional
 
-import numpy as np
-import psutil
-
-from util import electrode_name
+from devices.common.closed_loop import ClosedLoopConfig, ClosedLoopDetector
+from devices.common.packet_decoder import PacketDecoder
+from devices.common.parent_process import is_parent_alive
+from devices.common.raw_packet_log import RawPacketLogWriter
+from devices.common.udp_recorder import record_udp_messages
 
 MAX_SAMPLES = 100_000
 MAX_MESSAGES = 10_000
 BUFFER_SIZE = 50_000
 
+# Batches of packets (about 10 ms each) that may wait for the recorder process.
+RECORD_QUEUE_SIZE = 3_000
+
+# Commands for the receiving process. They're sent as tuples of the command and its arguments.
+RECORD_START = 'startRecording'
+RECORD_STOP = 'stopRecording'
+RAW_CAPTURE_START = 'startRawCapture'
+RAW_CAPTURE_STOP = 'stopRawCapture'
+CLOSED_LOOP_START = 'startClosedLoop'
+CLOSED_LOOP_STOP = 'stopClosedLoop'
+
+# When the device is closed, wait this long for the recorder to finish the file.
+RECORDER_STOP_TIMEOUT_SEC = 30
+
 
 def exit_if_parent_exits(parent_pid):
     while True:
         time.sleep(1)
-        if parent_pid not in psutil.pids():
+        if not is_parent_alive(parent_pid):
             return
 
 
-def receive_udp_messages(ports, msg_queue, parent_pid):
+def receive_udp_messages(ports, msg_queue, parent_pid, record_queue, control_queue, status_queue,
+                         decoder: PacketDecoder, trigger_connection):
     socks = []
 
     # Start a thread that will monitor whether the parent is still around.
@@ -45,12 +61,39 @@ def receive_udp_messages(ports, msg_queue, parent_pid):
     batch = []
     last_queue_send_time = time.time()
     min_queue_send_delay = 0.01
+    is_recording = False
+    raw_log: Optional[RawPacketLogWriter] = None
+
+    # Samples received so far, counted on the first port like the engine's sample clock
+    # counts them on the first electrode. A direct recording is told the sample it starts at.
+    num_samples_received = 0
+
+    # In closed-loop mode, each packet is checked for triggers as soon as it arrives, and
+    # the time of each trigger goes straight to the device process through `trigger_connection`.
+    detector: Optional[ClosedLoopDetector] = None
+
+    def send_batch():
+        # While recording, the batches are also teed to the recorder process. The display
+        # may drop batches when the engine falls behind, but the recording must not.
+        if is_recording:
+            try:
+                record_queue.put_nowait(batch)
+            except queue.Full:
+                print("Recording queue is full, packets were lost")
+
+        try:
+            msg_queue.put_nowait(batch)
+        except queue.Full:
+            print("Queue is full")
 
     # Continuously poll the sockets for results.
     while True:
         socks_ready, _, _ = select.select(socks, [], [], 1)
 
         if not parent_monitor_thread.is_alive():
+            if raw_log is not None:
+                raw_log.close()
+
             msg_queue.close()
             os.abort()
 
@@ -58,18 +101,67 @@ def receive_udp_messages(ports, msg_queue, parent_pid):
             (_, port) = sock.getsockname()
             port_num = ports.index(port)
             buffer = sock.recv(8200)
+            arrival_time = time.time()
+
+            if port_num == 0:
+                num_samples_received += len(buffer) // 4 // decoder.dwords_per_batch
+
+            if detector is not None:
+                trigger_time = detector.process_packet(buffer, port_num, arrival_time)
+
+                if trigger_time is not None:
+                    trigger_connection.send(trigger_time)
+
+            # Raw capture keeps the packets exactly as they were received, before anything else happens.
+            if raw_log is not None:
+                raw_log.append(arrival_time, port_num, buffer)
 
             batch.append((buffer, port_num))
-            now = time.time()
 
-            # To prevent overloading the queue, we'll batch the results into lists of received messages.
-            if (now - last_queue_send_time) > min_queue_send_delay:
-                msg_queue.put_nowait(batch)
+        now = time.time()
+
+        # To prevent overloading the queue, we'll batch the results into lists of received messages.
+        if (now - last_queue_send_time) > min_queue_send_delay:
+            if len(batch) > 0:
+                send_batch()
                 batch = []
-                last_queue_send_time = now
 
-            if msg_queue.full():
-                print("Queue is full")
+            last_queue_send_time = now
+
+            while not control_queue.empty():
+                command, *args = control_queue.get()
+
+                if command == RECORD_START:
+                    # The recording starts with the packets after the ones in `batch`.
+                    batch_samples = sum(len(buffer) // 4 // decoder.dwords_per_batch
+                                        for buffer, port_num in batch if port_num == 0)
+                    record_queue.put({'startSample': num_samples_received - batch_samples})
+                    is_recording = True
+                elif command == RECORD_STOP and is_recording:
+                    # Everything received until now goes into the recording.
+                    if len(batch) > 0:
+                        send_batch()
+                        batch = []
+
+                    record_queue.put(None)
+                    is_recording = False
+                elif command == RAW_CAPTURE_START and raw_log is None:
+                    file_path, metadata = args
+
+                    try:
+                        raw_log = RawPacketLogWriter(file_path, metadata)
+                        status_queue.put({'isRecording': True})
+                    except Exception as e:
+                        status_queue.put({'isRecording': False, 'error': f'Could not start the raw capture: {e}'})
+                elif command == RAW_CAPTURE_STOP and raw_log is not None:
+                    raw_log.close()
+                    raw_log = None
+                    status_queue.put({'isRecording': False})
+                elif command == CLOSED_LOOP_START and trigger_connection is not None:
+                    config, = args
+                    detector = ClosedLoopDetector(config, decoder, decoder.channels_per_port)
+                elif command == CLOSED_LOOP_STOP:
+                    detector = None
 
 
 class UdpDataReceiver:
@@ -77,7 +169,8 @@ class UdpDataReceiver:
                  ports: List[int],
                  channels_per_port: int,
                  dwords_per_batch: int,
-                 extract_dc: bool):
+                 extract_dc: bool,
+                 trigger_connection=None):
         self.ports = ports
         self.num_channels = channels_per_port * len(ports)
         self.channels_per_port = channels_per_port
@@ -85,102 +178,146 @@ class UdpDataReceiver:
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
         self.extract_dc = extract_dc
+        self.decoder = PacketDecoder(len(ports), channels_per_port, dwords_per_batch, extract_dc, BUFFER_SIZE)
 
         self.msg_queue = Queue(maxsize=10_000)
 
+        # The recorder process gets its own copy of the packets, through its own queue.
+        self.record_queue = Queue(maxsize=RECORD_QUEUE_SIZE)
+        self.control_queue = Queue()
+        self.status_queue = Queue()
+        self.recorder_process: Optional[Process] = None
+        self.recording_state_messages = []
+        self.is_capturing_raw = False
+
         # Receive UDP messages in a separate process. As far as I can tell, this is the only way to make sure
         # that we receive every UDP message.
-        self.process = Process(target=receive_udp_messages, args=(ports, self.msg_queue, os.getpid()))
+        # The closed-loop detector decodes single channels of the packets with its own decoder.
+        detector_decoder = PacketDecoder(len(ports), channels_per_port, dwords_per_batch, False)
+
+        self.process = Process(target=receive_udp_messages,
+                               args=(ports, self.msg_queue, os.getpid(), self.record_queue, self.control_queue,
+                                     self.status_queue, detector_decoder, trigger_connection))
         self.process.start()
 
     def close(self):
+        # Let the recording finish, so that the file is complete.
+        if self.recorder_process is not None:
+            self.stop_recording()
+            self.recorder_process.join(RECORDER_STOP_TIMEOUT_SEC)
+
+        if self.is_capturing_raw:
+            self.stop_raw_capture()
+
+            # Wait for the receiving process to close the log.
+            try:
+                while self.status_queue.get(timeout=RECORDER_STOP_TIMEOUT_SEC).get('isRecording', False):
+                    pass
+            except queue.Empty:
+                pass
+
         self.process.terminate()
         self.process.join()
         self.process.close()
 
-    def process_message(self, buffer, port_num, channel_groups, num_samples_per_channel):
-        # Each message consists of one or more 20 4-byte blocks.
-        # Each of these 20 blocks contains:
-        #       * 16 channel samples (in order from 0 to 15)
-        #       * 4 command responses
-
-        # Each 4-byte channel sample:
-        #
-        #       bit id: 3 3 2 2 2 2 2 2 2 2 2 2 1 1 1 1 1 1 1 1 1 1 0 0 0 0 0 0 0 0 0 0
-        #               1 0 9 8 7 6 5 4 3 2 1 0 9 8 7 6 5 4 3 2 1 0 9 8 7 6 5 4 3 2 1 1
-        #              |            AC sample          |      DC sample    | Channel ID|
-
-        # There's a chance that the channel samples are not exactly aligned to the
-        # start of the UDP packet, so we'll have to figure out which channel we should
-        # be starting with.
-        raw_samples = np.frombuffer(buffer, dtype='<u4')
-        channel_ids = raw_samples[0:self.dwords_per_batch] & 0b111111
-        first_channel_offset = np.argmax(channel_ids == 0)
-
-        num_new_samples_per_channel = math.floor(len(raw_samples) / self.dwords_per_batch)
-        raw_samples.shape = (num_new_samples_per_channel, self.dwords_per_batch)
-        raw_ac_samples = raw_samples >> 16
-
-        rescaled_ac_samples = raw_ac_samples.astype('f4')
-        rescaled_ac_samples -= 32768
-        rescaled_ac_samples *= (0.195 / 1000 / 1000)
-
-        if self.extract_dc:
-            raw_dc_samples = ((raw_samples >> 6) & 0b1111111111)
-            rescaled_dc_samples = raw_dc_samples.astype('f4')
-            rescaled_dc_samples -= 512
-            rescaled_dc_samples *= (-19.23) / 1000
-
-        from_channel = port_num * self.channels_per_port
-
-        for i in range(self.channels_per_port):
-            channel_position_in_packet = (first_channel_offset + i) % self.dwords_per_batch
-            from_index = num_samples_per_channel[from_channel + i]
-            to_index = from_index + num_new_samples_per_channel
-
-            if to_index > BUFFER_SIZE:
-                continue
-
-            ac_samples = channel_groups['ac']
-            dc_samples = channel_groups['dc']
-            ac_samples[from_channel + i][from_index:to_index] = \
-                rescaled_ac_samples[:, channel_position_in_packet]
-
-            if self.extract_dc:
-                dc_samples[from_channel + i][from_index:to_index] = \
-                    rescaled_dc_samples[:, channel_position_in_packet]
-            num_samples_per_channel[from_channel + i] += num_new_samples_per_channel
-
-    def collect_data(self) -> Dict[str, Iterable]:
-        queue_size_approx = self.msg_queue.qsize()
-        messages_taken = 0
-        total_buffers = 0
+    def start_recording(self, writer_config_json: Dict, device_props: Dict):
+        """Record the incoming samples straight to an NWB file, configured like the NwbFileWriter step."""
+        if self.recorder_process is not None:
+            self.stop_recording()
+            self.recorder_process.join()
+            self.check_recorder_process()
+
+        # The recorder never drops samples, however many have piled up in the queue.
+        decoder = PacketDecoder(len(self.ports), self.channels_per_port, self.dwords_per_batch, self.extract_dc)
+
+        self.recorder_process = Process(target=record_udp_messages,
+                                        args=(self.record_queue, decoder, writer_config_json, device_props,
+                                              os.getpid()),
+                                        name='udp-recorder')
+        self.recorder_process.start()
+        self.control_queue.put((RECORD_START,))
+        self.recording_state_messages.append({'isRecording': True})
+
+    def stop_recording(self):
+        # The recorder process finishes the file on its own; collect_recording_state()
+        # reports when it's done.
+        self.control_queue.put((RECORD_STOP,))
+
+    def record_events(self, events: List[Dict]):
+        """Store the events in the recording, if there is one. See record_udp_messages()."""
+        if self.recorder_process is None:
+            return
 
-        channel_groups = {
-            'ac': [np.zeros(BUFFER_SIZE, float) for _ in range(self.num_channels)],
-            'dc': [np.zeros(BUFFER_SIZE, float) for _ in range(self.num_channels)]
+        try:
+            self.record_queue.put_nowait({'events': events})
+        except queue.Full:
+            print("Recording queue is full, events were lost")
+
+    def start_raw_capture(self, file_path: str, samples_per_sec: int, device_props: Dict):
+        """
+        Append the raw UDP packets to a raw packet log, right from the receiving process.
+        The metadata has everything that's needed to decode the log later.
+        """
+        metadata = {
+            'deviceProps': device_props,
+            'samplesPerSec': samples_per_sec,
+            'numPorts': len(self.ports),
+            'channelsPerPort': self.channels_per_port,
+            'dwordsPerBatch': self.dwords_per_batch,
+            'extractDC': self.extract_dc,
         }
 
-        num_samples_per_channel = [0 for _ in range(self.num_channels)]
+        self.control_queue.put((RAW_CAPTURE_START, file_path, metadata))
+        self.is_capturing_raw = True
 
-        while not self.msg_queue.empty() and messages_taken < queue_size_approx:
-            messages_taken += 1
-            messages = self.msg_queue.get()
+    def stop_raw_capture(self):
+        self.control_queue.put((RAW_CAPTURE_STOP,))
+        self.is_capturing_raw = False
 
-            for (buffer, port_num) in messages:
-                total_buffers += 1
-                self.process_message(buffer, port_num, channel_groups, num_samples_per_channel)
+    def start_closed_loop(self, config_json: Dict, samples_per_sec: float):
+        """Start detecting the closed-loop triggers, if the device has a trigger connection."""
+        config = ClosedLoopConfig.from_json(config_json, samples_per_sec)
 
-        if max(num_samples_per_channel) == 0:
-            return dict()
+        if config.is_enabled():
+            self.control_queue.put((CLOSED_LOOP_START, config))
 
-        results = dict()
+    def stop_closed_loop(self):
+        self.control_queue.put((CLOSED_LOOP_STOP,))
 
-        ac_channels = channel_groups['ac']
-        dc_chammels = channel_groups['dc']
+    def collect_recording_state(self) -> List[Dict]:
+        self.check_recorder_process()
+
+        while not self.status_queue.empty():
+            self.recording_state_messages.append(self.status_queue.get())
+
+        messages = self.recording_state_messages
+        self.recording_state_messages = []
+        return messages
+
+    def check_recorder_process(self):
+        if self.recorder_process is None or self.recorder_process.is_alive():
+            return
 
-        for i in range(self.num_channels):
-            results[electrode_name(i, 'ac')] = ac_channels[i][:num_samples_per_channel[i]]
-            results[electrode_name(i, 'dc')] = dc_chammels[i][:num_samples_per_channel[i]]
+        exit_code = self.recorder_process.exitcode
+        self.recorder_process.join()
+        self.recorder_process.close()
+        self.recorder_process = None
+
+        if exit_code == 0:
+            self.recording_state_messages.append({'isRecording': False})
+        else:
+            self.recording_state_messages.append({
+                'isRecording': False,
+                'error': f'The recording stopped unexpectedly (exit code {exit_code})'
+            })
+
+    def collect_data(self) -> Dict[str, Iterable]:
+        queue_size_approx = self.msg_queue.qsize()
+        messages_taken = 0
+        batches = []
+
+        while not self.msg_queue.empty() and messages_taken < queue_size_approx:
+            messages_taken += 1
+            batches.append(self.msg_queue.get())
 
-        return results
+        return self.decoder.decode(batches)
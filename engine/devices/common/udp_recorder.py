@@ -0,0 +1,81 @@
+import logging
+import queue
+from typing import Dict
+
+from devices.common.packet_decoder import PacketDecoder
+from devices.common.parent_process import is_parent_alive
+from devices.recording_device import RecordingDevice
+from sample_clock import SampleClock
+from sources_and_sinks.nwb_file_writer import NwbFileWriterConfig
+from sources_and_sinks.spike_event_nwb_file_writer import create_nwb_file_writer
+
+# Up to this many packet batches (about 10 ms each) are decoded and handed to the writer at once.
+MAX_BATCHES_PER_STEP = 50
+
+# How often the recorder checks that the engine is still around while no packets come in.
+PARENT_CHECK_INTERVAL_SEC = 1
+
+
+class RecorderEngine:
+    """
+    The part of `Engine` that NwbFileWriter.configure() needs. There are no published steps:
+    the stimulus events come through the record queue, and so does the sample that the
+    recording starts at.
+    """
+    def __init__(self, device_props: Dict):
+        self.device = RecordingDevice(device_props)
+        self.published_steps: Dict = dict()
+        self.sample_clock = SampleClock()
+
+
+def record_udp_messages(record_queue, decoder: PacketDecoder, writer_config_json: Dict, device_props: Dict, parent_pid):
+    """
+    Entry point of the recorder process. The UDP receiving process tees the packet batches
+    into `record_queue` while recording; they're decoded here and written to the NWB file
+    until a None arrives. The engine process is not involved, so its load doesn't matter,
+    except that it also puts the stimulus events ({'events': [...]}) into the queue. The
+    receiving process puts the acquisition sample of the first batch ({'startSample': ...})
+    in front of the batches.
+    """
+    log = logging.getLogger(__name__)
+
+    writer_config = NwbFileWriterConfig.from_json(writer_config_json)
+    writer = create_nwb_file_writer(writer_config)
+    writer.configure(writer_config, RecorderEngine(device_props))
+    is_done = False
+
+    try:
+        while not is_done:
+            try:
+                batches = [record_queue.get(timeout=PARENT_CHECK_INTERVAL_SEC)]
+            except queue.Empty:
+                # If the engine is gone, so is the UDP receiver. Keep what was recorded so far.
+                if not is_parent_alive(parent_pid):
+                    log.warning('The engine has exited; finishing the recording')
+                    break
+
+                continue
+
+            while len(batches) < MAX_BATCHES_PER_STEP and batches[-1] is not None:
+                try:
+                    batches.append(record_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batches[-1] is None:
+                batches.pop()
+                is_done = True
+
+            for item in batches:
+                if isinstance(item, dict) and 'startSample' in item:
+                    writer.start_sample = item['startSample']
+                elif isinstance(item, dict):
+                    writer.add_stimulus_events(item['events'])
+
+            data = decoder.decode([item for item in batches if not isinstance(item, dict)])
+
+            if len(data) > 0:
+                writer.do_step(data)
+
+    finally:
+        writer.finalize()
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, List, Set
 
 
 class Device:
@@ -13,6 +13,20 @@ class Device:
     def close(self):
         pass
 
+    def set_subscribed_series(self, series_names: Set[str]):
+        """
+        Called with the names of the published series that pipelines read from whenever
+        they change. Devices may use this to skip loading the other series.
+        """
+        pass
+
+    def record_events(self, events: List[Dict]):
+        """
+        Called with the events of each engine step that carry an acquisition sample. Devices
+        that record without the engine (see 'canRecordDirectly') store them in the recording.
+        """
+        pass
+
     def num_electrodes(self) -> int:
         return 0
 
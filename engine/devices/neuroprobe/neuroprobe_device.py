@@ -14,6 +14,7 @@ DEVICE_PROPS = {
     'canControlReplay': False,
     'canControlSampling': True,
     'canRecordToFile': True,
+    'canRecordDirectly': True,
     'canStimulate': True,
     'canSampleDC': False,
     'numElectrodes': NEUROPROBE_NUM_ELECTRODES,
@@ -63,14 +64,27 @@ class NeuroprobeDevice(Device):
         if self.is_closed:
             return
 
-        self.send_queue.put_nowait(msg)
+        # Recording is handled next to the UDP receiver, not by the device process.
+        if 'startRecording' in msg:
+            self.udp_data_receiver.start_recording(msg['startRecording'], self.get_properties())
+        elif 'stopRecording' in msg:
+            self.udp_data_receiver.stop_recording()
+        elif 'startRawCapture' in msg:
+            config = msg['startRawCapture']
+            self.udp_data_receiver.start_raw_capture(config['filePath'],
+                                                     config['samplesPerSec'],
+                                                     self.get_properties())
+        elif 'stopRawCapture' in msg:
+            self.udp_data_receiver.stop_raw_capture()
+        else:
+            self.send_queue.put_nowait(msg)
 
     def collect_updates(self):
         if self.is_closed:
             return {}
 
         result = {
-            'state': [],
+            'state': self.udp_data_receiver.collect_recording_state(),
             'data': self.udp_data_receiver.collect_data()
         }
 
@@ -6,23 +6,26 @@ import threading
 import time
 from typing import Dict
 
-import psutil
-
+from devices.common.parent_process import is_parent_alive
 from devices.common.ssh_connection import SshConnection
 
 DEVICE_SCLK_FREQ = 200_000_000.
 MAX_SAMPLES_PER_SEC = 40_000.
 
+# Without messages, the control loop wakes up this often to check that the engine is still running.
+PARENT_CHECK_INTERVAL_SEC = 1
+
+# The connection to the device is checked this often.
+CONNECTION_CHECK_INTERVAL_SEC = 5
+
 
 class NeuroprobeDeviceProcess:
     def __init__(self, rcv_queue, send_queue, parent_pid, config: Dict):
         self.rcv_queue = rcv_queue
         self.send_queue = send_queue
         self.parent_pid = parent_pid
-        self.last_parent_exit_check_time = time.time()
 
         self.ssh_connection = SshConnection(config)
-        self.last_ssh_connection_check = time.time()
         self.connected = False
 
         self.device_init_commands = config['device_init_commands']
@@ -104,27 +107,35 @@ class NeuroprobeDeviceProcess:
             self.exec_device_command('rhd_sample_dis')
 
 
-    def process_messages(self):
+    def process_messages(self, timeout: float):
+        """Wait up to `timeout` seconds for messages, and process all the ones that came in."""
+        try:
+            msg = self.rcv_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
         while True:
-            self.exit_if_parent_exists()
+            self.process_message(msg)
 
             try:
                 msg = self.rcv_queue.get_nowait()
-                self.process_message(msg)
             except queue.Empty:
                 break
 
     def run_loop(self):
-        while True:
-            now = time.time()
+        connection_monitor_thread = threading.Thread(target=self.run_connection_monitor,
+                                                     name='connection-monitor',
+                                                     daemon=True)
+        connection_monitor_thread.start()
 
-            if now > (self.last_ssh_connection_check + 5):
-                self.last_ssh_connection_check = now
-                conn_check_thread = threading.Thread(target=self.run_connection_check)
-                conn_check_thread.start()
+        while True:
+            self.process_messages(PARENT_CHECK_INTERVAL_SEC)
+            self.exit_if_parent_exited()
 
-            self.process_messages()
-            time.sleep(0.001)
+    def run_connection_monitor(self):
+        while True:
+            time.sleep(CONNECTION_CHECK_INTERVAL_SEC)
+            self.run_connection_check()
 
     def run_connection_check(self):
         was_connected = self.connected
@@ -136,15 +147,8 @@ class NeuroprobeDeviceProcess:
         else:
             self.emit_device_state({'isConnected': self.connected})
 
-    def exit_if_parent_exists(self):
-        now = time.time()
-
-        if now <= self.last_parent_exit_check_time + 1:
-            return
-
-        self.last_parent_exit_check_time = now
-
-        if self.parent_pid not in psutil.pids():
+    def exit_if_parent_exited(self):
+        if not is_parent_alive(self.parent_pid):
             os.abort()
 
     def emit_device_state(self, state):
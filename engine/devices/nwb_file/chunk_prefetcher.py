@@ -0,0 +1,141 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from devices.nwb_file.nwb_file_reader import NwbFileReader
+
+
+class PreloadedChunk:
+    """Samples in [from_sample, to_sample) of a number of series, held in memory."""
+    def __init__(self, from_sample: int, to_sample: int, samples: Dict[str, np.ndarray]):
+        self.from_sample = from_sample
+        self.to_sample = to_sample
+        self.samples = samples
+
+    def slice(self, from_sample: int, to_sample: int) -> Dict[str, np.ndarray]:
+        from_index = from_sample - self.from_sample
+        to_index = to_sample - self.from_sample
+        return {name: samples[from_index:to_index] for name, samples in self.samples.items()}
+
+
+class ChunkPrefetcher:
+    """
+    Double-buffered preloading of the samples of an NWB recording.
+
+    While the samples are read from the current chunk, the next chunk is already being
+    read from the file (and decompressed) on a background thread. When the reads move
+    past the end of the current chunk, the next chunk is swapped in and the one after
+    it starts loading. The engine thread only has to wait for the file if the playback
+    gets ahead of the background thread.
+
+    Only the series in `series_names` are read. When series are added, their samples
+    for the current chunk are read right away; the rest are read with the next chunks.
+    """
+    def __init__(self, reader: NwbFileReader, series_names: List[str], chunk_size: int):
+        self.reader = reader
+        self.series_names = series_names
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nwb-prefetch')
+
+        self.current_chunk = PreloadedChunk(0, 0, {})
+        self.next_chunk: Optional[Future] = None
+        self.next_chunk_from = 0
+
+    def set_series_names(self, series_names: List[str]):
+        self.series_names = list(series_names)
+        self.current_chunk = self.complete_chunk(self.current_chunk)
+
+    def set_chunk_size(self, chunk_size: int):
+        # Takes effect with the next prefetched chunk.
+        self.chunk_size = chunk_size
+
+    def load(self, from_sample: int, to_sample: int):
+        """Synchronously load the chunk [from_sample, to_sample) and start prefetching the one after it."""
+        self.cancel_prefetch()
+        self.current_chunk = self.read_chunk(from_sample, to_sample)
+        self.start_prefetch()
+
+    def read(self, from_sample: int, to_sample: int) -> Dict[str, np.ndarray]:
+        """Get the samples in [from_sample, to_sample), moving on to the next chunks as needed."""
+        if to_sample <= from_sample:
+            return self.current_chunk.slice(from_sample, from_sample)
+
+        parts = []
+
+        while True:
+            chunk = self.current_chunk
+
+            if from_sample < chunk.to_sample:
+                part_to = min(to_sample, chunk.to_sample)
+                parts.append(chunk.slice(from_sample, part_to))
+                from_sample = part_to
+
+            if from_sample >= to_sample:
+                break
+
+            self.swap_in_next_chunk()
+
+        if len(parts) == 1:
+            return parts[0]
+
+        return {name: np.concatenate([part[name] for part in parts]) for name in self.series_names}
+
+    def close(self):
+        self.cancel_prefetch()
+        self.executor.shutdown(wait=True)
+
+    def swap_in_next_chunk(self):
+        chunk_from = self.current_chunk.to_sample
+
+        if self.next_chunk is not None and self.next_chunk_from == chunk_from:
+            # This only blocks if the background read hasn't finished yet.
+            next_chunk = self.complete_chunk(self.next_chunk.result())
+        else:
+            next_chunk = self.read_chunk(chunk_from, chunk_from + self.chunk_size)
+
+        self.current_chunk = next_chunk
+        self.next_chunk = None
+        self.start_prefetch()
+
+    def start_prefetch(self):
+        prefetch_from = self.current_chunk.to_sample
+        prefetch_to = prefetch_from + self.chunk_size
+
+        if prefetch_from >= self.reader.num_samples:
+            return
+
+        self.next_chunk_from = prefetch_from
+        self.next_chunk = self.executor.submit(self.read_chunk, prefetch_from, prefetch_to, self.series_names)
+
+    def cancel_prefetch(self):
+        if self.next_chunk is None:
+            return
+
+        # A read that has already started can't be interrupted, so wait for it to
+        # finish before anything else touches the file.
+        if not self.next_chunk.cancel():
+            try:
+                self.next_chunk.result()
+            except Exception:
+                pass
+
+        self.next_chunk = None
+
+    def read_chunk(self, from_sample: int, to_sample: int, series_names: List[str] = None) -> PreloadedChunk:
+        if series_names is None:
+            series_names = self.series_names
+
+        to_sample = min(to_sample, self.reader.num_samples)
+        samples = self.reader.read(series_names, from_sample, to_sample)
+        return PreloadedChunk(from_sample, to_sample, samples)
+
+    def complete_chunk(self, chunk: PreloadedChunk) -> PreloadedChunk:
+        """Make sure that the chunk has exactly the current series, in case they changed after it was read."""
+        missing_names = [name for name in self.series_names if name not in chunk.samples]
+        samples = {name: chunk.samples[name] for name in self.series_names if name in chunk.samples}
+
+        if len(missing_names) > 0:
+            samples.update(self.reader.read(missing_names, chunk.from_sample, chunk.to_sample))
+
+        return PreloadedChunk(chunk.from_sample, chunk.to_sample, samples)
@@ -1,15 +1,44 @@
-import json
 import time
-from typing import Dict
+from typing import Dict, List, Optional, Set, Union
 
 import numpy as np
-from pynwb import NWBHDF5IO
 
 from devices.device import Device
-from util import electrode_name
+from devices.nwb_file.chunk_prefetcher import ChunkPrefetcher
+from devices.nwb_file.nwb_file_reader import NwbFileReader
+from devices.nwb_file.segmented_nwb_file_reader import SegmentedNwbFileReader, open_recording
+from devices.nwb_file.overview_index import OverviewIndex, OverviewIndexBuilder, summarize
 
 DEVICE_NAME = 'NWB file'
 
+# The recording is preloaded into memory in chunks of this many seconds of playback.
+# At faster playback rates, the chunks cover proportionally more of the recording,
+# up to MAX_PRELOAD_CHUNK_SEC.
+PRELOAD_CHUNK_SEC = 20
+MAX_PRELOAD_CHUNK_SEC = 120
+
+MIN_PLAYBACK_RATE = 0.1
+MAX_PLAYBACK_RATE = 20
+
+# Special playback rate: replay the recording as fast as the engine can process it.
+PLAYBACK_RATE_FASTEST = 'max'
+
+# Never emit more than this many seconds of the recording in a single engine step.
+# If the engine can't keep up with the playback rate, the playback slows down instead
+# of flooding the pipelines with ever-larger steps.
+MAX_EMIT_SEC_PER_STEP = 1
+
+# After seeking, this much of the recording before the seek point is emitted to fill up
+# the charts. The charts draw their history from these samples, with or without the
+# overview index.
+SEEK_PREROLL_SEC = 30
+
+DEFAULT_OVERVIEW_POINTS = 2000
+
+# Overviews of ranges that are too short for the overview index are calculated from the
+# raw samples. This limits how much we'll read for that (number of samples x series).
+MAX_RAW_OVERVIEW_VALUES = 20_000_000
+
 
 DEFAULT_DEVICE_PROPS = {
     'name': DEVICE_NAME,
@@ -26,6 +55,18 @@ DEFAULT_DEVICE_PROPS = {
 }
 
 
+def make_device_props(stored_props: Dict) -> Dict:
+    """Make the device properties from the ones that NwbFileWriter stored in the NWB file."""
+    device_props = dict(DEFAULT_DEVICE_PROPS)
+    device_props['canSampleDC'] = stored_props['canSampleDC']
+    device_props['numElectrodes'] = stored_props['numElectrodes']
+    device_props['numElectrodeRows'] = stored_props['numElectrodeRows']
+    device_props['electrodeMap'] = stored_props['electrodeMap']
+    device_props['electrodeExists'] = stored_props['electrodeExists']
+    device_props['electrodeNames'] = stored_props['electrodeNames']
+    return device_props
+
+
 class NwbFileDevice(Device):
     name = DEVICE_NAME
 
@@ -35,17 +76,23 @@ class NwbFileDevice(Device):
         self.replay_length_sec = 0
         self.device_state_messages = []
         self.file_path = ""
+        self.reader: Optional[Union[NwbFileReader, SegmentedNwbFileReader]] = None
+        self.prefetcher: Optional[ChunkPrefetcher] = None
+        self.overview_index: Optional[OverviewIndex] = None
+        self.overview_builder: Optional[OverviewIndexBuilder] = None
+
+        # Only the series that pipelines read from are loaded from the file.
+        self.subscribed_series: Set[str] = set()
 
         self.samples_per_sec = 0
         self.num_samples = 0
         self.emitted_to_sample = 0
-        self.preloaded_from = 0
-        self.preloaded_to = 0
-        self.preloaded_samples = {}
         self.preload_chunk_size = 0
         self.started_at_time = 0
         self.started_at_sample = 0
         self.is_playing = False
+        self.playback_rate = 1.0
+        self.plays_fastest = False
 
         self.emit_extra_samples = {}
         self.emit_was_reset = False
@@ -63,6 +110,7 @@ class NwbFileDevice(Device):
 
             'replayLengthSamples': None,
             'replayPositionSample': None,
+            'playbackRate': self.playback_rate,
             'error': None,
             'deviceProps': DEFAULT_DEVICE_PROPS
         }
@@ -85,7 +133,15 @@ class NwbFileDevice(Device):
         if 'seekTo' in msg:
             self.seek_to(msg['seekTo'])
 
+        if 'setPlaybackRate' in msg:
+            self.set_playback_rate(msg['setPlaybackRate'])
+
+        if 'getOverview' in msg:
+            self.get_overview(msg['getOverview'])
+
     def collect_updates(self):
+        self.check_overview_builder()
+
         updates = {
             'data': self.collect_data()
         }
@@ -101,7 +157,21 @@ class NwbFileDevice(Device):
         return updates
 
     def close(self):
-        pass
+        if self.overview_builder is not None:
+            self.overview_builder.stop()
+            self.overview_builder = None
+
+        if self.overview_index is not None:
+            self.overview_index.close()
+            self.overview_index = None
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
 
     def collect_data(self):
         if len(self.emit_extra_samples) > 0:
@@ -109,13 +179,25 @@ class NwbFileDevice(Device):
             self.emit_extra_samples = {}
             return data
 
-        if not self.is_playing:
+        if not self.is_playing or self.prefetcher is None:
             return {}
 
         state_update = {}
-        elapsed = time.time() - self.started_at_time
+        now = time.time()
         prev_emit_to = self.emitted_to_sample
-        emit_to = int(round(elapsed * self.samples_per_sec)) + self.started_at_sample
+        max_emit_samples = int(round(MAX_EMIT_SEC_PER_STEP * self.samples_per_sec))
+
+        if self.plays_fastest:
+            emit_to = prev_emit_to + max_emit_samples
+        else:
+            elapsed = now - self.started_at_time
+            emit_to = int(round(elapsed * self.samples_per_sec * self.playback_rate)) + self.started_at_sample
+
+            if emit_to - prev_emit_to > max_emit_samples:
+                # The engine is falling behind. Continue from here instead of catching up.
+                emit_to = prev_emit_to + max_emit_samples
+                self.started_at_time = now
+                self.started_at_sample = emit_to
 
         if emit_to >= self.num_samples:
             emit_to = self.num_samples
@@ -124,25 +206,8 @@ class NwbFileDevice(Device):
             self.is_playing = False
             state_update['isSampling'] = False
 
-        emit_from_index = prev_emit_to - self.preloaded_from
-        emit_to_index = emit_to - self.preloaded_from
-
-        if emit_to_index > (self.preloaded_to - self.preloaded_from):
-            self.preload_next_chunk()
-
-            # The line above may have changed self.preloaded_from and self.preloaded_to,
-            # so we'll need to recalculate these.
-            emit_from_index = prev_emit_to - self.preloaded_from
-            emit_to_index = emit_to - self.preloaded_from
-
-        data = {}
-        for i in range(self.num_loaded_electrodes):
-            ac_series_name = electrode_name(i, 'ac')
-            data[ac_series_name] = self.preloaded_samples[ac_series_name][emit_from_index:emit_to_index]
-
-            if self.can_sample_dc:
-                dc_series_name = electrode_name(i, 'dc')
-                data[dc_series_name] = self.preloaded_samples[dc_series_name][emit_from_index:emit_to_index]
+        # The next chunk is prefetched in the background, so this normally doesn't touch the file.
+        data = self.prefetcher.read(prev_emit_to, emit_to)
 
         self.emitted_to_sample = emit_to
         state_update['replayPositionSample'] = self.emitted_to_sample
@@ -154,92 +219,53 @@ class NwbFileDevice(Device):
 
     def open_file(self, file_path):
         self.file_path = file_path
+        self.close()
 
         try:
-            with NWBHDF5IO(file_path, 'r') as nwb_io:
-                nwb_file = nwb_io.read()
-
-                # Load the electrode configuration
-                # FIXME: try and catch cases when NWB format is not supporred by this application.
-                notes = nwb_file.notes
-                stored_props = json.loads(notes)
-                device_props = dict(DEFAULT_DEVICE_PROPS)
-                device_props['canSampleDC'] = stored_props['canSampleDC']
-                device_props['numElectrodes'] = stored_props['numElectrodes']
-                device_props['numElectrodeRows'] = stored_props['numElectrodeRows']
-                device_props['electrodeMap'] = stored_props['electrodeMap']
-                device_props['electrodeExists'] = stored_props['electrodeExists']
-                device_props['electrodeNames'] = stored_props['electrodeNames']
-
-                self.num_loaded_electrodes = device_props['numElectrodes']
-                self.can_sample_dc = device_props['canSampleDC']
-                self.device_props = device_props
-
-                # Load the time series details
-                first_electrode = nwb_file.acquisition[electrode_name(0, 'ac')]
-                self.samples_per_sec = first_electrode.rate
-                self.num_samples = len(first_electrode.data)
-
-                self.emitted_to_sample = 0
-                self.preloaded_samples = {}
-                self.preloaded_from = 0
-                self.started_at_sample = 0
-                self.emit_was_reset = True
-
-                # Preload data into memory in 20-second chunks.
-                self.preload_chunk_size = int(round(20 * self.samples_per_sec))
-
-                num_to_preload = min(self.num_samples, self.preload_chunk_size)
-                self.preloaded_to = num_to_preload
-
-                # Preload some samples.
-                # While at it, validate that all the time series have the same metadata
-                for i in range(self.num_loaded_electrodes):
-                    ac_time_series = nwb_file.acquisition[electrode_name(i, 'ac')]
-
-                    # The number of samples in individual time series may vary slightly
-                    # because of the differences in timing when this studio has received the
-                    # UDP packets.
-                    num_ac_samples = len(ac_time_series.data)
-
-                    if self.num_samples > num_ac_samples:
-                        self.num_samples = num_ac_samples
-
-                    if ac_time_series.rate != self.samples_per_sec:
-                        raise Exception('Not all electrodes have the same sampling rate')
-
-                    self.preloaded_samples[electrode_name(i, 'ac')] = ac_time_series.data[:num_to_preload]
-
-                    if self.can_sample_dc:
-                        dc_time_series = nwb_file.acquisition[electrode_name(i, 'dc')]
-                        num_dc_samples = len(dc_time_series.data)
-
-                        if self.num_samples > num_dc_samples:
-                            self.num_samples = num_dc_samples
-
-                        if dc_time_series.rate != self.samples_per_sec:
-                            raise Exception('Not all electrodes have the same sampling rate')
-
-                        self.preloaded_samples[electrode_name(i, 'dc')] = dc_time_series.data[:num_to_preload]
-
-                # Signal success to the UI.
-                state_update = {
-                    'isConnected': True,
-                    'initState': 'INITIALIZED',
-                    'isSampling': False,
-                    'samplesPerSec': self.samples_per_sec,
-                    'replayLengthSamples': self.num_samples,
-                    'replayPositionSample': 0,
-                    'error': None,
-                    'deviceProps': self.device_props
-                }
-
-                self.emit_device_state(state_update)
+            self.reader = open_recording(file_path)
+
+            # Load the electrode configuration
+            device_props = make_device_props(self.reader.stored_props)
+
+            self.num_loaded_electrodes = device_props['numElectrodes']
+            self.can_sample_dc = device_props['canSampleDC']
+            self.device_props = device_props
+
+            # Load the time series details
+            self.samples_per_sec = self.reader.samples_per_sec
+            self.num_samples = self.reader.num_samples
+
+            self.emitted_to_sample = 0
+            self.started_at_sample = 0
+            self.emit_was_reset = True
+
+            # Preload data into memory in chunks.
+            self.update_preload_chunk_size()
+            self.prefetcher = ChunkPrefetcher(self.reader,
+                                              self.active_series_names(),
+                                              self.preload_chunk_size)
+            self.prefetcher.load(0, self.preload_chunk_size)
+
+            # Signal success to the UI.
+            state_update = {
+                'isConnected': True,
+                'initState': 'INITIALIZED',
+                'isSampling': False,
+                'samplesPerSec': self.samples_per_sec,
+                'replayLengthSamples': self.num_samples,
+                'replayPositionSample': 0,
+                'hasOverview': False,
+                'error': None,
+                'deviceProps': self.device_props
+            }
+
+            self.emit_device_state(state_update)
+            self.load_overview_index()
         except:
+            self.close()
             self.samples_per_sec = 0
             self.num_samples = 0
             self.emitted_to_sample = 0
-            self.preloaded_to = 0
 
             state_update = {
                 'isConnected': False,
@@ -259,14 +285,45 @@ class NwbFileDevice(Device):
         self.started_at_sample = self.emitted_to_sample
         self.emit_device_state({'isSampling': True})
 
+    def set_playback_rate(self, playback_rate):
+        if playback_rate == PLAYBACK_RATE_FASTEST:
+            self.plays_fastest = True
+        else:
+            self.plays_fastest = False
+            self.playback_rate = min(max(float(playback_rate), MIN_PLAYBACK_RATE), MAX_PLAYBACK_RATE)
+
+        # Continue from the current position at the new rate.
+        self.started_at_time = time.time()
+        self.started_at_sample = self.emitted_to_sample
+        self.update_preload_chunk_size()
+
+        self.emit_device_state({
+            'playbackRate': PLAYBACK_RATE_FASTEST if self.plays_fastest else self.playback_rate
+        })
+
+    def update_preload_chunk_size(self):
+        # Faster playback needs larger reads from the file; otherwise we'd be
+        # preloading the next chunk every few engine steps.
+        if self.plays_fastest:
+            chunk_sec = MAX_PRELOAD_CHUNK_SEC
+        else:
+            chunk_sec = min(PRELOAD_CHUNK_SEC * max(1.0, self.playback_rate), MAX_PRELOAD_CHUNK_SEC)
+
+        self.preload_chunk_size = int(round(chunk_sec * self.samples_per_sec))
+
+        if self.prefetcher is not None:
+            self.prefetcher.set_chunk_size(self.preload_chunk_size)
+
     def pause_playing(self):
         self.is_playing = False
         self.emit_device_state({'isSampling': False})
 
     def seek_to(self, seek_to_sample):
-        # We will immediately emmit 30 sec worth of samples
-        # immediately before the seek point in order to fill up
-        # the charts.
+        # We will immediately emmit some samples immediately
+        # before the seek point in order to fill up the charts.
+        if self.prefetcher is None:
+            return
+
         state_update = {}
 
         if self.is_playing:
@@ -276,21 +333,14 @@ class NwbFileDevice(Device):
         seek_to_sample = min(seek_to_sample, self.num_samples)
         self.emit_was_reset = True
 
-        desired_extra_samples = int(round(30 * self.samples_per_sec))
-        extra_samples_from = max(0, seek_to_sample - desired_extra_samples)
-        self.preload_chunk_for_seeking(extra_samples_from, seek_to_sample)
-
-        if seek_to_sample != 0:
-            for i in range(self.num_loaded_electrodes):
-                ac_series_name = electrode_name(i, 'ac')
-                dc_series_name = electrode_name(i, 'dc')
-
-                emit_to = seek_to_sample - extra_samples_from
+        extra_samples_from = max(0, seek_to_sample - self.preroll_samples())
 
-                self.emit_extra_samples[ac_series_name] = self.preloaded_samples[ac_series_name][:emit_to]
+        # Only the pre-roll has to be read right away. The samples after the seek point
+        # are prefetched in the background.
+        self.prefetcher.load(extra_samples_from, seek_to_sample)
 
-                if self.can_sample_dc:
-                    self.emit_extra_samples[dc_series_name] = self.preloaded_samples[dc_series_name][:emit_to]
+        if seek_to_sample != 0:
+            self.emit_extra_samples = self.prefetcher.read(extra_samples_from, seek_to_sample)
 
         # Store and emit the current spot in the recording.
         self.emitted_to_sample = seek_to_sample
@@ -298,64 +348,117 @@ class NwbFileDevice(Device):
 
         self.emit_device_state(state_update)
 
+    def set_subscribed_series(self, series_names: Set[str]):
+        self.subscribed_series = set(series_names)
+
+        if self.prefetcher is None:
+            return
+
+        prev_names = set(self.prefetcher.series_names)
+        active_names = self.active_series_names()
+        self.prefetcher.set_series_names(active_names)
+
+        # Fill up the charts of the newly subscribed series, the same way as after seeking.
+        new_names = [name for name in active_names if name not in prev_names]
+        history_from = max(0, self.emitted_to_sample - self.preroll_samples())
+
+        if len(new_names) > 0 and history_from < self.emitted_to_sample:
+            self.emit_extra_samples.update(self.reader.read(new_names, history_from, self.emitted_to_sample))
+
+    def active_series_names(self) -> List[str]:
+        return [name for name in self.reader.electrode_series_names() if name in self.subscribed_series]
+
+    def preroll_samples(self) -> int:
+        return int(round(SEEK_PREROLL_SEC * self.samples_per_sec))
+
+    def load_overview_index(self):
+        if OverviewIndex.is_up_to_date(self.file_path):
+            self.overview_index = OverviewIndex(self.file_path)
+            self.emit_device_state({'hasOverview': True})
+        else:
+            # This may take a while for long recordings, so do it in the background.
+            self.overview_builder = OverviewIndexBuilder(self.file_path)
+            self.overview_builder.start()
+
+    def check_overview_builder(self):
+        if self.overview_builder is None or not self.overview_builder.is_done():
+            return
+
+        if self.overview_builder.succeeded:
+            self.overview_index = OverviewIndex(self.file_path)
+            self.emit_device_state({'hasOverview': True})
+
+        self.overview_builder = None
+
+    def get_overview(self, request: Dict):
+        """
+        Send the min/max/RMS summary of a range of the recording at screen resolution.
+        The request may contain 'fromSample', 'toSample', 'numPoints', and 'seriesNames'.
+        """
+        if self.reader is None:
+            return
+
+        from_sample = max(0, int(request.get('fromSample', 0)))
+        to_sample = min(int(request.get('toSample', self.num_samples)), self.num_samples)
+        num_points = max(1, int(request.get('numPoints', DEFAULT_OVERVIEW_POINTS)))
+        series_names = request.get('seriesNames', self.reader.electrode_series_names())
+
+        if to_sample <= from_sample:
+            return
+
+        overview = None
+
+        if self.overview_index is not None:
+            try:
+                overview = self.overview_index.get_overview(series_names, from_sample, to_sample, num_points)
+            except Exception as e:
+                self.emit_device_state({'overview': {
+                    'fromSample': from_sample,
+                    'toSample': to_sample,
+                    'error': str(e)
+                }})
+                return
+
+        if overview is None:
+            if (to_sample - from_sample) * len(series_names) > MAX_RAW_OVERVIEW_VALUES:
+                self.emit_device_state({'overview': {
+                    'fromSample': from_sample,
+                    'toSample': to_sample,
+                    'error': 'The overview of this recording is not ready yet'
+                }})
+                return
+
+            overview = self.summarize_raw_samples(series_names, from_sample, to_sample, num_points)
+
+        self.emit_device_state({'overview': {
+            'fromSample': overview['fromSample'],
+            'toSample': overview['toSample'],
+            'series': {
+                name: {
+                    'min': overview['min'][:, i].tolist(),
+                    'max': overview['max'][:, i].tolist(),
+                    'rms': overview['rms'][:, i].tolist(),
+                } for i, name in enumerate(series_names)
+            }
+        }})
+
+    def summarize_raw_samples(self, series_names, from_sample: int, to_sample: int, num_points: int) -> Dict:
+        chunk = self.reader.read(series_names, from_sample, to_sample)
+        samples = np.stack([chunk[name] for name in series_names], axis=1)
+        boundaries = np.unique(np.linspace(0, to_sample - from_sample, num_points, endpoint=False).astype(int))
+        mins, maxes, mean_squares = summarize(samples, boundaries)
+
+        return {
+            'min': mins,
+            'max': maxes,
+            'rms': np.sqrt(mean_squares),
+            'fromSample': from_sample,
+            'toSample': to_sample,
+        }
+
     def emit_device_state(self, device_state_msg):
         self.device_state_messages.append(device_state_msg)
 
-    def preload_next_chunk(self):
-        num_remaining = self.num_samples - self.preloaded_to
-        num_to_preload = min(num_remaining, self.preload_chunk_size)
-        preload_to = self.preloaded_to + num_to_preload
-        preload_from = self.preloaded_to
-
-        unload_to_index = self.emitted_to_sample - self.preloaded_from
-
-        with NWBHDF5IO(self.file_path, 'r') as nwb_io:
-            nwb_file = nwb_io.read()
-
-            for i in range(self.num_loaded_electrodes):
-                ac_series_name = electrode_name(i, 'ac')
-                ac_preloaded_samples = self.preloaded_samples[ac_series_name]
-                ac_preloaded_samples = ac_preloaded_samples[unload_to_index:]
-                ac_nwb_series = nwb_file.acquisition[ac_series_name]
-                ac_preloaded_samples = np.concatenate((ac_preloaded_samples,
-                                                       ac_nwb_series.data[preload_from:preload_to]))
-                self.preloaded_samples[ac_series_name] = ac_preloaded_samples
-
-                if self.can_sample_dc:
-                    dc_series_name = electrode_name(i, 'dc')
-                    dc_preloaded_samples = self.preloaded_samples[dc_series_name]
-                    dc_preloaded_samples = dc_preloaded_samples[unload_to_index:]
-                    dc_nwb_series = nwb_file.acquisition[dc_series_name]
-
-                    dc_preloaded_samples = np.concatenate((dc_preloaded_samples,
-                                                           dc_nwb_series.data[preload_from:preload_to]))
-
-                    self.preloaded_samples[dc_series_name] = dc_preloaded_samples
-
-        self.preloaded_from = self.emitted_to_sample
-        self.preloaded_to = preload_to
-
-    def preload_chunk_for_seeking(self, preload_from, seek_to):
-        num_remaining = self.num_samples - seek_to
-        num_to_preload = min(num_remaining, self.preload_chunk_size)
-        preload_to = seek_to + num_to_preload
-
-        with NWBHDF5IO(self.file_path, 'r') as nwb_io:
-            nwb_file = nwb_io.read()
-
-            for i in range(self.num_loaded_electrodes):
-                ac_series_name = electrode_name(i, 'ac')
-                ac_nwb_series = nwb_file.acquisition[ac_series_name]
-                self.preloaded_samples[ac_series_name] = ac_nwb_series.data[preload_from:preload_to]
-
-                if self.can_sample_dc:
-                    dc_series_name = electrode_name(i, 'dc')
-                    dc_nwb_series = nwb_file.acquisition[dc_series_name]
-                    self.preloaded_samples[dc_series_name] = dc_nwb_series.data[preload_from:preload_to]
-
-        self.preloaded_from = preload_from
-        self.preloaded_to = preload_to
-
     def get_properties(self) -> Dict:
         return self.device_props
 
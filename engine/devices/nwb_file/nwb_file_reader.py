@@ -0,0 +1,129 @@
+import json
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from sources_and_sinks.nwb_file_writer import matrix_series_name
+from util import electrode_name
+
+
+class NwbFileReader:
+    """
+    Keeps an NWB recording made by `NwbFileWriter` open for reading.
+
+    The NWB object graph is parsed only once, when the file is opened. After that,
+    the samples are read as slices straight from the HDF5 datasets of the time series.
+    Both the per-electrode and the matrix layout of `NwbFileWriter` are supported, and
+    samples stored as integer ADC codes are rescaled to volts as they're read.
+    """
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.nwb_io = NWBHDF5IO(file_path, 'r')
+
+        try:
+            nwb_file = self.nwb_io.read()
+
+            # NwbFileWriter stores the properties of the recording device in the notes.
+            # FIXME: try and catch cases when NWB format is not supporred by this application.
+            self.stored_props: Dict = json.loads(nwb_file.notes)
+            self.num_electrodes: int = self.stored_props['numElectrodes']
+            self.can_sample_dc: bool = self.stored_props['canSampleDC']
+
+            # Where to find each electrode series: the dataset, and the column
+            # of the dataset in the matrix layout (or None).
+            self.series_columns: Dict[str, Tuple[object, Optional[int]]] = dict()
+
+            # The conversion and offset of the datasets with integer samples, by dataset id.
+            self.rescaling: Dict[int, Tuple[float, float]] = dict()
+            self.samples_per_sec = None
+            self.num_samples = None
+
+            # In the matrix layout, reading any electrode reads the time range of all of them.
+            self.is_matrix_layout: bool = matrix_series_name('ac') in nwb_file.acquisition
+
+            if self.is_matrix_layout:
+                stored_series = []
+
+                for kind in (['ac', 'dc'] if self.can_sample_dc else ['ac']):
+                    time_series = nwb_file.acquisition[matrix_series_name(kind)]
+                    stored_series.append(time_series)
+
+                    for i in range(self.num_electrodes):
+                        self.series_columns[electrode_name(i, kind)] = (time_series.data, i)
+            else:
+                stored_series = [nwb_file.acquisition[name] for name in self.electrode_series_names()]
+
+                for time_series in stored_series:
+                    self.series_columns[time_series.name] = (time_series.data, None)
+
+            # While at it, validate that all the time series have the same metadata.
+            for time_series in stored_series:
+                if time_series.data.dtype.kind in 'iu':
+                    offset = float(time_series.data.attrs.get('offset', 0.))
+                    self.rescaling[id(time_series.data)] = (time_series.conversion, offset)
+
+                if self.samples_per_sec is None:
+                    self.samples_per_sec = time_series.rate
+                elif time_series.rate != self.samples_per_sec:
+                    raise Exception('Not all electrodes have the same sampling rate')
+
+                # The number of samples in individual time series may vary slightly
+                # because of the differences in timing when this studio has received the
+                # UDP packets. Only the samples that all the series have are replayed.
+                num_series_samples = len(time_series.data)
+
+                if self.num_samples is None or num_series_samples < self.num_samples:
+                    self.num_samples = num_series_samples
+
+            if self.num_samples is None:
+                self.num_samples = 0
+
+        except:
+            self.nwb_io.close()
+            raise
+
+    def electrode_series_names(self) -> List[str]:
+        names = []
+
+        for i in range(self.num_electrodes):
+            names.append(electrode_name(i, 'ac'))
+
+            if self.can_sample_dc:
+                names.append(electrode_name(i, 'dc'))
+
+        return names
+
+    def read(self, series_names: Iterable[str], from_sample: int, to_sample: int) -> Dict[str, np.ndarray]:
+        """Read the samples in [from_sample, to_sample) of each of the given series."""
+        samples = dict()
+        matrix_blocks = dict()
+
+        for name in series_names:
+            dataset, column = self.series_columns[name]
+
+            if column is None:
+                samples[name] = self.rescale(dataset, dataset[from_sample:to_sample])
+                continue
+
+            # Read the time range of all the electrodes at once; reading the
+            # columns one by one would decompress the same chunks over and over.
+            if id(dataset) not in matrix_blocks:
+                matrix_blocks[id(dataset)] = self.rescale(dataset, dataset[from_sample:to_sample])
+
+            samples[name] = np.ascontiguousarray(matrix_blocks[id(dataset)][:, column])
+
+        return samples
+
+    def rescale(self, dataset, samples: np.ndarray) -> np.ndarray:
+        if id(dataset) not in self.rescaling:
+            return samples
+
+        conversion, offset = self.rescaling[id(dataset)]
+        volts = samples.astype('f4')
+        volts *= conversion
+        volts += offset
+        return volts
+
+    def close(self):
+        self.nwb_io.close()
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+import h5py
+import numpy as np
+
+from devices.nwb_file.nwb_file_reader import NwbFileReader
+from devices.nwb_file.segmented_nwb_file_reader import open_recording
+from sources_and_sinks.nwb_file_writer import is_segment_manifest
+
+OVERVIEW_FILE_SUFFIX = '.overview.h5'
+OVERVIEW_FORMAT_VERSION = 2
+
+# Number of samples summarized by one bin at each level of the overview. Views that
+# need finer detail than the first level are summarized from the raw samples instead;
+# they're short enough for that to be fast.
+OVERVIEW_LEVELS = [1024, 8192, 65536]
+
+# The index is built from chunks of this many samples. Must be a multiple of all the levels.
+BUILD_CHUNK_SAMPLES = 4 * OVERVIEW_LEVELS[-1]
+
+
+def overview_file_path(recording_path: str) -> str:
+    return recording_path + OVERVIEW_FILE_SUFFIX
+
+
+def recording_file_stats(recording_path: str) -> List[List]:
+    """
+    The [path, size, modification time] of each file of a recording: the recording itself,
+    and for a rotated recording, each of the segments its manifest lists.
+    """
+    paths = [recording_path]
+
+    if is_segment_manifest(recording_path):
+        with open(recording_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        directory = os.path.dirname(recording_path)
+        paths += [os.path.join(directory, segment['file']) for segment in manifest['segments']]
+
+    stats = []
+    for path in paths:
+        # The last segment may not have been created yet.
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            stats.append([os.path.basename(path), stat.st_size, stat.st_mtime])
+
+    return stats
+
+
+def summarize(samples: np.ndarray, boundaries: np.ndarray):
+    """
+    Calculate the min, max and mean square of `samples` (with samples along the first axis)
+    between each pair of consecutive `boundaries`. The last group runs to the end of `samples`.
+    """
+    mins = np.minimum.reduceat(samples, boundaries, axis=0)
+    maxes = np.maximum.reduceat(samples, boundaries, axis=0)
+    squares = np.square(samples, dtype='f8')
+    counts = np.diff(np.append(boundaries, len(samples)))
+    mean_squares = np.add.reduceat(squares, boundaries, axis=0) / counts.reshape((-1,) + (1,) * (samples.ndim - 1))
+    return mins, maxes, mean_squares
+
+
+class OverviewIndex:
+    """
+    Per-series min/max/RMS summaries of a whole recording at several decimation levels,
+    cached in a sidecar HDF5 file next to the recording.
+    """
+    def __init__(self, recording_path: str):
+        self.file = h5py.File(overview_file_path(recording_path), 'r')
+        self.num_samples: int = int(self.file.attrs['numSamples'])
+        self.series_names: List[str] = json.loads(self.file.attrs['seriesNames'])
+        self.series_columns = {name: i for i, name in enumerate(self.series_names)}
+        self.levels: List[int] = [int(level) for level in self.file.attrs['levels']]
+
+    @staticmethod
+    def is_up_to_date(recording_path: str) -> bool:
+        """Check that the sidecar file exists and that it was built from the current version of the recording."""
+        index_path = overview_file_path(recording_path)
+
+        if not os.path.isfile(index_path):
+            return False
+
+        try:
+            with h5py.File(index_path, 'r') as index_file:
+                return index_file.attrs['version'] == OVERVIEW_FORMAT_VERSION and \
+                    json.loads(index_file.attrs['recordingFiles']) == recording_file_stats(recording_path)
+        except Exception:
+            return False
+
+    def get_overview(self,
+                     series_names: List[str],
+                     from_sample: int,
+                     to_sample: int,
+                     num_points: int) -> Optional[Dict[str, np.ndarray]]:
+        """
+        Summarize the samples in [from_sample, to_sample) in about `num_points` points.
+        Returns None if the range is too short for the coarsest detail the index has.
+        """
+        samples_per_point = (to_sample - from_sample) / num_points
+
+        # Use the coarsest level that still has at least one bin per point.
+        level_num = None
+        for i, level in enumerate(self.levels):
+            if level <= samples_per_point:
+                level_num = i
+
+        if level_num is None:
+            return None
+
+        bin_size = self.levels[level_num]
+        level_group = self.file[f'level{level_num}']
+        from_bin = from_sample // bin_size
+        to_bin = min(-(-to_sample // bin_size), level_group['min'].shape[0])
+
+        unknown_names = [name for name in series_names if name not in self.series_columns]
+        if len(unknown_names) > 0:
+            raise Exception(f'The overview index has no series {", ".join(unknown_names)}')
+
+        columns = [self.series_columns[name] for name in series_names]
+        mins = level_group['min'][from_bin:to_bin][:, columns]
+        maxes = level_group['max'][from_bin:to_bin][:, columns]
+        mean_squares = np.square(level_group['rms'][from_bin:to_bin][:, columns], dtype='f8')
+
+        # All bins have the same size, except maybe the last bin of the recording.
+        counts = np.full(to_bin - from_bin, bin_size, dtype='f8')
+        if to_bin * bin_size > self.num_samples:
+            counts[-1] = self.num_samples - (to_bin - 1) * bin_size
+
+        # Merge the bins into the requested number of points.
+        num_bins = to_bin - from_bin
+        boundaries = np.unique(np.linspace(0, num_bins, num_points, endpoint=False).astype(int))
+        point_counts = np.add.reduceat(counts, boundaries)
+
+        return {
+            'min': np.minimum.reduceat(mins, boundaries, axis=0),
+            'max': np.maximum.reduceat(maxes, boundaries, axis=0),
+            'rms': np.sqrt(np.add.reduceat(mean_squares * counts[:, np.newaxis], boundaries, axis=0) /
+                           point_counts[:, np.newaxis]),
+            'fromSample': from_bin * bin_size,
+            'toSample': min(to_bin * bin_size, self.num_samples),
+        }
+
+    def close(self):
+        self.file.close()
+
+
+class OverviewIndexBuilder:
+    """Builds the overview index of a recording on a background thread."""
+    def __init__(self, recording_path: str):
+        self.recording_path = recording_path
+        self.stop_requested = threading.Event()
+        self.succeeded = False
+        self.log = logging.getLogger(__name__)
+        self.thread = threading.Thread(target=self.run, name='nwb-overview-index', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def is_done(self) -> bool:
+        return not self.thread.is_alive()
+
+    def stop(self):
+        self.stop_requested.set()
+        self.thread.join()
+
+    def run(self):
+        index_path = overview_file_path(self.recording_path)
+
+        # Write to a temporary file first, so that a half-built index is never used.
+        temp_path = index_path + '.tmp'
+
+        try:
+            recording_files = recording_file_stats(self.recording_path)
+
+            # Use a separate reader, so that the building doesn't get in the way of
+            # the playback's prefetching.
+            reader = open_recording(self.recording_path)
+
+            try:
+                self.build(reader, temp_path)
+            finally:
+                reader.close()
+
+            if self.stop_requested.is_set():
+                os.remove(temp_path)
+                return
+
+            with h5py.File(temp_path, 'a') as index_file:
+                index_file.attrs['recordingFiles'] = json.dumps(recording_files)
+
+            os.replace(temp_path, index_path)
+            self.succeeded = True
+
+        except Exception as e:
+            self.log.warning(f'Could not build the overview index for {self.recording_path}: {e}')
+
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def build(self, reader: NwbFileReader, index_path: str):
+        series_names = reader.electrode_series_names()
+        num_series = len(series_names)
+        num_samples = reader.num_samples
+
+        with h5py.File(index_path, 'w') as index_file:
+            index_file.attrs['version'] = OVERVIEW_FORMAT_VERSION
+            index_file.attrs['numSamples'] = num_samples
+            index_file.attrs['samplesPerSec'] = reader.samples_per_sec
+            index_file.attrs['seriesNames'] = json.dumps(series_names)
+            index_file.attrs['levels'] = OVERVIEW_LEVELS
+
+            # Bins are stored along the first axis, so that a time range of all the series
+            # can be read in one go.
+            datasets = []
+            for level_num, bin_size in enumerate(OVERVIEW_LEVELS):
+                num_bins = -(-num_samples // bin_size)
+                level_group = index_file.create_group(f'level{level_num}')
+                datasets.append({stat: level_group.create_dataset(stat, shape=(num_bins, num_series), dtype='f4')
+                                 for stat in ('min', 'max', 'rms')})
+
+            for chunk_from in range(0, num_samples, BUILD_CHUNK_SAMPLES):
+                if self.stop_requested.is_set():
+                    return
+
+                chunk_to = min(chunk_from + BUILD_CHUNK_SAMPLES, num_samples)
+                chunk = reader.read(series_names, chunk_from, chunk_to)
+                samples = np.stack([chunk[name] for name in series_names], axis=1)
+
+                for level_num, bin_size in enumerate(OVERVIEW_LEVELS):
+                    boundaries = np.arange(0, chunk_to - chunk_from, bin_size)
+                    mins, maxes, mean_squares = summarize(samples, boundaries)
+
+                    from_bin = chunk_from // bin_size
+                    to_bin = from_bin + len(boundaries)
+                    datasets[level_num]['min'][from_bin:to_bin] = mins
+                    datasets[level_num]['max'][from_bin:to_bin] = maxes
+                    datasets[level_num]['rms'][from_bin:to_bin] = np.sqrt(mean_squares)
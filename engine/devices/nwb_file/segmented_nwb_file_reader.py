@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+
+from devices.nwb_file.nwb_file_reader import NwbFileReader
+from sources_and_sinks.nwb_file_writer import is_segment_manifest
+
+
+class SegmentedNwbFileReader:
+    """
+    Reads a recording that `NwbFileWriter` has rotated into several segment files as one
+    timeline. Has the same interface as `NwbFileReader`, with sample numbers counted from
+    the start of the first segment.
+    """
+    def __init__(self, manifest_path: str):
+        self.file_path = manifest_path
+        self.segments: List[NwbFileReader] = []
+        self.segment_starts: List[int] = []
+        log = logging.getLogger(__name__)
+
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        directory = os.path.dirname(manifest_path)
+
+        try:
+            for segment in manifest['segments']:
+                segment_path = os.path.join(directory, segment['file'])
+
+                try:
+                    reader = NwbFileReader(segment_path)
+                except Exception as e:
+                    # The last segment may still be being written, or may have been cut
+                    # short. Replay everything up to it.
+                    if segment['numSamples'] is None:
+                        log.warning(f'Skipping the unfinished segment {segment_path}: {e}')
+                        break
+
+                    raise
+
+                self.segments.append(reader)
+
+            if len(self.segments) == 0:
+                raise Exception(f'{manifest_path} has no readable segments')
+
+            first_segment = self.segments[0]
+            self.stored_props: Dict = first_segment.stored_props
+            self.num_electrodes: int = first_segment.num_electrodes
+            self.can_sample_dc: bool = first_segment.can_sample_dc
+            self.is_matrix_layout: bool = first_segment.is_matrix_layout
+            self.samples_per_sec = first_segment.samples_per_sec
+            self.num_samples = 0
+
+            for reader in self.segments:
+                if reader.samples_per_sec != self.samples_per_sec or reader.num_electrodes != self.num_electrodes:
+                    raise Exception(f'{reader.file_path} does not match the other segments of the recording')
+
+                # The writer ends every segment at a sample that all the electrodes have,
+                # so the segments line up back to back.
+                self.segment_starts.append(self.num_samples)
+                self.num_samples += reader.num_samples
+
+        except:
+            self.close()
+            raise
+
+    def electrode_series_names(self) -> List[str]:
+        return self.segments[0].electrode_series_names()
+
+    def read(self, series_names: Iterable[str], from_sample: int, to_sample: int) -> Dict[str, np.ndarray]:
+        """Read the samples in [from_sample, to_sample) of each of the given series, across segment boundaries."""
+        series_names = list(series_names)
+        blocks = []
+
+        for segment_start, reader in zip(self.segment_starts, self.segments):
+            segment_end = segment_start + reader.num_samples
+
+            if segment_end <= from_sample or segment_start >= to_sample:
+                continue
+
+            blocks.append(reader.read(series_names,
+                                      max(from_sample, segment_start) - segment_start,
+                                      min(to_sample, segment_end) - segment_start))
+
+        if len(blocks) == 0:
+            return self.segments[0].read(series_names, 0, 0)
+
+        if len(blocks) == 1:
+            return blocks[0]
+
+        return {name: np.concatenate([block[name] for block in blocks]) for name in series_names}
+
+    def close(self):
+        for reader in self.segments:
+            reader.close()
+
+
+def open_recording(file_path: str) -> Union[NwbFileReader, SegmentedNwbFileReader]:
+    """Open either a single NWB file or the manifest of a segmented recording."""
+    if is_segment_manifest(file_path):
+        return SegmentedNwbFileReader(file_path)
+
+    return NwbFileReader(file_path)
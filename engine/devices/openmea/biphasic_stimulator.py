@@ -1,22 +1,61 @@
-import math
+import logging
+import time
 from io import BytesIO
-from typing import Dict
+from typing import Dict, List
+
+import numpy as np
 
 from devices.openmea.stimulator import Stimulator
 from devices.openmea.rsh2116 import STIM_STEP_SIZES, \
     rsh2116_write_register, \
     REG_STIM_POLARITY, REG_STIM_ON, COMMAND_READ_CHIP_ID, REG_CHARGE_RECOV_SWITCH, rsh2116_electrode_bit, \
     rsh2116_write_current
+from devices.openmea.wav_stimulator import EMIT_AHEAD_SEC
 
 ELECTRODES_PER_CHIP = 16
 
+# The chips take this many commands per sample period.
+COMMANDS_PER_FRAME = 4
+
+
+def command_word(command: bytes) -> int:
+    return int.from_bytes(command, byteorder='little')
+
+
+COMMAND_READ_CHIP_ID_WORD = command_word(COMMAND_READ_CHIP_ID)
+
+
+def read_chip_id_words(count: int) -> np.ndarray:
+    """`count` commands that don't do anything, for padding and waiting."""
+    return np.full(max(0, count), COMMAND_READ_CHIP_ID_WORD, dtype='<u4')
+
 
 class BiphasicStimulator(Stimulator):
+    """
+    Biphasic pulses on the selected electrodes, optionally as a pulse train: `pulseCount`
+    pulses every `pulseInterval` seconds make a burst, and `burstCount` bursts start every
+    `burstInterval` seconds. The commands of the whole train are generated when stimulation
+    starts, and then sent a bit ahead of time while it runs.
+    """
     def __init__(self, config_json: Dict, stim_step_size_index: int, max_freq: int):
         super().__init__()
+        self.log = logging.getLogger(__name__)
         self.config = config_json
         self.stim_step_size_index = stim_step_size_index
         self.max_freq = max_freq
+        self.emit_ahead_sec = EMIT_AHEAD_SEC
+
+        # The commands of the whole train for each chip that has selected electrodes.
+        self.train: Dict[int, np.ndarray] = {}
+        self.all_electrode_flags: Dict[int, int] = {}
+
+        # Where each pulse of the train starts, and how many commands into a pulse phase 1 starts.
+        self.pulse_starts = np.zeros(0, dtype=int)
+        self.pulse_onset_commands = 0
+        self.commands_emitted = 0
+        self.emit_start_time = 0
+        self.is_done_emitting = True
+        self.stop_requested = False
 
     def pulse_type(self):
         return 'biphasic'
@@ -26,170 +65,206 @@ class BiphasicStimulator(Stimulator):
         self.max_freq = self.config['maxFrequency']
         self.stim_step_size_index = self.config['stimStepSizeIndex']
 
+    def set_emit_ahead(self, emit_ahead_sec: float) -> None:
+        self.emit_ahead_sec = emit_ahead_sec
+
+    def on_stimulation_starting(self) -> None:
+        self.train = self.make_train()
+        self.commands_emitted = 0
+        self.emit_start_time = 0
+        self.is_done_emitting = len(self.train) == 0
+        self.stop_requested = False
+
     def emit_next_commands(self) -> Dict[int, BytesIO]:
-        stim_step_size = STIM_STEP_SIZES[self.stim_step_size_index]
-        main_electrodes = self.config['electrodesByPulse'][0]
-        inverse_electrodes = []
+        if self.is_done_emitting:
+            return dict()
+
+        now = time.time()
+
+        if self.emit_start_time == 0:
+            self.emit_start_time = now
+
+        if self.stop_requested:
+            self.is_done_emitting = True
+            return self.stop_commands()
+
+        # Stop at the end of a 4-command block, so that a stop can follow.
+        emit_to = COMMANDS_PER_FRAME * int((now + self.emit_ahead_sec - self.emit_start_time) * self.max_freq)
+        emit_to = max(emit_to, self.commands_emitted)
+        commands = {chip: BytesIO(chip_train[self.commands_emitted:emit_to].tobytes())
+                    for chip, chip_train in self.train.items()}
+
+        self.add_pulse_events(self.commands_emitted, emit_to, self.emit_start_time, self.pulse_type())
+
+        self.commands_emitted = emit_to
+        self.is_done_emitting = emit_to >= max(len(chip_train) for chip_train in self.train.values())
+        return commands
+
+    def triggered_commands(self) -> Dict[int, BytesIO]:
+        # Each trigger sends the whole train.
+        return {chip: BytesIO(chip_train.tobytes()) for chip, chip_train in self.make_train().items()}
+
+    def add_triggered_events(self, sent_time: float) -> None:
+        self.add_pulse_events(0, self.pulse_starts.max(initial=0) + 1, sent_time, 'closed-loop')
+
+    def add_pulse_events(self, from_command: int, to_command: int, train_start_time: float, label: str):
+        """Record the pulses that start in [from_command, to_command) of a train that started at `train_start_time`."""
         pulse_config = self.config['pulseConfig']
+        electrodes = self.config['electrodesByPulse'][0]
+        duration = pulse_config['phase1Duration'] + pulse_config['interphaseDuration'] + \
+            pulse_config['phase2Duration']
+        commands_per_sec = COMMANDS_PER_FRAME * float(self.max_freq)
+
+        for pulse_start in self.pulse_starts[(self.pulse_starts >= from_command) & (self.pulse_starts < to_command)]:
+            start_time = train_start_time + (pulse_start + self.pulse_onset_commands) / commands_per_sec
+            self.add_stimulus_event(start_time, duration, electrodes, pulse_config['phase1Current'], label)
+
+    def stop_stimulation(self) -> None:
+        self.stop_requested = True
 
-        num_main = len(main_electrodes)
-        num_inverse = len(inverse_electrodes)
+    def is_done(self) -> bool:
+        return self.is_done_emitting
 
-        if (num_main == 0) and (num_inverse == 0):
+    def make_train(self) -> Dict[int, np.ndarray]:
+        electrodes = self.config['electrodesByPulse'][0]
+
+        if len(electrodes) == 0:
+            self.pulse_starts = np.zeros(0, dtype=int)
             return dict()
 
-        phase1_current = int(round(pulse_config['phase1Current'] / stim_step_size))
+        pulse_config = self.config['pulseConfig']
+        pulses = self.make_pulses(electrodes)
 
-        commands = {0: BytesIO(), 1: BytesIO(), 2: BytesIO(), 3: BytesIO() }
-        main_electrode_flags = {0: 0, 1: 0, 2: 0, 3: 0}
-        inverse_electrode_flags = {0: 0, 1: 0, 2: 0, 3: 0}
-        all_electrode_flags = {0: 0, 1: 0, 2: 0, 3: 0}
-        setup_steps_counts = {0: 0, 1: 0, 2: 0, 3: 0}
-
-        chips_used = {0: False, 1: False, 2: False, 3: False}
-
-        # Phase 1 setup
-        for electrode in main_electrodes:
-            chip_electrode = electrode % ELECTRODES_PER_CHIP
-            chip = math.floor(electrode / ELECTRODES_PER_CHIP)
-            chips_used[chip] = True
-
-            commands[chip].write(rsh2116_write_current(chip_electrode, phase1_current))
-            electrode_bit = rsh2116_electrode_bit(chip_electrode)
-            main_electrode_flags[chip] |= electrode_bit
-            all_electrode_flags[chip] |= electrode_bit
-            setup_steps_counts[chip] += 1
-
-        for electrode in inverse_electrodes:
-            chip_electrode = electrode % ELECTRODES_PER_CHIP
-            chip = math.floor(electrode / ELECTRODES_PER_CHIP)
-            chips_used[chip] = True
-
-            commands[chip].write(rsh2116_write_current(chip_electrode, -phase1_current))
-            electrode_bit = rsh2116_electrode_bit(chip_electrode)
-            inverse_electrode_flags[chip] |= electrode_bit
-            all_electrode_flags[chip] |= electrode_bit
-            setup_steps_counts[chip] += 1
+        pulse_count = int(pulse_config.get('pulseCount', 1))
+        burst_count = int(pulse_config.get('burstCount', 1))
 
-        # Make sure that we start stimulating all electrodes together.
-        # Note that chip commands have to come in groups of four.
-        num_phase1_setup_commands = max(setup_steps_counts.values())
+        if pulse_count == 1 and burst_count == 1:
+            self.pulse_starts = np.zeros(1, dtype=int)
+            return pulses
 
-        # Ensure that the commands line up with 4-command blocks, after accounting
-        # for the extra two commands farther down.
-        extra_pad_commands = (4 - (num_phase1_setup_commands + 2) % 4) % 4
-        pad_to_steps = num_phase1_setup_commands + extra_pad_commands
+        # Every pulse takes the same time on all chips, even if they set up different
+        # numbers of electrodes, so that the pulses stay aligned.
+        longest_pulse = max(len(pulse) for pulse in pulses.values())
+        pulse_interval = self.interval_commands(pulse_config.get('pulseInterval', 0), longest_pulse, 'pulse')
+        burst_length = pulse_count * pulse_interval
+        burst_interval = self.interval_commands(pulse_config.get('burstInterval', 0), burst_length, 'burst')
 
-        for chip in commands:
-            if not chips_used[chip]:
-                continue
+        self.pulse_starts = (burst_interval * np.arange(burst_count)[:, np.newaxis] +
+                             pulse_interval * np.arange(pulse_count)[np.newaxis, :]).ravel()
 
-            for i in range(setup_steps_counts[chip], pad_to_steps):
-                commands[chip].write(COMMAND_READ_CHIP_ID)
+        train = dict()
 
-        # Trigger Phase 1
-        for chip, chip_used in chips_used.items():
-            if not chip_used:
-                continue
+        for chip, pulse in pulses.items():
+            padded_pulse = np.concatenate([pulse, read_chip_id_words(pulse_interval - len(pulse))])
+            burst = np.tile(padded_pulse, pulse_count)
+            padded_burst = np.concatenate([burst, read_chip_id_words(burst_interval - len(burst))])
 
-            positive_current_electrodes = \
-                main_electrode_flags[chip] if phase1_current > 0 else inverse_electrode_flags[chip]
+            # There's nothing to wait for after the last burst.
+            train[chip] = np.tile(padded_burst, burst_count)[:(burst_count - 1) * burst_interval + len(burst)]
 
-            commands[chip].write(
-                rsh2116_write_register(REG_STIM_POLARITY, positive_current_electrodes))
-            commands[chip].write(
-                (rsh2116_write_register(REG_STIM_ON, all_electrode_flags[chip], trigger=True)))
+        return train
 
-        # Set up Phase 2 right away. We'll trigger it later.
-        phase2_current = int(round(pulse_config['phase2Current'] / stim_step_size))
+    def interval_commands(self, interval_sec: float, min_commands: int, name: str) -> int:
+        """The number of commands in an interval, which must fit at least `min_commands`."""
+        interval = COMMANDS_PER_FRAME * int(round(interval_sec * float(self.max_freq)))
+        min_interval = COMMANDS_PER_FRAME * -(-min_commands // COMMANDS_PER_FRAME)
 
-        for electrode in main_electrodes:
-            chip_electrode = electrode % ELECTRODES_PER_CHIP
-            chip = math.floor(electrode / ELECTRODES_PER_CHIP)
-            commands[chip].write(rsh2116_write_current(chip_electrode, phase2_current))
+        if interval < min_interval:
+            self.log.warning(f'The {name} interval is shorter than a {name}; '
+                             f'using {min_interval / COMMANDS_PER_FRAME / self.max_freq} s')
+            return min_interval
 
-        for electrode in inverse_electrodes:
-            chip_electrode = electrode % ELECTRODES_PER_CHIP
-            chip = math.floor(electrode / ELECTRODES_PER_CHIP)
-            commands[chip].write(rsh2116_write_current(chip_electrode, -phase2_current))
+        return interval
 
-        # Wait for the phase to be over and then terminate it.
-        phase1_duration_steps = 4 * int(round(pulse_config['phase1Duration'] * float(self.max_freq)))
-        pad_phase1_steps = phase1_duration_steps - num_phase1_setup_commands - 2
-        pad_phase1_steps = max(2, pad_phase1_steps)
+    def make_pulses(self, electrodes: List[int]) -> Dict[int, np.ndarray]:
+        """The commands of a single pulse for each chip that has selected electrodes."""
+        stim_step_size = STIM_STEP_SIZES[self.stim_step_size_index]
+        pulse_config = self.config['pulseConfig']
 
-        for i in range(pad_phase1_steps):
-            for chip, chip_used in chips_used.items():
-                if not chip_used:
-                    continue
+        electrodes_by_chip: Dict[int, List[int]] = dict()
+        for electrode in electrodes:
+            electrodes_by_chip.setdefault(electrode // ELECTRODES_PER_CHIP, []).append(electrode % ELECTRODES_PER_CHIP)
 
-                commands[chip].write(COMMAND_READ_CHIP_ID)
+        self.all_electrode_flags = dict()
+        for chip, chip_electrodes in electrodes_by_chip.items():
+            self.all_electrode_flags[chip] = 0
+            for chip_electrode in chip_electrodes:
+                self.all_electrode_flags[chip] |= rsh2116_electrode_bit(chip_electrode)
 
-        # At this point, we're 2 commands short of a 4-command block.
-        # We'll add the missing commands while triggering the next phase.
+        phase1_current = int(round(pulse_config['phase1Current'] / stim_step_size))
+        phase2_current = int(round(pulse_config['phase2Current'] / stim_step_size))
 
-        # Do the interphase, if needed
-        interphase_duration_steps = 4 * int(round(pulse_config['interphaseDuration'] * float(self.max_freq)))
+        # Make sure that we start stimulating all electrodes together.
+        # Note that chip commands have to come in groups of four, and that two more
+        # commands follow the setup.
+        num_phase1_setup_commands = max(len(chip_electrodes) for chip_electrodes in electrodes_by_chip.values())
+        extra_pad_commands = (4 - (num_phase1_setup_commands + 2) % 4) % 4
+        pad_to_steps = num_phase1_setup_commands + extra_pad_commands
+
+        # Phase 1 starts with the second command after the setup.
+        self.pulse_onset_commands = pad_to_steps + 1
 
-        if interphase_duration_steps > 0:
-            for chip, chip_used in chips_used.items():
-                if not chip_used:
-                    continue
-
-                commands[chip].write(COMMAND_READ_CHIP_ID)
-                commands[chip].write(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))
-
-                for i in range(interphase_duration_steps):
-                    commands[chip].write(COMMAND_READ_CHIP_ID)
-
-        # At this point, we're again 2 commands short of a 4-command block.
-        # We'll add the missing commands while triggering the next phase.
-
-        # Trigger Phase 2.
-        for chip, chip_used in chips_used.items():
-            if not chip_used:
-                continue
-
-            positive_current_electrodes = \
-                main_electrode_flags[chip] if phase2_current > 0 else inverse_electrode_flags[chip]
-
-            commands[chip].write(
-                rsh2116_write_register(REG_STIM_POLARITY, positive_current_electrodes))
-            commands[chip].write(
-                (rsh2116_write_register(REG_STIM_ON, all_electrode_flags[chip], trigger=True)))
-
-        # Wait for Phase 2 to end and stop it.
-        phase2_duration_steps = 4 * int(round(pulse_config['phase2Duration'] * float(self.max_freq)))
-        phase2_duration_steps = max(4, phase2_duration_steps)
-
-        for chip, chip_used in chips_used.items():
-            if not chip_used:
-                continue
-
-            # We subtract 1 to account for the stop stim command at the end.
-            for i in range(phase2_duration_steps - 1):
-                commands[chip].write(COMMAND_READ_CHIP_ID)
-
-            commands[chip].write(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))
-
-            # Do some charge recovery
-            commands[chip].write(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH,
-                                                        all_electrode_flags[chip],
-                                                        trigger=True))
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(COMMAND_READ_CHIP_ID)
-            commands[chip].write(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH,
-                                                        0,
-                                                        trigger=True))
+        # Wait for each phase to be over and then terminate it.
+        phase1_duration_steps = 4 * int(round(pulse_config['phase1Duration'] * float(self.max_freq)))
+        pad_phase1_steps = max(2, phase1_duration_steps - num_phase1_setup_commands - 2)
+        interphase_duration_steps = 4 * int(round(pulse_config['interphaseDuration'] * float(self.max_freq)))
+        phase2_duration_steps = max(4, 4 * int(round(pulse_config['phase2Duration'] * float(self.max_freq))))
+
+        pulses = dict()
+
+        for chip, chip_electrodes in electrodes_by_chip.items():
+            all_flags = self.all_electrode_flags[chip]
+            parts = []
+
+            # Phase 1 setup
+            parts.append([command_word(rsh2116_write_current(e, phase1_current)) for e in chip_electrodes])
+            parts.append(read_chip_id_words(pad_to_steps - len(chip_electrodes)))
+
+            # Trigger Phase 1
+            parts.append([command_word(rsh2116_write_register(REG_STIM_POLARITY, all_flags if phase1_current > 0 else 0)),
+                          command_word(rsh2116_write_register(REG_STIM_ON, all_flags, trigger=True))])
+
+            # Set up Phase 2 right away. We'll trigger it later.
+            parts.append([command_word(rsh2116_write_current(e, phase2_current)) for e in chip_electrodes])
+            parts.append(read_chip_id_words(pad_phase1_steps))
+
+            # Do the interphase, if needed
+            if interphase_duration_steps > 0:
+                parts.append([COMMAND_READ_CHIP_ID_WORD,
+                              command_word(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))])
+                parts.append(read_chip_id_words(interphase_duration_steps))
+
+            # Trigger Phase 2.
+            parts.append([command_word(rsh2116_write_register(REG_STIM_POLARITY, all_flags if phase2_current > 0 else 0)),
+                          command_word(rsh2116_write_register(REG_STIM_ON, all_flags, trigger=True))])
+
+            # Wait for Phase 2 to end and stop it. We subtract 1 to account for the stop stim command at the end.
+            parts.append(read_chip_id_words(phase2_duration_steps - 1))
+            parts.append([command_word(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))])
+
+            parts.append(self.charge_recovery_words(chip))
+            pulses[chip] = np.concatenate([np.asarray(part, dtype='<u4') for part in parts])
+
+        return pulses
+
+    def charge_recovery_words(self, chip: int) -> np.ndarray:
+        return np.concatenate([
+            [command_word(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH, self.all_electrode_flags[chip],
+                                                 trigger=True))],
+            read_chip_id_words(10),
+            [command_word(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH, 0, trigger=True))],
+        ]).astype('<u4')
+
+    def stop_commands(self) -> Dict[int, BytesIO]:
+        """End the pulse that may be going on, and do the charge recovery."""
+        commands = dict()
+
+        for chip in self.train.keys():
+            words = np.concatenate([
+                read_chip_id_words(3),
+                [command_word(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))],
+                self.charge_recovery_words(chip),
+            ]).astype('<u4')
+            commands[chip] = BytesIO(words.tobytes())
 
         return commands
@@ -1,7 +1,7 @@
 import multiprocessing
 import os
 import queue
-from typing import Dict
+from typing import Dict, List
 
 from constants import OPENMEA_NUM_ELECTRODES
 from devices.common.udp_data_receiver import UdpDataReceiver
@@ -14,6 +14,7 @@ DEVICE_PROPS = {
     'canControlReplay': False,
     'canControlSampling': True,
     'canRecordToFile': True,
+    'canRecordDirectly': True,
     'canStimulate': True,
     'canSampleDC': True,
     'numElectrodes': OPENMEA_NUM_ELECTRODES,
@@ -64,14 +65,23 @@ class OpenMEADevice(Device):
         super(OpenMEADevice, self).__init__()
         self.rcv_queue = multiprocessing.Queue()
         self.send_queue = multiprocessing.Queue()
-        self.udp_data_receiver = UdpDataReceiver([5051, 5052, 5053, 5054], 16, 20, True)
         self.is_closed = False
         self.sent_device_config = False
 
+        # Closed-loop triggers go from the UDP receiving process straight to the device
+        # process, without passing through the engine.
+        trigger_receiver, trigger_sender = multiprocessing.Pipe(duplex=False)
+        self.udp_data_receiver = UdpDataReceiver([5051, 5052, 5053, 5054], 16, 20, True, trigger_sender)
+
+        # The closed-loop detection of the stimulation config. It runs while stimulating.
+        self.closed_loop_config_json = None
+        self.closed_loop_samples_per_sec = 0
+        self.is_closed_loop_running = False
+
         # Note that this process's rcv_queue is the child process's send_queue, and vice versa.
         self.device_control_process = \
             multiprocessing.Process(target=run_stimulator,
-                                    args=(self.send_queue, self.rcv_queue, os.getpid(), config))
+                                    args=(self.send_queue, self.rcv_queue, os.getpid(), config, trigger_receiver))
         self.device_control_process.start()
 
     def num_electrodes(self) -> int:
@@ -81,15 +91,49 @@ class OpenMEADevice(Device):
         if self.is_closed:
             return
 
-        self.send_queue.put_nowait(msg)
+        # Recording is handled next to the UDP receiver, not by the device process.
+        if 'startRecording' in msg:
+            self.udp_data_receiver.start_recording(msg['startRecording'], self.get_properties())
+        elif 'stopRecording' in msg:
+            self.udp_data_receiver.stop_recording()
+        elif 'startRawCapture' in msg:
+            config = msg['startRawCapture']
+            self.udp_data_receiver.start_raw_capture(config['filePath'],
+                                                     config['samplesPerSec'],
+                                                     self.get_properties())
+        elif 'stopRawCapture' in msg:
+            self.udp_data_receiver.stop_raw_capture()
+        else:
+            self.send_queue.put_nowait(msg)
+            self.update_closed_loop(msg)
+
+    def update_closed_loop(self, msg: Dict):
+        """Start and stop the closed-loop detection along with the stimulation."""
+        if 'pulseConfig' in msg:
+            self.closed_loop_config_json = msg.get('closedLoop')
+            self.closed_loop_samples_per_sec = msg['maxFrequency']
+
+            if self.is_closed_loop_running:
+                self.udp_data_receiver.stop_closed_loop()
+                self.udp_data_receiver.start_closed_loop(self.closed_loop_config_json,
+                                                         self.closed_loop_samples_per_sec)
+
+        if 'startStim' in msg:
+            self.udp_data_receiver.start_closed_loop(self.closed_loop_config_json, self.closed_loop_samples_per_sec)
+            self.is_closed_loop_running = True
+
+        if 'stopStim' in msg:
+            self.udp_data_receiver.stop_closed_loop()
+            self.is_closed_loop_running = False
 
     def collect_updates(self):
         if self.is_closed:
             return {}
 
         result = {
-            'state': [],
-            'data': self.udp_data_receiver.collect_data()
+            'state': self.udp_data_receiver.collect_recording_state(),
+            'data': self.udp_data_receiver.collect_data(),
+            'stimulusEvents': []
         }
 
         if not self.sent_device_config:
@@ -103,11 +147,18 @@ class OpenMEADevice(Device):
                 if 'state' in message:
                     result['state'].append(message['state'])
 
+                if 'stimulusEvents' in message:
+                    result['stimulusEvents'] += message['stimulusEvents']
+
             except queue.Empty:
                 break
 
         return result
 
+    def record_events(self, events: List[Dict]):
+        if not self.is_closed:
+            self.udp_data_receiver.record_events(events)
+
     def close(self):
         self.is_closed = True
         self.udp_data_receiver.close()
@@ -4,45 +4,66 @@ import queue
 import re
 import threading
 import time
-from typing import Dict
-
-import psutil
+from typing import Dict, List, Optional
 
 from devices.openmea.biphasic_stimulator import BiphasicStimulator
 from devices.openmea.stimulator import Stimulator
 from devices.openmea.rsh2116 import rsh2116_set_stim_step_size, STIM_STEP_SIZE_1_uA
-from devices.common.ssh_connection import SshConnection
-from devices.openmea.wav_stimulator import WavStimulator
+from devices.common.closed_loop import ClosedLoopConfig, LatencyHistogram
+from devices.common.parent_process import is_parent_alive
+from devices.common.ssh_connection import SshConnection, PreloadedChipCommands
+from devices.openmea.wav_command_cache import DEFAULT_CACHE_DIR
+from devices.openmea.wav_stimulator import WavStimulator, EMIT_AHEAD_SEC, STREAM_EMIT_AHEAD_SEC
 
 ELECTRODES_PER_CHIP = 16
 
-# Rough implementation - stimulation based on a threshold
-STIM_ON_ELECTRODE = '(disable)-electrode[0]'
-STIM_UPPER_THRESHOLD = 0.001  # Volts
-STIM_LOWER_THRESHOLD = -0.0009  # Volts
-
 DEVICE_SCLK_FREQ = 200_000_000.
 MAX_SAMPLES_PER_SEC = 40_000.
 
+# Without messages, the control loop wakes up this often to check that the engine is still
+# running, and while stimulating, this often to send the next stimulation commands.
+PARENT_CHECK_INTERVAL_SEC = 1
+STIM_EMIT_INTERVAL_SEC = 0.01
+
+# The connection to the device is checked this often.
+CONNECTION_CHECK_INTERVAL_SEC = 5
+
+# In closed-loop mode, the latency histogram is sent at most this often.
+LATENCY_REPORT_INTERVAL_SEC = 1
+
 
 class OpenMEADeviceProcess:
-    def __init__(self, rcv_queue, send_queue, parent_pid, config: Dict):
+    def __init__(self, rcv_queue, send_queue, parent_pid, config: Dict, trigger_connection=None):
         self.rcv_queue = rcv_queue
         self.send_queue = send_queue
         self.parent_pid = parent_pid
-        self.last_parent_exit_check_time = time.time()
         self.stimulator = Stimulator()
         self.num_chips = len(config['fifo_dev_files'])
 
         self.stim_step_size_index = STIM_STEP_SIZE_1_uA
         self.max_frequency = 20_000
 
+        # Compiled .wav stimulation protocols are cached here.
+        self.stim_cache_dir = DEFAULT_CACHE_DIR
+        if 'stim_cache_dir' in config:
+            self.stim_cache_dir = config['stim_cache_dir']
+
         self.ssh_connection = SshConnection(config)
-        self.last_ssh_connection_check = time.time()
         self.connected = False
         self.initialized_stim = False
         self.is_stimulating = False
 
+        # Closed-loop stimulation: the UDP receiving process detects the triggers and sends
+        # their times through `trigger_connection`. While armed, each trigger sends the
+        # preloaded commands right away, from a thread of its own.
+        self.trigger_connection = trigger_connection
+        self.closed_loop_config = ClosedLoopConfig()
+        self.closed_loop_armed = False
+        self.closed_loop_lock = threading.Lock()
+        self.preloaded_commands: Optional[PreloadedChipCommands] = None
+        self.latency_histogram = LatencyHistogram()
+        self.last_latency_report_time = 0
+
         self.device_init_commands = config['device_init_commands']
         self.log = logging.getLogger(__name__)
         self.log.setLevel(logging.INFO)
@@ -61,6 +82,7 @@ class OpenMEADeviceProcess:
             # else: we'll set this on the first stimulation.
 
         self.max_frequency = config['maxFrequency']
+        self.closed_loop_config = ClosedLoopConfig.from_json(config.get('closedLoop'), self.max_frequency)
 
         pulse_type = config['pulseType']
 
@@ -71,7 +93,7 @@ class OpenMEADeviceProcess:
         self.stimulator.on_stimulation_done()
 
         if pulse_type == 'wav_files':
-            self.stimulator = WavStimulator(config)
+            self.stimulator = WavStimulator(config, self.stim_cache_dir)
 
         elif pulse_type == 'biphasic':
             self.stimulator = BiphasicStimulator(config,
@@ -79,17 +101,22 @@ class OpenMEADeviceProcess:
                                                  self.max_frequency)
 
     def start_stim(self):
+        if self.closed_loop_config.is_enabled():
+            self.arm_closed_loop()
+            return
+
         self.is_stimulating = True
         self.stimulator.on_stimulation_starting()
         self.emit_device_state({'isStimulating': True})
 
     def stop_stim(self):
-        self.stimulator.stop_stimulation()
-
-    def continue_stim(self):
-        if (not self.connected) or (not self.is_stimulating):
+        if self.closed_loop_armed:
+            self.disarm_closed_loop()
             return
 
+        self.stimulator.stop_stimulation()
+
+    def initialize_stim(self):
         if not self.initialized_stim:
             # Pad the init commands with COMMAND_READ_CHIP_ID to align it to 4-command blocks.
             init_commands = rsh2116_set_stim_step_size(self.stim_step_size_index)
@@ -97,6 +124,16 @@ class OpenMEADeviceProcess:
             self.ssh_connection.exec_same_chip_commands_on_all(init_commands)
             self.initialized_stim = True
 
+    def continue_stim(self):
+        if (not self.connected) or (not self.is_stimulating) or self.closed_loop_armed:
+            return
+
+        self.initialize_stim()
+
+        # If the stream fails, the commands are uploaded again, which needs more time.
+        self.stimulator.set_emit_ahead(
+            STREAM_EMIT_AHEAD_SEC if self.ssh_connection.is_streaming() else EMIT_AHEAD_SEC)
+
         start_generate = time.time()
         commands = self.stimulator.emit_next_commands()
         self.is_stimulating = not self.stimulator.is_done()
@@ -105,9 +142,85 @@ class OpenMEADeviceProcess:
         end = time.time()
         print(f'Generate: {start_send -start_generate }; send: {end-start_send}')
 
+        self.emit_stimulus_events(self.stimulator.take_stimulus_events())
+
         if not self.is_stimulating:
             self.emit_device_state({'isStimulating': False})
 
+    def arm_closed_loop(self):
+        if not self.connected:
+            self.log.warning('Closed-loop stimulation needs a connected device')
+            return
+
+        self.initialize_stim()
+
+        if not self.preload_closed_loop_commands():
+            self.log.warning('Closed-loop stimulation needs biphasic pulses and stimulation electrodes')
+            return
+
+        self.latency_histogram.clear()
+        self.closed_loop_armed = True
+        self.is_stimulating = True
+        self.emit_device_state({'isStimulating': True, 'closedLoopLatency': self.latency_histogram.to_json()})
+
+    def preload_closed_loop_commands(self) -> bool:
+        """Preload the commands of the current stimulator for the triggers. Returns False if there are none."""
+        commands = self.stimulator.triggered_commands()
+
+        if len(commands) == 0:
+            return False
+
+        preloaded = self.ssh_connection.preload_chip_commands(commands)
+
+        with self.closed_loop_lock:
+            old_preloaded = self.preloaded_commands
+            self.preloaded_commands = preloaded
+
+        if old_preloaded is not None:
+            self.ssh_connection.remove_preloaded_chip_commands(old_preloaded)
+
+        return True
+
+    def disarm_closed_loop(self):
+        with self.closed_loop_lock:
+            self.closed_loop_armed = False
+            preloaded = self.preloaded_commands
+            self.preloaded_commands = None
+
+        if preloaded is not None:
+            self.ssh_connection.remove_preloaded_chip_commands(preloaded)
+
+        self.log.info(self.latency_histogram.summary())
+        self.is_stimulating = False
+        self.emit_device_state({'isStimulating': False, 'closedLoopLatency': self.latency_histogram.to_json()})
+
+    def trigger_closed_loop(self, trigger_time: float):
+        """Send the preloaded commands for a trigger whose sample was acquired at `trigger_time`."""
+        with self.closed_loop_lock:
+            if not self.closed_loop_armed:
+                return
+
+            self.ssh_connection.exec_preloaded_chip_commands(self.preloaded_commands)
+            sent_time = time.time()
+            self.stimulator.add_triggered_events(sent_time)
+
+        # The latency is measured up to when the commands are on their way to the chips.
+        self.latency_histogram.add(sent_time - trigger_time)
+        self.emit_stimulus_events(self.stimulator.take_stimulus_events())
+
+        if sent_time - self.last_latency_report_time >= LATENCY_REPORT_INTERVAL_SEC:
+            self.last_latency_report_time = sent_time
+            self.emit_device_state({'closedLoopLatency': self.latency_histogram.to_json()})
+
+    def run_closed_loop_triggers(self):
+        while True:
+            try:
+                trigger_time = self.trigger_connection.recv()
+            except EOFError:
+                return
+
+            self.trigger_closed_loop(trigger_time)
+
     def exec_device_command(self, command: str):
         self.ssh_connection.exec_device_command(command)
         self.check_and_send_device_state()
@@ -169,6 +282,11 @@ class OpenMEADeviceProcess:
         if 'pulseConfig' in msg:
             self.configure(msg)
 
+            # Triggers from now on send the new stimuli.
+            if self.closed_loop_armed and \
+                    not (self.closed_loop_config.is_enabled() and self.preload_closed_loop_commands()):
+                self.disarm_closed_loop()
+
         if 'startStim' in msg:
             self.start_stim()
 
@@ -184,28 +302,43 @@ class OpenMEADeviceProcess:
         if 'stopSampling' in msg:
             self.exec_device_command('stop')
 
-    def process_messages(self):
+    def process_messages(self, timeout: float):
+        """Wait up to `timeout` seconds for messages, and process all the ones that came in."""
+        try:
+            msg = self.rcv_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+
         while True:
-            self.exit_if_parent_exists()
+            self.process_message(msg)
 
             try:
                 msg = self.rcv_queue.get_nowait()
-                self.process_message(msg)
             except queue.Empty:
                 break
 
     def run_loop(self):
-        while True:
-            now = time.time()
+        connection_monitor_thread = threading.Thread(target=self.run_connection_monitor,
+                                                     name='connection-monitor',
+                                                     daemon=True)
+        connection_monitor_thread.start()
 
-            if now > (self.last_ssh_connection_check + 5):
-                self.last_ssh_connection_check = now
-                conn_check_thread = threading.Thread(target=self.run_connection_check)
-                conn_check_thread.start()
+        if self.trigger_connection is not None:
+            closed_loop_thread = threading.Thread(target=self.run_closed_loop_triggers,
+                                                  name='closed-loop-triggers',
+                                                  daemon=True)
+            closed_loop_thread.start()
 
-            self.process_messages()
+        while True:
+            is_emitting = self.is_stimulating and not self.closed_loop_armed
+            self.process_messages(STIM_EMIT_INTERVAL_SEC if is_emitting else PARENT_CHECK_INTERVAL_SEC)
+            self.exit_if_parent_exited()
             self.continue_stim()
-            time.sleep(0.001)
+
+    def run_connection_monitor(self):
+        while True:
+            time.sleep(CONNECTION_CHECK_INTERVAL_SEC)
+            self.run_connection_check()
 
     def run_connection_check(self):
         was_connected = self.connected
@@ -219,26 +352,24 @@ class OpenMEADeviceProcess:
         if not was_connected and self.connected:
             self.check_and_send_device_state()
 
-    def exit_if_parent_exists(self):
-        now = time.time()
-
-        if now <= self.last_parent_exit_check_time + 1:
-            return
-
-        self.last_parent_exit_check_time = now
-
-        if self.parent_pid not in psutil.pids():
+    def exit_if_parent_exited(self):
+        if not is_parent_alive(self.parent_pid):
             os.abort()
 
     def emit_device_state(self, state):
         self.send_queue.put_nowait({'state': state})
 
+    def emit_stimulus_events(self, events: List[Dict]):
+        # The engine maps them onto the sample clock, and publishes them once their samples come in.
+        if len(events) > 0:
+            self.send_queue.put_nowait({'stimulusEvents': events})
+
     def set_sampling_rate(self, rate):
         adjusted_rate = min(rate, MAX_SAMPLES_PER_SEC)
         sample_duration_sck = int(round(DEVICE_SCLK_FREQ / adjusted_rate))
         self.exec_device_command(f'sampledur {sample_duration_sck}')
 
 
-def run_stimulator(rcv_queue, send_queue, parent_pid, config: Dict):
-    stimulator = OpenMEADeviceProcess(rcv_queue, send_queue, parent_pid, config)
+def run_stimulator(rcv_queue, send_queue, parent_pid, config: Dict, trigger_connection=None):
+    stimulator = OpenMEADeviceProcess(rcv_queue, send_queue, parent_pid, config, trigger_connection)
     stimulator.run_loop()
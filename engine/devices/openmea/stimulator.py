@@ -1,10 +1,11 @@
 from io import BytesIO
-from typing import Dict
+from typing import Dict, List
 
 
 class Stimulator:
     def __init__(self):
-        pass
+        # The stimuli of the commands emitted so far, until take_stimulus_events().
+        self.stimulus_events: List[Dict] = []
 
     def pulse_type(self) -> str:
         return 'none'
@@ -15,9 +16,43 @@ class Stimulator:
     def on_stimulation_starting(self) -> None:
         pass
 
+    def set_emit_ahead(self, emit_ahead_sec: float) -> None:
+        """How far ahead of time the commands should be generated and sent."""
+        pass
+
     def emit_next_commands(self) -> Dict[int, BytesIO]:
         return dict()
 
+    def triggered_commands(self) -> Dict[int, BytesIO]:
+        """
+        The commands that each closed-loop trigger sends, all at once. Empty if this kind of
+        stimulation can't be triggered.
+        """
+        return dict()
+
+    def add_triggered_events(self, sent_time: float) -> None:
+        """Record the stimuli of triggered_commands(), which were sent at `sent_time`."""
+        pass
+
+    def add_stimulus_event(self, start_time: float, duration: float, electrodes: List[int], amplitude: float,
+                           label: str) -> None:
+        """
+        Record a stimulus that the commands emitted now will deliver. `start_time` is when
+        it's meant to start (by time.time()), and `amplitude` is the peak current in amps.
+        """
+        self.stimulus_events.append({
+            'time': float(start_time),
+            'duration': float(duration),
+            'electrodes': [int(electrode) for electrode in electrodes],
+            'amplitude': float(amplitude),
+            'label': label
+        })
+
+    def take_stimulus_events(self) -> List[Dict]:
+        events = self.stimulus_events
+        self.stimulus_events = []
+        return events
+
     def stop_stimulation(self) -> None:
         pass
 
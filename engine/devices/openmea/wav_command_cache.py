@@ -0,0 +1,288 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import wave
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from devices.openmea.rsh2116 import COMMAND_READ_CHIP_ID, rsh2116_write_register, rsh2116_write_current, \
+    REG_STIM_POLARITY
+
+ELECTRODES_PER_CHIP = 16
+
+# The command that sets the current of electrode 0 to each 8-bit .wav sample (128 is no
+# current). The commands of the other electrodes only differ in the register number.
+WAV_SAMPLE_COMMANDS = np.array([int.from_bytes(rsh2116_write_current(0, sample - 128), byteorder='little')
+                                for sample in range(256)], dtype='<u4')
+ELECTRODE_REGISTER_SHIFT = 16
+
+COMMAND_READ_CHIP_ID_WORD = int.from_bytes(COMMAND_READ_CHIP_ID, byteorder='little')
+COMMAND_STIM_POLARITY_WORD = int.from_bytes(rsh2116_write_register(REG_STIM_POLARITY, 0, trigger=True),
+                                            byteorder='little')
+
+# A .wav frame that doesn't exist (after the end of a file) means no current.
+WAV_SILENCE = 128
+
+COMPILED_FORMAT_VERSION = 2
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'openmea_stim_cache')
+
+# Looping files of different lengths only repeat together after the least common multiple
+# of their lengths. Longer command streams than this aren't compiled.
+MAX_COMPILED_BYTES = 512 * 1024 * 1024
+
+# When the cache grows beyond this, the streams that were used least recently are removed.
+MAX_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+# Streams are compiled in pieces of this many frames, to limit the memory used.
+COMPILE_CHUNK_FRAMES = 1 << 20
+
+# Content hashes of the .wav files, by (path, size, modification time), so that a file
+# is only read once to hash it while it doesn't change.
+file_hashes: Dict[Tuple[str, int, float], str] = {}
+
+
+class WavChipLayout:
+    """
+    The commands for one .wav frame on one chip: a current command for each (file, electrode)
+    pair, in this order, then the pad commands, then the polarity command.
+    """
+    def __init__(self, electrodes_by_file: List[List[int]], chip: int, pad_commands: int):
+        pairs = [(file_num, electrode % ELECTRODES_PER_CHIP)
+                 for file_num, electrodes in enumerate(electrodes_by_file)
+                 for electrode in electrodes
+                 if math.floor(electrode / ELECTRODES_PER_CHIP) == chip]
+
+        self.file_nums = np.array([file_num for file_num, _ in pairs], dtype=int)
+        self.electrodes = np.array([electrode for _, electrode in pairs], dtype='<u4')
+        self.pad_commands = pad_commands
+
+    def num_commands(self) -> int:
+        return len(self.electrodes) + self.pad_commands + 1
+
+    def frame_commands(self, samples: np.ndarray) -> np.ndarray:
+        """The commands for the .wav `samples` (one row per file), one row per frame."""
+        num_currents = len(self.electrodes)
+        chip_samples = samples[self.file_nums].T
+
+        rows = np.empty((samples.shape[1], self.num_commands()), dtype='<u4')
+        rows[:, :num_currents] = WAV_SAMPLE_COMMANDS[chip_samples] + (self.electrodes << ELECTRODE_REGISTER_SHIFT)
+
+        # Pad to a multiple of 4 commands, and to align the frames together on different chips.
+        rows[:, num_currents:-1] = COMMAND_READ_CHIP_ID_WORD
+
+        # Stim! The electrodes with a current of 0 or more get a positive polarity.
+        positive_flags = (chip_samples >= WAV_SILENCE) * (np.uint32(1) << self.electrodes)
+        rows[:, -1] = COMMAND_STIM_POLARITY_WORD | np.bitwise_or.reduce(positive_flags, axis=1)
+
+        return rows
+
+
+class CompiledWavCommands:
+    """
+    The command streams of a whole .wav stimulation protocol, one memory-mapped file per chip
+    with one row of commands per frame. Without looping, the protocol ends after `num_frames`;
+    with looping, it starts over from the first frame.
+    """
+    def __init__(self, cache_dir: str, key: str):
+        with open(metadata_path(cache_dir, key), 'r') as metadata_file:
+            metadata = json.load(metadata_file)
+
+        self.num_frames: int = metadata['numFrames']
+
+        # The number of frames and the peak current (in stimulation steps) of each file, so
+        # that the files don't have to be read again when the protocol is in the cache.
+        self.file_lengths: List[int] = metadata['fileLengths']
+        self.file_peak_codes: List[int] = metadata['filePeakCodes']
+
+        self.streams: Dict[int, np.ndarray] = {}
+
+        for chip_str, num_commands in metadata['numCommandsByChip'].items():
+            chip = int(chip_str)
+            self.streams[chip] = np.memmap(stream_path(cache_dir, key, chip), dtype='<u4', mode='r',
+                                           shape=(self.num_frames, num_commands))
+
+        # Mark the protocol as recently used, for pruning.
+        os.utime(metadata_path(cache_dir, key))
+
+    def frame_ranges(self, from_frame: int, num_frames: int, loop: bool) -> List[Tuple[int, int]]:
+        """The ranges of compiled frames for `num_frames` frames from `from_frame` on."""
+        ranges = []
+
+        while num_frames > 0 and (loop or from_frame < self.num_frames):
+            from_frame %= self.num_frames
+            to_frame = min(from_frame + num_frames, self.num_frames)
+            ranges.append((from_frame, to_frame))
+            num_frames -= to_frame - from_frame
+            from_frame = to_frame
+
+        return ranges
+
+    def close(self):
+        # The mappings are closed once nothing refers to them any more.
+        self.streams = {}
+
+
+def metadata_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f'{key}.json')
+
+
+def stream_path(cache_dir: str, key: str, chip: int) -> str:
+    return os.path.join(cache_dir, f'{key}_chip{chip}.bin')
+
+
+def hash_file(file_path: str) -> str:
+    stat = os.stat(file_path)
+    file_key = (os.path.realpath(file_path), stat.st_size, stat.st_mtime)
+
+    if file_key not in file_hashes:
+        sha = hashlib.sha256()
+
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+
+        file_hashes[file_key] = sha.hexdigest()
+
+    return file_hashes[file_key]
+
+
+def protocol_key(file_paths: List[str], electrodes_by_file: List[List[int]], pad_commands: Dict[int, int],
+                 loop: bool) -> str:
+    """
+    The cache key of a protocol. It depends on the contents of the files, not their names,
+    and not on the frame rate or the stimulation step size, which don't change the commands.
+    """
+    description = {
+        'version': COMPILED_FORMAT_VERSION,
+        'files': [hash_file(file_path) for file_path in file_paths],
+        'electrodesByFile': electrodes_by_file,
+        'padCommands': {str(chip): pad for chip, pad in sorted(pad_commands.items())},
+        'loop': loop,
+    }
+
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_wav_samples(file_path: str) -> np.ndarray:
+    with wave.open(file_path, 'rb') as file:
+        return np.frombuffer(file.readframes(file.getnframes()), dtype=np.uint8)
+
+
+def wav_peak_code(samples: np.ndarray) -> int:
+    """The largest current of a .wav file, in stimulation steps."""
+    return int(np.max(np.abs(samples.astype(int) - WAV_SILENCE))) if len(samples) > 0 else 0
+
+
+def protocol_samples(files_samples: List[np.ndarray], from_frame: int, to_frame: int, loop: bool) -> np.ndarray:
+    """The samples of all files (one row per file) in [from_frame, to_frame) of the protocol."""
+    frame_nums = np.arange(from_frame, to_frame)
+    samples = np.full((len(files_samples), len(frame_nums)), WAV_SILENCE, dtype=np.uint8)
+
+    for file_num, file_samples in enumerate(files_samples):
+        if len(file_samples) == 0:
+            continue
+
+        if loop:
+            samples[file_num] = file_samples[frame_nums % len(file_samples)]
+        else:
+            num_file_frames = max(0, min(len(file_samples), to_frame) - from_frame)
+            samples[file_num, :num_file_frames] = file_samples[from_frame:from_frame + num_file_frames]
+
+    return samples
+
+
+def open_compiled_wav_commands(file_paths: List[str],
+                               electrodes_by_file: List[List[int]],
+                               layouts: Dict[int, WavChipLayout],
+                               loop: bool,
+                               cache_dir: str = DEFAULT_CACHE_DIR) -> Optional[CompiledWavCommands]:
+    """
+    Open the compiled command streams of a protocol, compiling them first if they aren't
+    in the cache. Returns None if the streams would be too long to compile.
+    """
+    log = logging.getLogger(__name__)
+    pad_commands = {chip: layout.pad_commands for chip, layout in layouts.items()}
+    key = protocol_key(file_paths, electrodes_by_file, pad_commands, loop)
+
+    if os.path.isfile(metadata_path(cache_dir, key)):
+        return CompiledWavCommands(cache_dir, key)
+
+    files_samples = [read_wav_samples(file_path) for file_path in file_paths]
+    file_lengths = [len(file_samples) for file_samples in files_samples if len(file_samples) > 0]
+
+    if len(file_lengths) == 0:
+        return None
+
+    num_frames = math.lcm(*file_lengths) if loop else max(file_lengths)
+    frame_bytes = 4 * sum(layout.num_commands() for layout in layouts.values())
+
+    if num_frames * frame_bytes > MAX_COMPILED_BYTES:
+        log.info(f'Not compiling the stimulation protocol: it would take {num_frames * frame_bytes} bytes')
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    for chip, layout in layouts.items():
+        temp_path = stream_path(cache_dir, key, chip) + '.tmp'
+
+        with open(temp_path, 'wb') as stream_file:
+            for from_frame in range(0, num_frames, COMPILE_CHUNK_FRAMES):
+                to_frame = min(from_frame + COMPILE_CHUNK_FRAMES, num_frames)
+                samples = protocol_samples(files_samples, from_frame, to_frame, loop)
+                stream_file.write(layout.frame_commands(samples).tobytes())
+
+        os.replace(temp_path, stream_path(cache_dir, key, chip))
+
+    # The metadata goes last: a protocol is only in the cache once all its streams are.
+    metadata = {
+        'version': COMPILED_FORMAT_VERSION,
+        'numFrames': num_frames,
+        'numCommandsByChip': {str(chip): layout.num_commands() for chip, layout in layouts.items()},
+        'fileLengths': [len(file_samples) for file_samples in files_samples],
+        'filePeakCodes': [wav_peak_code(file_samples) for file_samples in files_samples],
+    }
+
+    temp_path = metadata_path(cache_dir, key) + '.tmp'
+    with open(temp_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file)
+    os.replace(temp_path, metadata_path(cache_dir, key))
+
+    log.info(f'Compiled a stimulation protocol of {num_frames} frames')
+    prune_cache(cache_dir, keep_key=key)
+
+    return CompiledWavCommands(cache_dir, key)
+
+
+def prune_cache(cache_dir: str, keep_key: str, max_bytes: int = MAX_CACHE_BYTES):
+    """Remove the protocols that were used least recently until the cache fits in `max_bytes`."""
+    protocols = []
+
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith('.json'):
+            continue
+
+        key = file_name[:-len('.json')]
+        stream_files = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+                        if name.startswith(f'{key}_chip')]
+        size = sum(os.path.getsize(path) for path in stream_files)
+        protocols.append((os.path.getmtime(metadata_path(cache_dir, key)), key, size, stream_files))
+
+    total_bytes = sum(size for _, _, size, _ in protocols)
+
+    for _, key, size, stream_files in sorted(protocols):
+        if total_bytes <= max_bytes:
+            break
+
+        if key == keep_key:
+            continue
+
+        # Remove the metadata first, so that the protocol is never used half-removed.
+        os.remove(metadata_path(cache_dir, key))
+        for path in stream_files:
+            os.remove(path)
+
+        total_bytes -= size
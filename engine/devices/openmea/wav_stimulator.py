@@ -1,26 +1,36 @@
 import logging
 import math
+import os
 import time
 import wave
 from io import BytesIO
 from typing import Dict, List, Optional
 
+import numpy as np
+
 from devices.openmea.rsh2116 import rsh2116_electrode_bit, COMMAND_READ_CHIP_ID, rsh2116_write_register, REG_STIM_ON, \
-    REG_CHARGE_RECOV_SWITCH, rsh2116_write_current, REG_STIM_POLARITY
+    REG_CHARGE_RECOV_SWITCH, STIM_STEP_SIZES
 from devices.openmea.stimulator import Stimulator
+from devices.openmea.wav_command_cache import CompiledWavCommands, WavChipLayout, open_compiled_wav_commands, \
+    DEFAULT_CACHE_DIR, WAV_SILENCE, read_wav_samples, wav_peak_code
 
+# Commands are generated this far ahead of time, so that the device doesn't run out of
+# them while the next batch is on its way. Uploading a batch as files takes up to seconds;
+# streaming it takes about one network round trip.
 EMIT_AHEAD_SEC = 3
+STREAM_EMIT_AHEAD_SEC = 0.05
 ELECTRODES_PER_CHIP = 16
 
 
 class WavStimulator(Stimulator):
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, cache_dir: str = DEFAULT_CACHE_DIR):
         super(WavStimulator, self).__init__()
         self.log = logging.getLogger(__name__)
         self.log.setLevel(logging.INFO)
 
         self.config = None
         self.max_freq = 0
+        self.emit_ahead_sec = EMIT_AHEAD_SEC
 
         self.file_paths = []
         self.files: List[Optional[wave.Wave_read]] = []
@@ -37,6 +47,18 @@ class WavStimulator(Stimulator):
         self.pad_commands: Dict[int, int] = {}
         self.chips_used: List[int] = []
         self.loop_forever = False
+        self.layouts: Dict[int, WavChipLayout] = {}
+
+        # The number of frames and the peak current (in amps) of each file, for the stimulus events.
+        self.file_lengths: List[int] = []
+        self.file_amplitudes: List[float] = []
+
+        # The protocol is compiled into command streams that are cached in `cache_dir`, and
+        # then replayed from there. If it can't be, the commands are generated from the .wav
+        # files while stimulating.
+        self.cache_dir = cache_dir
+        self.compiled: Optional[CompiledWavCommands] = None
+        self.compiled_position = 0
 
         self.update_config(config)
 
@@ -52,16 +74,12 @@ class WavStimulator(Stimulator):
         self.electrodes_by_file = config['electrodesByPulse']
         self.loop_forever = config['loopForever']
 
-    def on_stimulation_starting(self) -> None:
-        # Open the .wav files
-        for file in self.files:
-            if file is not None:
-                file.close()
+    def set_emit_ahead(self, emit_ahead_sec: float) -> None:
+        self.emit_ahead_sec = emit_ahead_sec
 
-        self.files = []
-
-        for file_path in self.file_paths:
-            self.files.append(wave.open(file_path, 'rb'))
+    def on_stimulation_starting(self) -> None:
+        # Close the .wav files and the compiled protocol of the previous stimulation
+        self.on_stimulation_done()
 
         # Initialize the overall state
         self.emit_start_time = 0
@@ -99,6 +117,24 @@ class WavStimulator(Stimulator):
         for chip in self.chips_used:
             self.pad_commands[chip] = pad_to_commands - self.num_electrodes_per_chip[chip] - 1
 
+        self.layouts = {chip: WavChipLayout(self.electrodes_by_file, chip, self.pad_commands[chip])
+                        for chip in self.chips_used}
+
+        try:
+            self.compiled = open_compiled_wav_commands(self.file_paths, self.electrodes_by_file, self.layouts,
+                                                       self.loop_forever, self.cache_dir)
+        except Exception as e:
+            self.log.warning(f'Could not compile the stimulation protocol: {e}')
+            self.compiled = None
+
+        self.compiled_position = 0
+        self.init_file_stats()
+
+        if self.compiled is None:
+            # Open the .wav files
+            for file_path in self.file_paths:
+                self.files.append(wave.open(file_path, 'rb'))
+
     def emit_next_commands(self) -> Dict[int, BytesIO]:
         if self.is_done_emitting:
             return {}
@@ -124,11 +160,84 @@ class WavStimulator(Stimulator):
             self.is_done_emitting = True
             return self._turn_off_electrodes()
 
-        # Read the next set of .wav file frames
-        emit_to_time = now + EMIT_AHEAD_SEC
+        # The frames that were emitted stay emitted, even if the emit-ahead time got shorter
+        # (when the commands switch from being uploaded to being streamed).
+        emit_to_time = now + self.emit_ahead_sec
         should_be_at_frames = round((emit_to_time - self.emit_start_time) * float(self.max_freq))
+        should_be_at_frames = max(should_be_at_frames, self.frames_emitted)
         num_frames_to_emit = should_be_at_frames - self.frames_emitted
 
+        if self.compiled is not None:
+            # Copy the next frames of the compiled protocol
+            frame_ranges = self.compiled.frame_ranges(self.compiled_position, num_frames_to_emit, self.loop_forever)
+            num_frames_copied = sum(to_frame - from_frame for from_frame, to_frame in frame_ranges)
+
+            for chip in self.chips_used:
+                for from_frame, to_frame in frame_ranges:
+                    commands[chip].write(self.compiled.streams[chip][from_frame:to_frame])
+
+            self.compiled_position += num_frames_copied
+            num_frames_emitted = num_frames_copied
+
+        else:
+            num_frames_emitted = self._emit_file_frames(commands, num_frames_to_emit)
+
+        # Print some stats
+        delay = now - self.prev_emit_time
+        # self.log.info(f'Delay: {delay}; emitting {len(values)} frames')
+        print(f'Delay: {delay}; emitting {num_frames_emitted} frames')
+
+        self.add_file_events(self.frames_emitted, self.frames_emitted + num_frames_emitted)
+
+        # If the protocol has ended, end the stimulation.
+        if num_frames_emitted < num_frames_to_emit:
+            self.is_done_emitting = True
+            self._turn_off_electrodes(commands)
+
+        self.frames_emitted = should_be_at_frames
+        self.prev_emit_time = now
+        return commands
+
+    def init_file_stats(self):
+        stim_step_size = STIM_STEP_SIZES[self.config['stimStepSizeIndex']]
+
+        if self.compiled is not None:
+            # The compiled protocol knows the stats of its files.
+            self.file_lengths = list(self.compiled.file_lengths)
+            peak_codes = self.compiled.file_peak_codes
+        else:
+            files_samples = [read_wav_samples(file_path) for file_path in self.file_paths]
+            self.file_lengths = [len(samples) for samples in files_samples]
+            peak_codes = [wav_peak_code(samples) for samples in files_samples]
+
+        self.file_amplitudes = [peak_code * stim_step_size for peak_code in peak_codes]
+
+    def add_file_events(self, from_frame: int, to_frame: int):
+        """Record a stimulus for each file that starts (or starts over) in [from_frame, to_frame)."""
+        for file_num, electrodes in enumerate(self.electrodes_by_file):
+            num_frames = self.file_lengths[file_num]
+
+            if len(electrodes) == 0 or num_frames == 0:
+                continue
+
+            if self.loop_forever:
+                starts = range(-(-from_frame // num_frames) * num_frames, to_frame, num_frames)
+            else:
+                starts = [0] if from_frame == 0 and to_frame > 0 else []
+
+            for start_frame in starts:
+                self.add_stimulus_event(self.emit_start_time + start_frame / float(self.max_freq),
+                                        num_frames / float(self.max_freq),
+                                        electrodes,
+                                        self.file_amplitudes[file_num],
+                                        os.path.basename(self.file_paths[file_num]))
+
+    def _emit_file_frames(self, commands: Dict[int, BytesIO], num_frames_to_emit: int) -> int:
+        """
+        Generate the commands for the next frames of the .wav files. Return the number of frames,
+        which is less than `num_frames_to_emit` if the files have ended.
+        """
+        # Read the next set of .wav file frames
         frames: List[bytes] = []
         max_frames_read = 0
 
@@ -142,9 +251,12 @@ class WavStimulator(Stimulator):
             num_frames_read = len(file_frames)
 
             if num_frames_read < num_frames_to_emit:
-                if self.loop_forever:
-                    file.rewind()
-                    file_frames += file.readframes(num_frames_to_emit - num_frames_read)
+                if self.loop_forever and file.getnframes() > 0:
+                    # Files shorter than the batch start over more than once.
+                    while len(file_frames) < num_frames_to_emit:
+                        file.rewind()
+                        file_frames += file.readframes(num_frames_to_emit - len(file_frames))
+
                     max_frames_read = num_frames_to_emit
 
                 else:
@@ -157,58 +269,22 @@ class WavStimulator(Stimulator):
 
             frames.append(file_frames)
 
-        # Is this the end?
-        will_be_done = False
+        num_frames = min(max_frames_read, num_frames_to_emit)
 
-        if max_frames_read < num_frames_to_emit:
-            will_be_done = True
-            num_frames_to_emit = max_frames_read
-
-        # Print some stats
-        delay = now - self.prev_emit_time
-        # self.log.info(f'Delay: {delay}; emitting {len(values)} frames')
-        print(f'Delay: {delay}; emitting {num_frames_to_emit} frames')
+        if num_frames == 0:
+            return 0
 
         # Generate Intan chip commands from .wav frames
-        for frame_num in range(num_frames_to_emit):
-            pos_electrodes_flags = {0: 0, 1: 0, 2: 0, 3: 0}
-
-            # Translate .wav levels into file commands
-            for file_num in range(len(self.files)):
-                value = 0
-
-                if frame_num < len(frames[file_num]):
-                    value = frames[file_num][frame_num] - 128
-
-                for electrode in self.electrodes_by_file[file_num]:
-                    chip_electrode = electrode % ELECTRODES_PER_CHIP
-                    chip = math.floor(electrode / ELECTRODES_PER_CHIP)
-                    commands[chip].write(rsh2116_write_current(chip_electrode, value))
+        samples = np.full((len(frames), num_frames), WAV_SILENCE, dtype=np.uint8)
 
-                    if value >= 0:
-                        electrode_bit = rsh2116_electrode_bit(chip_electrode)
-                        pos_electrodes_flags[chip] |= electrode_bit
-
-            for chip in self.chips_used:
-                # Pad to a multiple of 4 commands, and to align the frames together
-                # on different chips.
-                for i in range(self.pad_commands[chip]):
-                    commands[chip].write(COMMAND_READ_CHIP_ID)
-
-                # Stim!
-                commands[chip].write(
-                    rsh2116_write_register(REG_STIM_POLARITY,
-                                           pos_electrodes_flags[chip],
-                                           trigger=True))
+        for file_num, file_frames in enumerate(frames):
+            num_file_frames = min(len(file_frames), num_frames)
+            samples[file_num, :num_file_frames] = np.frombuffer(file_frames, dtype=np.uint8, count=num_file_frames)
 
-        # If we're done, end the stimulation.
-        if will_be_done:
-            self.is_done_emitting = True
-            self._turn_off_electrodes(commands)
+        for chip in self.chips_used:
+            commands[chip].write(self.layouts[chip].frame_commands(samples).tobytes())
 
-        self.frames_emitted = should_be_at_frames
-        self.prev_emit_time = now
-        return commands
+        return num_frames
 
     def is_done(self) -> bool:
         return self.is_done_emitting
@@ -221,6 +297,10 @@ class WavStimulator(Stimulator):
 
         self.files = []
 
+        if self.compiled is not None:
+            self.compiled.close()
+            self.compiled = None
+
     def stop_stimulation(self) -> None:
         self.stop_requested = True
 
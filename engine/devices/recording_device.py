@@ -0,0 +1,19 @@
+from typing import Dict
+
+from devices.device import Device
+
+
+class RecordingDevice(Device):
+    """
+    Stands in for the device that made (or is making) a recording, so that steps that
+    look up the device properties in `configure()` work the same way as in the live engine.
+    """
+    def __init__(self, device_props: Dict):
+        super(RecordingDevice, self).__init__()
+        self.device_props = device_props
+
+    def num_electrodes(self) -> int:
+        return self.device_props['numElectrodes']
+
+    def get_properties(self) -> Dict:
+        return self.device_props
@@ -2,8 +2,9 @@ import asyncio
 import logging
 import time
 import uuid
-from typing import List, Dict
+from typing import List, Dict, Optional
 
+from constants import EVENTS_STEP_NAME, STIMULUS_EVENT_KIND
 from devices.device import Device
 from devices.neuroprobe.neuroprobe_device import NeuroprobeDevice
 from devices.nwb_file.nwb_file_device import NwbFileDevice
@@ -12,11 +13,16 @@ from engine_step import EngineStep
 from devices.openmea.openmea_device import OpenMEADevice
 from stores.data_buffer import DataBuffer
 from openmea_module import OpenMEAModule, all_openmea_modules
+from sample_clock import SampleClock
 from util import electrode_name
 from websocket_streams import WebsocketStreams
 
 STEPS_PER_SEC = 120
 
+# Stimulus events are published once the samples at their time have come in, or this long
+# after their time if the samples don't come in.
+STIMULUS_EVENT_MAX_WAIT_SEC = 1
+
 
 class Engine:
     def __init__(self, stream_sender: WebsocketStreams, config: Dict):
@@ -30,6 +36,17 @@ class Engine:
         self.next_step_time = time.time() + 1 / STEPS_PER_SEC
         self.logger = logging.getLogger(__name__)
         self.device: Device = Device()
+        self.is_shut_down = False
+
+        # Events for the next step's 'events' result: {'kind', 'time', 'label'}, and for
+        # stimuli, the fields described with STIMULUS_EVENT_KIND.
+        self.pending_events: List[Dict] = []
+        self.is_stimulating = False
+
+        # Maps the times of the stimulus events that the device reports onto its samples.
+        # The events are usually reported ahead of time, and wait here until they're due.
+        self.sample_clock = SampleClock()
+        self.pending_stimulus_events: List[Dict] = []
 
         self.count = 0
 
@@ -41,6 +58,7 @@ class Engine:
             self.published_steps[electrode_name(i, 'dc')] = DataBuffer()
 
         self.published_steps['electrodes'] = EngineStep()
+        self.published_steps[EVENTS_STEP_NAME] = EngineStep()
 
         # Load the modules.
         # for openmea_module in all_openmea_modules:
@@ -56,10 +74,18 @@ class Engine:
         if updates is not None:
             if 'state' in updates and len(updates['state']) > 0:
                 message['deviceState'] = updates['state']
+                self.collect_device_events(updates['state'])
+
+            self.update_sample_clock(updates)
+            self.pending_stimulus_events += updates.get('stimulusEvents', [])
+            self.publish_due_stimulus_events()
 
         for key in self.published_steps.keys():
             self.published_steps[key].result = None
 
+        self.published_steps[EVENTS_STEP_NAME].result = self.pending_events
+        self.pending_events = []
+
         if 'was_reset' in updates and updates['was_reset']:
             if 'deviceState' not in message:
                 message['deviceState'] = []
@@ -77,6 +103,9 @@ class Engine:
                 else:
                     self.published_steps[electrode_name(i, 'dc')] = DataBuffer()
 
+            # The number of electrodes may have changed (e.g. when a new file was opened for replay).
+            self.update_subscribed_series()
+
         self.published_steps['electrodes'].result = updates['data']
 
         for key, data in updates['data'].items():
@@ -127,12 +156,130 @@ class Engine:
     def add_pipeline(self, steps: List[EngineStep]):
         pipeline = EnginePipeline(steps)
         self.pipelines_by_id[pipeline.id] = pipeline
+        self.update_subscribed_series()
 
         return pipeline.id
 
     def delete_pipeline(self, id):
         self.pipelines_by_id[id].finalize()
         del self.pipelines_by_id[id]
+        self.update_subscribed_series()
+
+    def update_subscribed_series(self):
+        """Let the device know which of the published electrode series are actually used by pipelines."""
+        used_steps = set()
+
+        for pipeline in self.pipelines_by_id.values():
+            for step in pipeline.steps:
+                used_steps.add(step)
+                used_steps.update(step.input_steps())
+
+        subscribed_series = set()
+
+        for name, step in self.published_steps.items():
+            if step not in used_steps:
+                continue
+
+            if name == EVENTS_STEP_NAME:
+                continue
+
+            if name == 'electrodes':
+                # Pipelines on 'electrodes' get all the series.
+                for i in range(self.device.num_electrodes()):
+                    subscribed_series.add(electrode_name(i, 'ac'))
+                    subscribed_series.add(electrode_name(i, 'dc'))
+            else:
+                subscribed_series.add(name)
+
+        self.device.set_subscribed_series(subscribed_series)
+
+    def add_event(self, kind: str, label: str = '', event_time: Optional[float] = None,
+                  fields: Optional[Dict] = None) -> Dict:
+        """Publish an event, with any other `fields`, in the 'events' step of the next engine step."""
+        event = {
+            'kind': kind,
+            'time': time.time() if event_time is None else event_time,
+            'label': label
+        }
+
+        if fields is not None:
+            event.update(fields)
+
+        self.pending_events.append(event)
+        return event
+
+    def update_sample_clock(self, updates: Dict):
+        if updates.get('was_reset', False):
+            self.sample_clock.reset()
+
+        # All the series of an update have the same samples. Which series there are depends
+        # on the device: a file device only emits the electrodes that are subscribed to.
+        data = updates.get('data', {})
+        num_samples = next((len(samples) for samples in data.values() if samples is not None), None)
+
+        if num_samples is not None:
+            self.sample_clock.add_samples(num_samples, time.time())
+
+    def publish_due_stimulus_events(self):
+        """
+        Publish the stimulus events whose samples have come in, with those samples, so that
+        steps see each stimulus in the same engine step as its samples.
+        """
+        now = time.time()
+        clock = self.sample_clock
+        published_events = []
+        waiting_events = []
+
+        for event in self.pending_stimulus_events:
+            sample = clock.sample_at(event['time']) if clock.is_running() else None
+            is_late = now - event['time'] > STIMULUS_EVENT_MAX_WAIT_SEC
+
+            if (sample is not None and sample < clock.num_samples) or is_late:
+                published_events.append(self.add_event(STIMULUS_EVENT_KIND, event['label'], event['time'], {
+                    'electrodes': event['electrodes'],
+                    'amplitude': event['amplitude'],
+                    'duration': event['duration'],
+                    'sample': sample
+                }))
+            else:
+                waiting_events.append(event)
+
+        self.pending_stimulus_events = waiting_events
+
+        if len(published_events) > 0:
+            self.device.record_events(published_events)
+
+    def collect_device_events(self, device_states: List[Dict]):
+        for state in device_states:
+            if 'samplesPerSec' in state:
+                self.sample_clock.set_samples_per_sec(state['samplesPerSec'])
+
+            if 'isStimulating' not in state:
+                continue
+
+            if state['isStimulating'] and not self.is_stimulating:
+                self.add_event('stimulation')
+
+            self.is_stimulating = state['isStimulating']
+
+    def shutdown(self):
+        """
+        Finish what the pipelines and the device are writing (recordings, raw captures), so
+        that the files are complete. Called before the process exits.
+        """
+        if self.is_shut_down:
+            return
+
+        self.is_shut_down = True
+
+        for pipeline in self.pipelines_by_id.values():
+            try:
+                pipeline.finalize()
+            except Exception as e:
+                self.logger.error(f'Could not finalize pipeline {pipeline.id}: {e}')
+
+        self.pipelines_by_id.clear()
+        self.device.close()
 
     def get_published_step(self, name: str):
         if name in self.published_steps:
@@ -180,7 +327,10 @@ class Engine:
 
         # Reset all data caches
         self.device = new_device_type(device_config)
+        self.sample_clock = SampleClock()
+        self.pending_stimulus_events = []
         self.initialize()
+        self.update_subscribed_series()
 
 
 class EngineException(Exception):
@@ -1,4 +1,5 @@
 import uuid
+from typing import List
 
 
 class EngineStepConfig:
@@ -20,5 +21,9 @@ class EngineStep:
     def after_step(self) -> None:
         pass
 
+    def input_steps(self) -> List['EngineStep']:
+        """Other steps that this step reads from, besides the previous step in its pipeline."""
+        return []
+
     def finalize(self) -> None:
         pass
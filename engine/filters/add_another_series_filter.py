@@ -1,4 +1,4 @@
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from engine_step import EngineStepConfig, EngineStep
 from stores.data_buffer import DataBuffer
@@ -37,6 +37,9 @@ class AddAnotherSeriesFilter(EngineStep):
         self.other_series_factor = config.other_series_factor
         self.other_series_engine_step = engine.get_published_step(config.other_series_name)
 
+    def input_steps(self) -> List[EngineStep]:
+        return [self.other_series_engine_step]
+
     def do_step(self, data_ndarray):
         if (data_ndarray is None) or (len(data_ndarray) == 0):
             self.result = None
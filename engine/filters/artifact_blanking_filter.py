@@ -0,0 +1,186 @@
+from typing import Dict, Optional
+
+import numpy as np
+
+from constants import EVENTS_STEP_NAME, STIMULUS_EVENT_KIND
+from engine_step import EngineStepConfig, EngineStep
+
+# How the samples around a stimulus are replaced. They aren't set to zero: the jump from the
+# signal to zero would make the filters after this step ring just like the artifact.
+#   * hold: with the last sample before the blank.
+#   * interpolate: with a straight line from the last sample before the blank to the first one after it.
+BLANKING_HOLD = 'hold'
+BLANKING_INTERPOLATE = 'interpolate'
+BLANKING_MODES = [BLANKING_HOLD, BLANKING_INTERPOLATE]
+
+DEFAULT_PRE_MS = 0.2
+DEFAULT_POST_MS = 2
+
+# Samples that come in farther than this from where the step expects them mean that the
+# device was reset, and the samples are counted from the sample clock again.
+MAX_CLOCK_SKEW_SEC = 0.1
+
+
+class ArtifactBlankingFilterConfig(EngineStepConfig):
+    @staticmethod
+    def from_json(json: Dict):
+        config = ArtifactBlankingFilterConfig()
+        config.samples_per_sec = json['samplesPerSec']
+        config.mode = json.get('mode', BLANKING_INTERPOLATE)
+        config.pre_ms = json.get('preMs', DEFAULT_PRE_MS)
+        config.post_ms = json.get('postMs', DEFAULT_POST_MS)
+
+        if config.mode not in BLANKING_MODES:
+            raise Exception(f'Unknown artifact blanking mode "{config.mode}"')
+
+        return config
+
+    def __init__(self):
+        super().__init__()
+        self.samples_per_sec = 0
+        self.mode = BLANKING_INTERPOLATE
+
+        # The blank around each stimulus starts this long before it and ends this long after it.
+        self.pre_ms = DEFAULT_PRE_MS
+        self.post_ms = DEFAULT_POST_MS
+
+
+class ArtifactBlankingFilter(EngineStep):
+    """
+    Replaces the samples around each stimulus of the engine's events step, so that the
+    stimulation artifacts don't reach the filters after this step. An artifact is much
+    larger than the signal, and an IIR filter (BandFilter, CombFilter) that gets one rings
+    for tens of milliseconds. The filters see no step at the blank either, so their state
+    carries over it as if there had been no stimulus.
+
+    The samples are passed on `preMs` late, so that a blank can start before a stimulus that
+    is published in the same engine step as its sample. In the interpolate mode, a blank is
+    also held back until the first sample after it has come in. The blanks of all the stimuli
+    of a step are applied at once, so pulse trains cost the same as single pulses.
+    """
+    name = 'ArtifactBlankingFilter'
+
+    def __init__(self):
+        super().__init__()
+        self.config: Optional[ArtifactBlankingFilterConfig] = None
+        self.events_step: Optional[EngineStep] = None
+        self.sample_clock = None
+        self.pre_samples = 0
+        self.post_samples = 0
+        self.max_skew_samples = 0
+
+        # The blanks, as [start, end) acquisition samples, that may still reach the samples to come.
+        self.blank_starts = np.zeros(0, dtype=np.int64)
+        self.blank_ends = np.zeros(0, dtype=np.int64)
+
+        # The samples that haven't been passed on yet, the acquisition sample of the first one
+        # (None before the first samples), and the last sample that was passed on.
+        self.pending = np.zeros(0)
+        self.pending_start: Optional[int] = None
+        self.last_value = 0.
+
+    def configure(self, config: ArtifactBlankingFilterConfig, engine):
+        self.config = config
+        self.events_step = engine.get_published_step(EVENTS_STEP_NAME)
+        self.sample_clock = engine.sample_clock
+        self.pre_samples = int(round(config.pre_ms / 1000 * config.samples_per_sec))
+        self.post_samples = int(round(config.post_ms / 1000 * config.samples_per_sec))
+        self.max_skew_samples = int(MAX_CLOCK_SKEW_SEC * config.samples_per_sec)
+
+    def input_steps(self):
+        return [self.events_step]
+
+    def do_step(self, data_ndarray):
+        self.add_blanks(self.events_step.result or [])
+
+        if data_ndarray is None or len(data_ndarray) == 0:
+            self.result = None
+            return
+
+        # The samples of this step are the last ones that the sample clock has counted.
+        data_start = self.sample_clock.num_samples - len(data_ndarray)
+        reset_output = None
+
+        if self.pending_start is None or \
+                abs(data_start - (self.pending_start + len(self.pending))) > self.max_skew_samples:
+            reset_output = self.pending
+            self.pending = np.zeros(0)
+            self.pending_start = data_start
+
+        self.pending = np.concatenate([self.pending, data_ndarray])
+        output = self.take_output()
+
+        if reset_output is not None:
+            output = np.concatenate([reset_output, output])
+
+        self.result = output if len(output) > 0 else None
+
+    def add_blanks(self, events):
+        samples = [event['sample'] for event in events
+                   if event['kind'] == STIMULUS_EVENT_KIND and event.get('sample') is not None]
+
+        if len(samples) > 0:
+            samples = np.array(samples, dtype=np.int64)
+            self.blank_starts = np.concatenate([self.blank_starts, samples - self.pre_samples])
+            self.blank_ends = np.concatenate([self.blank_ends, samples + self.post_samples])
+
+    def blank_mask(self, start: int, length: int) -> np.ndarray:
+        """Which of the `length` samples from acquisition sample `start` on are in a blank."""
+        starts = np.clip(self.blank_starts - start, 0, length)
+        ends = np.clip(self.blank_ends - start, 0, length)
+
+        # +1 where a blank starts and -1 where it ends. Overlapping blanks add up.
+        edges = np.zeros(length + 1, dtype=np.int64)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, ends, -1)
+
+        return np.cumsum(edges[:-1]) > 0
+
+    def take_output(self) -> np.ndarray:
+        """Blank the pending samples that can be passed on, and take them out of `pending`."""
+        pending = self.pending
+        pending_end = self.pending_start + len(pending)
+        mask = self.blank_mask(self.pending_start, len(pending))
+        num_output = max(len(pending) - self.pre_samples, 0)
+
+        if self.config.mode == BLANKING_INTERPOLATE:
+            # Wait for the end of the blanks that haven't ended yet, including all the blanks
+            # that they overlap with.
+            unfinished_starts = self.blank_starts[self.blank_ends >= pending_end]
+
+            if len(unfinished_starts) > 0:
+                num_output = max(min(num_output, unfinished_starts.min() - self.pending_start), 0)
+
+            if num_output > 0 and mask[num_output - 1]:
+                unblanked = np.flatnonzero(~mask[:num_output])
+                num_output = unblanked[-1] + 1 if len(unblanked) > 0 else 0
+
+        output = pending[:num_output].copy()
+        output_mask = mask[:num_output]
+
+        if output_mask.any():
+            if self.config.mode == BLANKING_HOLD:
+                positions = np.arange(num_output)
+                last_unblanked = np.maximum.accumulate(np.where(output_mask, -1, positions))
+                held = np.where(last_unblanked >= 0, pending[np.maximum(last_unblanked, 0)], self.last_value)
+                output[output_mask] = held[output_mask]
+
+            else:
+                # Samples after the output are also known, and bound the blanks that end in them.
+                unblanked = np.flatnonzero(~mask)
+                known_positions = np.concatenate([[-1], unblanked])
+                known_values = np.concatenate([[self.last_value], pending[unblanked]])
+                output[output_mask] = np.interp(np.flatnonzero(output_mask), known_positions, known_values)
+
+        if num_output > 0:
+            self.last_value = output[-1]
+
+        self.pending = pending[num_output:]
+        self.pending_start += num_output
+
+        # Forget the blanks that are over.
+        is_current = self.blank_ends > self.pending_start
+        self.blank_starts = self.blank_starts[is_current]
+        self.blank_ends = self.blank_ends[is_current]
+
+        return output
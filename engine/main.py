@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import platform
+import signal
 import sys
 import os
 from pathlib import Path
@@ -23,14 +24,11 @@ from websocket_streams import WebsocketStreams
 from module_loader import load_openmea_modules
 
 
-async def main():
-    # If this process was started by the UI process, we will have to make
-    # sure that this process ends even if the parent process got killed and
-    # never got a chance to terminate this process.
-    if len(sys.argv) > 1 and platform.system() == 'Linux':
-        parent_pid = int(sys.argv[1].replace('"', '').replace("'", ''))
-        asyncio.ensure_future(quit_when_parent_quits(parent_pid))
+# Signals that end the engine process. The ones that the platform doesn't have are skipped.
+SHUTDOWN_SIGNALS = ['SIGTERM', 'SIGINT', 'SIGHUP', 'SIGBREAK']
 
+
+async def main():
     load_openmea_modules()
     config = load_config()
 
@@ -40,6 +38,15 @@ async def main():
     engine = Engine(websocket_streams, config)
     await setup_server(app, engine)
 
+    # If this process was started by the UI process, we will have to make
+    # sure that this process ends even if the parent process got killed and
+    # never got a chance to terminate this process.
+    if len(sys.argv) > 1 and platform.system() == 'Linux':
+        parent_pid = int(sys.argv[1].replace('"', '').replace("'", ''))
+        asyncio.ensure_future(quit_when_parent_quits(parent_pid, engine))
+
+    install_shutdown_handlers(engine)
+
     # Start the webserver
     runner = web.AppRunner(app)
     await runner.setup()
@@ -51,13 +58,38 @@ async def main():
     await engine.run()
 
 
-async def quit_when_parent_quits(parent_pid):
+async def quit_when_parent_quits(parent_pid, engine: Engine):
     while True:
         await asyncio.sleep(1)
         if parent_pid not in psutil.pids():
+            # Finish the recordings first; os.abort() doesn't run any cleanup.
+            engine.shutdown()
             os.abort()
 
 
+def install_shutdown_handlers(engine: Engine):
+    """Close the recordings properly when the process is asked to end, e.g. on Ctrl+C or when the UI quits."""
+    loop = asyncio.get_event_loop()
+
+    def shutdown():
+        logging.getLogger(__name__).info('Shutting down')
+        engine.shutdown()
+        loop.stop()
+
+    for signal_name in SHUTDOWN_SIGNALS:
+        if not hasattr(signal, signal_name):
+            continue
+
+        signal_num = getattr(signal, signal_name)
+
+        try:
+            # Runs the shutdown in the event loop, between engine steps.
+            loop.add_signal_handler(signal_num, shutdown)
+        except NotImplementedError:
+            # Windows event loops don't support signal handlers.
+            signal.signal(signal_num, lambda *_: loop.call_soon_threadsafe(shutdown))
+
+
 def load_config():
     if os.path.isfile('config.yml'):
         return yaml.safe_load(Path('config.yml').read_text())
@@ -0,0 +1,156 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from typing import List, Tuple
+
+import h5py
+import numpy as np
+
+# Same as in main.py: embeddable Python doesn't support PYTHONPATH, so make sure
+# that the local packages and modules can be imported.
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+if scriptdir not in sys.path:
+    sys.path.insert(0, scriptdir)
+
+from devices.nwb_file.nwb_file_reader import NwbFileReader
+from sources_and_sinks.nwb_file_writer import CONSISTENT_SAMPLES_ATTR, is_segment_manifest, write_segment_manifest
+
+# Trailing samples that were never written are looked for in blocks of this many samples.
+SCAN_BLOCK_SAMPLES = 65_536
+
+
+def count_trailing_fill(dataset: h5py.Dataset, num_samples: int) -> int:
+    """
+    Count the samples at the end of a float dataset that are all NaN, the fill value of
+    NwbFileWriter. That is what the file has where it was resized, but the samples never
+    reached it. Integer datasets can't tell missing samples apart, so they're not scanned.
+    """
+    if dataset.dtype.kind != 'f':
+        return 0
+
+    num_trailing = 0
+
+    while num_trailing < num_samples:
+        block_to = num_samples - num_trailing
+        block_from = max(block_to - SCAN_BLOCK_SAMPLES, 0)
+        block = dataset[block_from:block_to]
+        is_written = ~np.isnan(block).reshape((len(block), -1)).all(axis=1)
+
+        if is_written.any():
+            return num_trailing + (len(block) - 1 - int(np.flatnonzero(is_written)[-1]))
+
+        num_trailing += len(block)
+
+    return num_trailing
+
+
+def recover_file(file_path: str, dry_run: bool = False) -> Tuple[int, int]:
+    """
+    Truncate all the time series of a recording to the last sample that all of them have
+    fully written. Returns the number of samples kept, and how many were cut off the
+    longest series.
+    """
+    with h5py.File(file_path, 'r' if dry_run else 'r+') as h5_file:
+        datasets: List[h5py.Dataset] = [series['data'] for series in h5_file['acquisition'].values()
+                                        if isinstance(series, h5py.Group) and 'data' in series]
+
+        if len(datasets) == 0:
+            raise Exception(f'{file_path} has no time series')
+
+        lengths = [len(dataset) for dataset in datasets]
+        num_samples = min(lengths)
+
+        if CONSISTENT_SAMPLES_ATTR in h5_file.attrs:
+            num_samples = min(num_samples, int(h5_file.attrs[CONSISTENT_SAMPLES_ATTR]))
+        else:
+            # Recorded before the writer kept track of it. Go by the samples themselves.
+            num_samples -= max(count_trailing_fill(dataset, num_samples) for dataset in datasets)
+
+        num_cut_off = max(lengths) - num_samples
+
+        if not dry_run:
+            for dataset in datasets:
+                if len(dataset) > num_samples:
+                    dataset.resize((num_samples,) + dataset.shape[1:])
+
+            h5_file.attrs[CONSISTENT_SAMPLES_ATTR] = num_samples
+
+    return num_samples, num_cut_off
+
+
+def recover_segmented_recording(manifest_path: str, dry_run: bool = False) -> int:
+    """
+    Recover each segment of a rotated recording, and bring the manifest up to date. Segments
+    after one that can't be opened at all are left out of the manifest, but not deleted.
+    """
+    log = logging.getLogger(__name__)
+
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    directory = os.path.dirname(manifest_path)
+    segments = []
+    start_sample = 0
+
+    for segment in manifest['segments']:
+        segment_path = os.path.join(directory, segment['file'])
+
+        try:
+            num_samples, num_cut_off = recover_file(segment_path, dry_run)
+        except Exception as e:
+            log.error(f'Could not recover {segment_path}, leaving it and the segments after it out: {e}')
+            break
+
+        log.info(f'{segment["file"]}: {num_samples} samples, cut off {num_cut_off}')
+        segments.append({'file': segment['file'], 'startSample': start_sample, 'numSamples': num_samples})
+        start_sample += num_samples
+
+    manifest['segments'] = segments
+
+    if not dry_run:
+        write_segment_manifest(manifest_path, manifest)
+
+    return start_sample
+
+
+def recover_recording(file_path: str, dry_run: bool = False) -> int:
+    """Recover a recording (an NWB file, or the manifest of a rotated one) after a crash. Returns its length in samples."""
+    log = logging.getLogger(__name__)
+
+    if is_segment_manifest(file_path):
+        return recover_segmented_recording(file_path, dry_run)
+
+    num_samples, num_cut_off = recover_file(file_path, dry_run)
+    log.info(f'{os.path.basename(file_path)}: {num_samples} samples, cut off {num_cut_off}')
+
+    if not dry_run:
+        # Make sure that the replay can open it now.
+        NwbFileReader(file_path).close()
+
+    return num_samples
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Repair an NWB recording that was cut short by a crash, by truncating it to '
+                    'the last sample that all the electrodes have fully written.')
+
+    parser.add_argument('recording', help='NWB file, or the .manifest.json of a rotated recording')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be cut off')
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    log = logging.getLogger(__name__)
+
+    num_samples = recover_recording(args.recording, args.dry_run)
+    log.info(f'{args.recording}: {num_samples} samples{" (dry run)" if args.dry_run else ""}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
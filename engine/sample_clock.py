@@ -0,0 +1,73 @@
+from collections import deque
+from typing import Optional
+
+# The clock offset is estimated from the steps of the last this many seconds, so that
+# it follows slow drift between the device clock and the computer clock.
+CLOCK_WINDOW_SEC = 10
+
+# Without a known sampling rate, it's estimated once the steps span at least this long.
+MIN_RATE_ESTIMATE_SEC = 1
+
+
+class SampleClock:
+    """
+    Maps wall clock times (time.time()) onto the acquisition sample clock: the index of
+    the sample, counted since the device was (re)set, that was acquired at that time.
+
+    Sample n was acquired at about start_time + n / samples_per_sec. Each engine step only
+    gives an upper bound of that: the samples that have arrived by now were acquired
+    before now. The step that arrived with the least delay gives the tightest bound, so
+    `start_time` is the earliest of the bounds within the window.
+    """
+    def __init__(self):
+        self.num_samples = 0
+        self.samples_per_sec: Optional[float] = None
+
+        # (arrival time, number of samples that had arrived by then)
+        self.arrivals = deque()
+
+    def reset(self):
+        self.num_samples = 0
+        self.arrivals.clear()
+
+    def set_samples_per_sec(self, samples_per_sec: float):
+        if samples_per_sec != self.samples_per_sec:
+            self.samples_per_sec = samples_per_sec
+            self.arrivals.clear()
+
+    def add_samples(self, num_samples: int, arrival_time: float):
+        if num_samples == 0:
+            return
+
+        self.num_samples += num_samples
+        self.arrivals.append((arrival_time, self.num_samples))
+
+        while arrival_time - self.arrivals[0][0] > CLOCK_WINDOW_SEC:
+            self.arrivals.popleft()
+
+    def rate(self) -> Optional[float]:
+        if self.samples_per_sec is not None:
+            return self.samples_per_sec
+
+        first_time, first_samples = self.arrivals[0]
+        last_time, last_samples = self.arrivals[-1]
+
+        if last_time - first_time < MIN_RATE_ESTIMATE_SEC:
+            return None
+
+        return (last_samples - first_samples) / (last_time - first_time)
+
+    def is_running(self) -> bool:
+        return len(self.arrivals) > 0 and self.rate() is not None
+
+    def start_time(self) -> float:
+        rate = self.rate()
+        return min(arrival_time - num_samples / rate for arrival_time, num_samples in self.arrivals)
+
+    def sample_at(self, wall_time: float) -> int:
+        """The sample acquired at `wall_time`. Only valid while the clock is running."""
+        return int(round((wall_time - self.start_time()) * self.rate()))
+
+    def time_of(self, sample: int) -> float:
+        """The wall clock time at which `sample` was acquired. Only valid while the clock is running."""
+        return self.start_time() + sample / self.rate()
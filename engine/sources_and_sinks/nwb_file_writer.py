@@ -1,25 +1,296 @@
-import _thread
 import json
+import logging
+import queue
+import threading
 import time
 from datetime import datetime
 import os
 from pathlib import Path
 from typing import Dict, Optional, List, Any
 
+import h5py
 import numpy as np
 from dateutil.tz import tzlocal
 from hdmf.backends.hdf5 import H5DataIO
 from pynwb import NWBFile, NWBHDF5IO
 from pynwb.ecephys import ElectricalSeries
+from pynwb.epoch import TimeIntervals
 
+from constants import EVENTS_STEP_NAME, STIMULUS_EVENT_KIND
 from engine_step import EngineStepConfig, EngineStep
 
+# hdf5plugin is optional. When it's installed, importing it registers more compression
+# filters with HDF5 (Zstd, LZ4, Blosc, ...).
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
 # Larger buffers cause UI pauses during writes. As the buffers get smaller,
 # the pauses get smaller, but only up to a point.
 from util import electrode_name
 
 BUFFER_SIZE = 262_144  # = 10 ^ 15, or 1/4 MB for 32-bit float per channel.
 
+# Number of full chunks that may wait for the writer thread. When the disk can't
+# keep up, do_step() blocks instead of buffering an unbounded amount of data.
+WRITE_QUEUE_SIZE = 8
+
+# How often the writer thread logs its queue depth and write latency.
+WRITE_STATS_INTERVAL_SEC = 30
+
+# How often the buffered samples are written to the file even if the buffers aren't
+# full yet. Bounds what is lost if the engine process dies in the middle of a recording.
+DEFAULT_FLUSH_INTERVAL_SEC = 5
+
+# Root attribute of the recording files with the number of samples that all the series
+# have, as of the last write that has fully reached the file. Everything beyond it may
+# be incomplete after a crash; see recover_recording.py.
+CONSISTENT_SAMPLES_ATTR = 'openmea_consistent_samples'
+
+# Storage layouts of the samples in the file:
+#   * per_electrode: one 1-D time series for each electrode, and for AC and DC.
+#   * matrix: one 2-D (samples, electrodes) time series for AC and another for DC.
+#     Each write to the file is one large operation, and reading a time range of
+#     all the electrodes only touches a few HDF5 chunks.
+LAYOUT_PER_ELECTRODE = 'per_electrode'
+LAYOUT_MATRIX = 'matrix'
+LAYOUTS = [LAYOUT_PER_ELECTRODE, LAYOUT_MATRIX]
+
+# HDF5 chunks in the matrix layout span this many samples of all the electrodes.
+MATRIX_CHUNK_SAMPLES = 8192
+
+# Electrodes may be a few samples ahead of each other. The matrix buffer has room
+# for that many extra samples beyond a full write, and grows if that's not enough.
+MATRIX_BUFFER_SLACK = 65_536
+
+# Compression of the samples. 'none', 'lzf' and 'gzip' are always available; the
+# hdf5plugin filters only when it's installed. Any other HDF5 filter that is registered
+# locally can be used by its numeric filter ID.
+COMPRESSION_NONE = 'none'
+COMPRESSION_LZF = 'lzf'
+COMPRESSION_GZIP = 'gzip'
+DEFAULT_COMPRESSION = COMPRESSION_GZIP
+DEFAULT_COMPRESSION_LEVEL = 4
+
+PLUGIN_COMPRESSIONS = {
+    'zstd': lambda level: hdf5plugin.Zstd(clevel=level),
+    'lz4': lambda level: hdf5plugin.LZ4(),
+    'blosc-lz4': lambda level: hdf5plugin.Blosc(cname='lz4', clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE),
+    'blosc-zstd': lambda level: hdf5plugin.Blosc(cname='zstd', clevel=level, shuffle=hdf5plugin.Blosc.SHUFFLE),
+    'bitshuffle-lz4': lambda level: hdf5plugin.Bitshuffle(),
+}
+
+# Formats of the stored samples:
+#   * float32: the samples in volts, as they come from the device.
+#   * uint16: the original ADC codes. Takes half the space, and compresses much better.
+#     The time series have the conversion and offset needed to get back to volts.
+SAMPLE_FORMAT_FLOAT32 = 'float32'
+SAMPLE_FORMAT_UINT16 = 'uint16'
+SAMPLE_FORMATS = [SAMPLE_FORMAT_FLOAT32, SAMPLE_FORMAT_UINT16]
+
+# What is recorded:
+#   * continuous: all the samples of all the electrodes.
+#   * spikes: only the detected spikes, as timestamps and short waveform snippets of each
+#     electrode, and optionally a downsampled LFP. See SpikeEventNwbFileWriter.
+MODE_CONTINUOUS = 'continuous'
+MODE_SPIKES = 'spikes'
+MODES = [MODE_CONTINUOUS, MODE_SPIKES]
+
+# Spike detection defaults of the spikes mode. The threshold is in multiples of the noise
+# level of the high-pass filtered signal, and the snippets span the given time before and
+# after the trough of each spike.
+DEFAULT_SPIKE_THRESHOLD_STD = 5
+DEFAULT_SPIKE_HIGH_PASS_HZ = 300
+DEFAULT_SPIKE_PRE_MS = 0.5
+DEFAULT_SPIKE_POST_MS = 1.0
+
+# With rotation, the recording is split into segment files next to `filePath`
+# (name_0001.nwb, name_0002.nwb, ...), and a manifest (name.manifest.json) lists
+# the segments in order. Consecutive segments continue each other without a gap.
+SEGMENT_MANIFEST_SUFFIX = '.manifest.json'
+SEGMENT_MANIFEST_VERSION = 1
+
+# The stimulus events of a recording are stored in a TimeIntervals table with this name.
+STIMULATION_INTERVALS_NAME = 'stimulation'
+
+
+def matrix_series_name(kind: str) -> str:
+    """Name of the time series with the `kind` ('ac' or 'dc') samples of all electrodes in the matrix layout."""
+    return f'electrodes.{kind}'
+
+
+def segment_file_path(file_path: str, segment_num: int) -> str:
+    stem, extension = os.path.splitext(file_path)
+    return f'{stem}_{segment_num:04d}{extension}'
+
+
+def segment_manifest_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + SEGMENT_MANIFEST_SUFFIX
+
+
+def is_segment_manifest(file_path: str) -> bool:
+    return file_path.endswith(SEGMENT_MANIFEST_SUFFIX)
+
+
+def write_segment_manifest(manifest_path: str, manifest: Dict):
+    # Replace the manifest in one go, so that readers never see a half-written one.
+    temp_path = manifest_path + '.tmp'
+
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.replace(temp_path, manifest_path)
+
+
+def make_nwb_file(file_path: str, device_props: Dict, num_electrodes: int) -> NWBFile:
+    """Create the NWB file metadata: the device, with its properties in the notes, and the electrodes."""
+    file_name = os.path.basename(file_path)
+    notes = json.dumps(device_props)
+    nwb_file = NWBFile(file_name, file_name, datetime.now(tzlocal()), notes=notes)
+
+    device_name = device_props['name']
+    device = nwb_file.create_device(name=device_name)
+    electrode_group = nwb_file.create_electrode_group(device_name,
+                                                      description='',
+                                                      location='',
+                                                      device=device)
+
+    for i in range(num_electrodes):
+        nwb_file.add_electrode(i * 1., 0., 0., 1., '', '', electrode_group, id=i)
+
+    return nwb_file
+
+
+def write_new_nwb_file(nwb_file: NWBFile, file_path: str):
+    """Write the NWB file with its (still empty) time series. Remove any existing files."""
+    existing_file = Path(file_path)
+
+    if existing_file.exists():
+        if not existing_file.is_file():
+            raise Exception(f'{file_path} is not a file')
+
+        os.remove(file_path)
+
+    file_io = NWBHDF5IO(file_path, 'w')
+    file_io.write(nwb_file)
+    file_io.close()
+
+
+def stimulus_events_of(events: List[Dict]) -> List[Dict]:
+    """The events of the engine's events step that can be stored: stimuli with a sample."""
+    return [event for event in events if event['kind'] == STIMULUS_EVENT_KIND and event.get('sample') is not None]
+
+
+def recording_start_sample(config: 'NwbFileWriterConfig', engine) -> int:
+    """The acquisition sample that the first recorded sample is."""
+    if config.start_sample is not None:
+        return config.start_sample
+
+    # Pipelines get the samples from the step after they were added on.
+    return engine.sample_clock.num_samples
+
+
+def write_stimulus_intervals(file_path: str,
+                             events: List[Dict],
+                             first_sample: int,
+                             num_samples: int,
+                             start_time: float,
+                             samples_per_sec: float):
+    """
+    Add the stimulus events of the samples that a recording file has to it, as a TimeIntervals
+    table. The file has `num_samples` samples from acquisition sample `first_sample` on, and
+    its series start at `start_time`. The intervals are in the same clock, and their 'sample'
+    is where the stimulus starts in the series of the file.
+    """
+    file_events = [event for event in events if first_sample <= event['sample'] < first_sample + num_samples]
+
+    if len(file_events) == 0:
+        return
+
+    file_io = NWBHDF5IO(file_path, 'a')
+
+    try:
+        nwb_file = file_io.read()
+        intervals = TimeIntervals(STIMULATION_INTERVALS_NAME, 'Stimuli delivered during the recording')
+        intervals.add_column('sample', 'First sample of the stimulus in the time series')
+        intervals.add_column('electrodes', 'Stimulated electrodes', index=True)
+        intervals.add_column('amplitude', 'Peak stimulation current, in amps')
+        intervals.add_column('label', 'Pulse type or stimulation file')
+
+        for event in file_events:
+            sample = event['sample'] - first_sample
+            event_start_time = start_time + sample / samples_per_sec
+
+            intervals.add_interval(event_start_time,
+                                   event_start_time + event['duration'],
+                                   sample=sample,
+                                   electrodes=event['electrodes'],
+                                   amplitude=float(event['amplitude']),
+                                   label=event['label'])
+
+        nwb_file.add_time_intervals(intervals)
+        file_io.write(nwb_file)
+
+    finally:
+        file_io.close()
+
+
+def compression_args(compression, level: int) -> Dict:
+    """Translate the compression config into H5DataIO arguments."""
+    if compression == COMPRESSION_NONE:
+        return {}
+
+    if compression == COMPRESSION_LZF:
+        return {'compression': COMPRESSION_LZF}
+
+    if compression == COMPRESSION_GZIP:
+        return {'compression': COMPRESSION_GZIP, 'compression_opts': level}
+
+    if compression in PLUGIN_COMPRESSIONS:
+        if hdf5plugin is None:
+            raise Exception(f'Compression "{compression}" needs the hdf5plugin package')
+
+        plugin_filter = PLUGIN_COMPRESSIONS[compression](level)
+
+        return {'compression': plugin_filter['compression'],
+                'compression_opts': tuple(plugin_filter['compression_opts']),
+                'allow_plugin_filters': True}
+
+    if isinstance(compression, int) and not isinstance(compression, bool):
+        if not h5py.h5z.filter_avail(compression):
+            raise Exception(f'HDF5 filter {compression} is not available')
+
+        return {'compression': compression, 'allow_plugin_filters': True}
+
+    raise Exception(f'Unknown compression "{compression}"')
+
+
+def available_compressions() -> List[str]:
+    compressions = [COMPRESSION_NONE, COMPRESSION_LZF, COMPRESSION_GZIP]
+
+    if hdf5plugin is not None:
+        compressions += PLUGIN_COMPRESSIONS.keys()
+
+    return compressions
+
+
+def make_chunk_stream(chunks: tuple, config: 'NwbFileWriterConfig') -> H5DataIO:
+    dtype = config.sample_format
+
+    return H5DataIO(data=np.empty(shape=(0,) + chunks[1:], dtype=dtype),
+                    maxshape=(None,) + chunks[1:],
+                    chunks=chunks,
+                    shuffle=config.shuffle,
+                    fillvalue=np.nan if dtype == SAMPLE_FORMAT_FLOAT32 else 0,
+                    **compression_args(config.compression, config.compression_level))
+
+
+def encode_samples(samples: np.ndarray, offset: float, conversion: float) -> np.ndarray:
+    """Turn samples in volts back into the ADC codes, where volts = (code + offset) * conversion."""
+    codes = np.rint(samples / conversion - offset)
+    return np.clip(codes, 0, np.iinfo(np.uint16).max).astype(np.uint16)
+
 
 class NwbFileWriterConfig(EngineStepConfig):
     @staticmethod
@@ -32,17 +303,90 @@ class NwbFileWriterConfig(EngineStepConfig):
         config.conversion = json['conversion']
         config.samples_per_sec = json['samplesPerSec']
         config.num_electrodes = json['numElectrodes']
+        config.layout = json.get('layout', LAYOUT_PER_ELECTRODE)
+        config.sample_format = json.get('sampleFormat', SAMPLE_FORMAT_FLOAT32)
+        config.dc_offset = json.get('dcOffset', 0)
+        config.dc_conversion = json.get('dcConversion', 1)
+        config.compression = json.get('compression', DEFAULT_COMPRESSION)
+        config.compression_level = json.get('compressionLevel', DEFAULT_COMPRESSION_LEVEL)
+        config.shuffle = json.get('shuffle', True)
+        config.chunk_samples = json.get('chunkSamples', None)
+        config.rotate_minutes = json.get('rotateMinutes', None)
+        config.rotate_gb = json.get('rotateGB', None)
+        config.flush_interval_sec = json.get('flushIntervalSec', DEFAULT_FLUSH_INTERVAL_SEC)
+        config.mode = json.get('mode', MODE_CONTINUOUS)
+        config.spike_threshold_std = json.get('spikeThresholdStd', DEFAULT_SPIKE_THRESHOLD_STD)
+        config.spike_high_pass_hz = json.get('spikeHighPassHz', DEFAULT_SPIKE_HIGH_PASS_HZ)
+        config.spike_pre_ms = json.get('spikePreMs', DEFAULT_SPIKE_PRE_MS)
+        config.spike_post_ms = json.get('spikePostMs', DEFAULT_SPIKE_POST_MS)
+        config.lfp_samples_per_sec = json.get('lfpSamplesPerSec', None)
+        config.start_sample = json.get('startSample', None)
+
+        if config.layout not in LAYOUTS:
+            raise Exception(f'Unknown NWB file layout "{config.layout}"')
+
+        if config.sample_format not in SAMPLE_FORMATS:
+            raise Exception(f'Unknown NWB sample format "{config.sample_format}"')
+
+        if config.mode not in MODES:
+            raise Exception(f'Unknown NWB recording mode "{config.mode}"')
+
+        if config.mode == MODE_SPIKES and config.rotates():
+            raise Exception('Spike recordings can not be rotated')
+
+        # Fail early, rather than when the recording starts.
+        compression_args(config.compression, config.compression_level)
 
         return config
 
     def __init__(self):
         super().__init__()
         self.file_path: str = ""
+        # Volts = (ADC code + offset) * conversion. Only used with the uint16 sample format.
         self.offset = 0
         self.resolution = 0
         self.conversion = 1
         self.samples_per_sec = 0
         self.num_electrodes = 0
+        self.layout = LAYOUT_PER_ELECTRODE
+        self.sample_format = SAMPLE_FORMAT_FLOAT32
+
+        # Same as `offset` and `conversion`, but for the DC samples.
+        self.dc_offset = 0
+        self.dc_conversion = 1
+
+        self.compression = DEFAULT_COMPRESSION
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        self.shuffle = True
+
+        # Length of the HDF5 chunks, in samples. None means the default of the layout.
+        self.chunk_samples: Optional[int] = None
+
+        # Start a new segment file after this many minutes of samples, or once the
+        # segment file has grown to this many GB. None means no limit.
+        self.rotate_minutes: Optional[float] = None
+        self.rotate_gb: Optional[float] = None
+
+        # Samples that wait in the buffers are written at least this often, even if the
+        # buffers aren't full, so that a crash loses at most this many seconds. None means
+        # that only full buffers are written.
+        self.flush_interval_sec: Optional[float] = DEFAULT_FLUSH_INTERVAL_SEC
+
+        # Used by the spikes mode only. The LFP is recorded at about this rate
+        # (an integer fraction of the sampling rate), or not at all if None.
+        self.mode = MODE_CONTINUOUS
+        self.spike_threshold_std = DEFAULT_SPIKE_THRESHOLD_STD
+        self.spike_high_pass_hz = DEFAULT_SPIKE_HIGH_PASS_HZ
+        self.spike_pre_ms = DEFAULT_SPIKE_PRE_MS
+        self.spike_post_ms = DEFAULT_SPIKE_POST_MS
+        self.lfp_samples_per_sec: Optional[float] = None
+
+        # The acquisition sample (see SampleClock) that the first recorded sample is. None
+        # means the next sample that the engine gets, which is right for pipeline steps.
+        self.start_sample: Optional[int] = None
+
+    def rotates(self) -> bool:
+        return self.rotate_minutes is not None or self.rotate_gb is not None
 
 
 class NwbFileWriter(EngineStep):
@@ -53,66 +397,222 @@ class NwbFileWriter(EngineStep):
         self.config: Optional[NwbFileWriterConfig] = None
 
         self.nwb_file = None
-        self.time_series_data = None
-        self.file_io = None
-        self.chunk_streams = []
         self.samples_written_per_series = []
         self.buffers_ac = []
         self.buffers_dc = []
         self.buffer_space_used = []
         self.num_electrodes = 0
         self.can_sample_dc = False
+        self.device_props: Dict = dict()
+        self.series_start_time = 0.
+        self.h5_file: Optional[h5py.File] = None
+        self.datasets_ac: List[h5py.Dataset] = []
+        self.datasets_dc: List[h5py.Dataset] = []
+
+        # Used by the matrix layout only. Each electrode has its own column in the buffers,
+        # filled up to matrix_rows_used[i].
+        self.matrix_buffer_ac: Optional[np.ndarray] = None
+        self.matrix_buffer_dc: Optional[np.ndarray] = None
+        self.matrix_rows_used: List[int] = []
+        self.matrix_rows_written = 0
+        self.write_queue: Optional[queue.Queue] = None
+        self.write_thread: Optional[threading.Thread] = None
+        self.flushed_at = 0.
+
+        # Rotation. The engine thread decides when to start a new segment; the file that is
+        # open, and the manifest, belong to the writer thread.
+        self.segment_num = 0
+        self.segment_samples_received = 0
+        self.segment_samples_handed_off: List[int] = []
+        self.segment_has_writes = False
+        self.rotate_samples: Optional[int] = None
+        self.rotate_bytes: Optional[int] = None
+        self.segment_path = ''
+        self.segment_start_sample = 0
+        self.manifest: Optional[Dict] = None
+
+        # Samples of the per-electrode layout that were written past the end of the previous
+        # segment, and go to the start of the next one instead.
+        self.carried_over_ac: List[Optional[np.ndarray]] = []
+        self.carried_over_dc: List[Optional[np.ndarray]] = []
+
+        # The stimulus events of the recording, which are added to the files once they're complete.
+        # They come from the engine's events step, or from add_stimulus_events().
+        self.events_step: Optional[EngineStep] = None
+        self.stimulus_events: List[Dict] = []
+        self.start_sample = 0
+
+        self.log = logging.getLogger(__name__)
 
     def configure(self, config: NwbFileWriterConfig, engine):
         self.config = config
 
-        device_props = engine.device.get_properties()
-        device_name = device_props['name']
-        self.num_electrodes = device_props['numElectrodes']
-        self.can_sample_dc = device_props['canSampleDC']
+        self.device_props = engine.device.get_properties()
+        self.num_electrodes = self.device_props['numElectrodes']
+        self.can_sample_dc = self.device_props['canSampleDC']
+        self.series_start_time = time.time()
+        self.flushed_at = self.series_start_time
+        self.start_sample = recording_start_sample(config, engine)
+        self.events_step = engine.published_steps.get(EVENTS_STEP_NAME)
 
-        file_name = os.path.basename(config.file_path)
-        notes = json.dumps(device_props)
-        self.nwb_file = NWBFile(file_name, file_name, datetime.now(tzlocal()), notes=notes)
+        if config.layout == LAYOUT_MATRIX:
+            self.init_matrix_buffers()
+        else:
+            self.init_per_electrode_buffers()
 
-        # Initialize data chunk streams. The code in do_step() will write to these.
-        self.buffers_ac = []
-        self.buffers_dc = []
+        self.segment_samples_handed_off = [0 for _ in range(config.num_electrodes)]
 
-        for i in range(config.num_electrodes):
-            chunk_stream = H5DataIO(data=np.empty(shape=(0,), dtype='f4'),
-                                    maxshape=(None,),
-                                    chunks=(BUFFER_SIZE,),
-                                    compression='gzip',
-                                    compression_opts=4,
-                                    shuffle=True,
-                                    fillvalue=np.nan)
-            self.chunk_streams.append(chunk_stream)
-
-            self.buffers_ac.append(np.zeros(BUFFER_SIZE, 'f4'))
-            self.buffers_dc.append(np.zeros(BUFFER_SIZE, 'f4'))
+        if config.rotates():
+            if config.rotate_minutes is not None:
+                self.rotate_samples = int(config.rotate_minutes * 60 * config.samples_per_sec)
+
+            if config.rotate_gb is not None:
+                self.rotate_bytes = int(config.rotate_gb * 1e9)
+
+            self.segment_num = 1
+            self.manifest = {
+                'version': SEGMENT_MANIFEST_VERSION,
+                'samplesPerSec': config.samples_per_sec,
+                'numElectrodes': config.num_electrodes,
+                'startTime': self.series_start_time,
+                'segments': []
+            }
+            self.open_segment(segment_file_path(config.file_path, self.segment_num))
+        else:
+            self.open_segment(config.file_path)
+
+        self.write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.write_thread = threading.Thread(target=self.run_write_thread, name='nwb-writer', daemon=True)
+        self.write_thread.start()
+
+    def init_per_electrode_buffers(self):
+        # The code in do_step() will write to these.
+        self.buffers_ac = [np.zeros(BUFFER_SIZE, 'f4') for _ in range(self.config.num_electrodes)]
+        self.buffers_dc = [np.zeros(BUFFER_SIZE, 'f4') for _ in range(self.config.num_electrodes)]
+        self.buffer_space_used = [0 for _ in range(self.config.num_electrodes)]
+
+    def init_matrix_buffers(self):
+        buffer_rows = BUFFER_SIZE + MATRIX_BUFFER_SLACK
+        num_electrodes = self.config.num_electrodes
+        self.matrix_buffer_ac = np.zeros((buffer_rows, num_electrodes), 'f4')
+        self.matrix_buffer_dc = np.zeros((buffer_rows, num_electrodes), 'f4') if self.can_sample_dc else None
+        self.matrix_rows_used = [0 for _ in range(num_electrodes)]
+
+    def open_segment(self, file_path: str):
+        """
+        Create the NWB file that the samples are written to next. Without rotation this is
+        only called once; with rotation, on the writer thread at each segment boundary.
+        """
+        config = self.config
+        self.segment_path = file_path
+        self.nwb_file = make_nwb_file(file_path, self.device_props, config.num_electrodes)
+
+        # Each segment starts exactly where the previous one has ended.
+        series_start_time = self.series_start_time + self.segment_start_sample / config.samples_per_sec
+
+        if config.layout == LAYOUT_MATRIX:
+            self.add_matrix_time_series(series_start_time)
+        else:
+            self.add_per_electrode_time_series(series_start_time)
+
+        write_new_nwb_file(self.nwb_file, file_path)
+
+        # Keep the datasets of the time series open for the rest of the recording, so
+        # that the writes don't have to open and parse the NWB file every time.
+        self.h5_file = h5py.File(file_path, 'a')
+        acquisition = self.h5_file['acquisition']
+
+        if config.sample_format == SAMPLE_FORMAT_UINT16:
+            # pynwb 2.0 doesn't know about the offset of time series yet (it came with
+            # NWB 2.4), so it's added here, in volts, the same way as newer versions store it.
+            for series_name, series_group in acquisition.items():
+                kind = series_name.split('.')[-1]
+                offset, conversion = self.get_rescaling(kind)
+                series_group['data'].attrs['offset'] = float(offset * conversion)
+
+        if config.layout == LAYOUT_MATRIX:
+            self.datasets_ac = [acquisition[matrix_series_name('ac')]['data']]
+            self.datasets_dc = [acquisition[matrix_series_name('dc')]['data']] if self.can_sample_dc else []
+        else:
+            self.datasets_ac = [acquisition[electrode_name(i, 'ac')]['data'] for i in range(config.num_electrodes)]
+            self.datasets_dc = [acquisition[electrode_name(i, 'dc')]['data'] for i in range(config.num_electrodes)] \
+                if self.can_sample_dc else []
 
         self.samples_written_per_series = [0 for _ in range(config.num_electrodes)]
-        self.buffer_space_used = [0 for _ in range(config.num_electrodes)]
+        self.matrix_rows_written = 0
 
-        # Set up the rest of the NWB file, including the metadata.
-        device = self.nwb_file.create_device(name=device_name)
-        electrode_group = self.nwb_file.create_electrode_group(device_name,
-                                                               description='',
-                                                               location='',
-                                                               device=device)
+        # Continue with the samples that went past the end of the previous segment.
+        for datasets, carried_over in [(self.datasets_ac, self.carried_over_ac),
+                                       (self.datasets_dc, self.carried_over_dc)]:
+            for i, samples in enumerate(carried_over):
+                if samples is not None:
+                    datasets[i].resize((len(samples),))
+                    datasets[i][:] = samples
+                    self.samples_written_per_series[i] = len(samples)
 
-        for i in range(config.num_electrodes):
-            self.nwb_file.add_electrode(i * 1., 0., 0., 1., '', '', electrode_group, id=i)
+        self.carried_over_ac = []
+        self.carried_over_dc = []
+        self.flush_file(min(self.samples_written_per_series, default=0))
+
+        if self.manifest is not None:
+            self.manifest['segments'].append({
+                'file': os.path.basename(file_path),
+                'startSample': self.segment_start_sample,
+                'numSamples': None
+            })
+            write_segment_manifest(segment_manifest_path(config.file_path), self.manifest)
+
+    def close_segment(self, num_samples: Optional[int] = None):
+        """
+        Close the current segment file. In the per-electrode layout, `num_samples` is where
+        the segment ends; electrodes that are ahead of it continue in the next segment.
+        """
+        if self.h5_file is None:
+            return
+
+        if self.config.layout == LAYOUT_MATRIX:
+            num_samples = self.matrix_rows_written
+        elif num_samples is None:
+            num_samples = min(self.samples_written_per_series, default=0)
+        else:
+            self.carried_over_ac = self.truncate_datasets(self.datasets_ac, num_samples)
+            self.carried_over_dc = self.truncate_datasets(self.datasets_dc, num_samples)
+            self.flush_file(num_samples)
+
+        self.h5_file.close()
+        self.h5_file = None
+        self.segment_start_sample += num_samples
+
+        if self.manifest is not None:
+            self.manifest['segments'][-1]['numSamples'] = num_samples
+            write_segment_manifest(segment_manifest_path(self.config.file_path), self.manifest)
+
+    def truncate_datasets(self, datasets: List[h5py.Dataset], num_samples: int) -> List[Optional[np.ndarray]]:
+        """Cut the per-electrode datasets to `num_samples`, and return the samples that were cut off."""
+        cut_off = []
+
+        for i, dataset in enumerate(datasets):
+            num_written = self.samples_written_per_series[i]
+
+            if num_written > num_samples:
+                cut_off.append(dataset[num_samples:num_written])
+                dataset.resize((num_samples,))
+            else:
+                cut_off.append(None)
 
-        series_start_time = time.time()
+        return cut_off
+
+    def add_per_electrode_time_series(self, series_start_time: float):
+        config = self.config
+        chunks = (config.chunk_samples or BUFFER_SIZE,)
 
         for i in range(config.num_electrodes):
             electrode_table_region = self.nwb_file.create_electrode_table_region([i], f'electrode {i}')
             time_series_ac = ElectricalSeries(electrode_name(i, 'ac'),
-                                              self.chunk_streams[i],
+                                              make_chunk_stream(chunks, config),
                                               electrode_table_region,
                                               resolution=config.resolution,
+                                              conversion=self.get_stored_conversion('ac'),
                                               starting_time=series_start_time,
                                               rate=float(config.samples_per_sec))
 
@@ -120,35 +620,86 @@ class NwbFileWriter(EngineStep):
 
             if self.can_sample_dc:
                 time_series_dc = ElectricalSeries(electrode_name(i, 'dc'),
-                                                  self.chunk_streams[i],
+                                                  make_chunk_stream(chunks, config),
                                                   electrode_table_region,
                                                   resolution=config.resolution,
+                                                  conversion=self.get_stored_conversion('dc'),
                                                   starting_time=series_start_time,
                                                   rate=float(config.samples_per_sec))
 
                 self.nwb_file.add_acquisition(time_series_dc)
 
-        # Open the file for appending. Remove any existing files.
-        existing_file = Path(config.file_path)
+    def add_matrix_time_series(self, series_start_time: float):
+        config = self.config
+        num_electrodes = config.num_electrodes
+        chunks = (config.chunk_samples or MATRIX_CHUNK_SAMPLES, num_electrodes)
+
+        electrode_table_region = self.nwb_file.create_electrode_table_region(list(range(num_electrodes)),
+                                                                             'all electrodes')
+
+        for kind in (['ac', 'dc'] if self.can_sample_dc else ['ac']):
+            time_series = ElectricalSeries(matrix_series_name(kind),
+                                           make_chunk_stream(chunks, config),
+                                           electrode_table_region,
+                                           resolution=config.resolution,
+                                           conversion=self.get_stored_conversion(kind),
+                                           starting_time=series_start_time,
+                                           rate=float(config.samples_per_sec))
+
+            self.nwb_file.add_acquisition(time_series)
+
+    def get_rescaling(self, kind: str):
+        """Get the offset (in ADC codes) and conversion of the 'ac' or 'dc' samples."""
+        if kind == 'dc':
+            return self.config.dc_offset, self.config.dc_conversion
+        else:
+            return self.config.offset, self.config.conversion
+
+    def get_stored_conversion(self, kind: str) -> float:
+        if self.config.sample_format == SAMPLE_FORMAT_UINT16:
+            return float(self.get_rescaling(kind)[1])
+        else:
+            # The samples are stored in volts.
+            return 1.
 
-        if existing_file.exists():
-            if not existing_file.is_file():
-                raise Exception(f'{config.file_path} is not a file')
+    def encode(self, samples: np.ndarray, kind: str) -> np.ndarray:
+        if self.config.sample_format == SAMPLE_FORMAT_UINT16:
+            return encode_samples(samples, *self.get_rescaling(kind))
+        else:
+            return samples
 
-            os.remove(config.file_path)
+    def input_steps(self) -> List[EngineStep]:
+        return [self.events_step] if self.events_step is not None else []
 
-        self.file_io = NWBHDF5IO(config.file_path, 'w')
-        self.file_io.write(self.nwb_file)
-        self.file_io.close()
+    def add_stimulus_events(self, events: List[Dict]):
+        self.stimulus_events += stimulus_events_of(events)
 
     def do_step(self, electrode_channels: Dict[str, Any]):
-        chunks_to_write_ac = [None for _ in range(self.num_electrodes)]
-        chunks_to_write_dc = [None for _ in range(self.num_electrodes)]
-        has_chunks_to_write = False
+        if self.events_step is not None:
+            self.add_stimulus_events(self.events_step.result or [])
 
         if len(electrode_channels) == 0:
             return
 
+        # The samples of this step are the first ones of the new segment.
+        if self.is_rotation_due():
+            self.rotate()
+
+        self.segment_samples_received += len(electrode_channels[electrode_name(0, 'ac')])
+
+        if self.config.layout == LAYOUT_MATRIX:
+            self.do_step_matrix(electrode_channels)
+        else:
+            self.do_step_per_electrode(electrode_channels)
+
+        if self.is_flush_due():
+            self.flush_buffers()
+
+    def do_step_per_electrode(self, electrode_channels: Dict[str, Any]):
+        chunks_to_write_ac = [None for _ in range(self.num_electrodes)]
+        chunks_to_write_dc = [None for _ in range(self.num_electrodes)]
+        has_chunks_to_write = False
+
         for i in range(self.num_electrodes):
             samples_ac = electrode_channels[electrode_name(i, 'ac')]
 
@@ -177,6 +728,7 @@ class NwbFileWriter(EngineStep):
                     chunks_to_write_dc[i] = buffer_dc
 
                 has_chunks_to_write = True
+                self.segment_samples_handed_off[i] += BUFFER_SIZE
 
                 new_buffer_ac = np.zeros(BUFFER_SIZE, 'f4')
 
@@ -207,16 +759,202 @@ class NwbFileWriter(EngineStep):
 
         # Write the data updates to file.
         chunk_sizes = [BUFFER_SIZE for _ in range(self.num_electrodes)]
-        _thread.start_new_thread(self.write_to_file,
-                                 (chunks_to_write_ac, chunks_to_write_dc, chunk_sizes))
+        self.segment_has_writes = True
+        self.queue_write(self.write_to_file, chunks_to_write_ac, chunks_to_write_dc, chunk_sizes)
+
+    def do_step_matrix(self, electrode_channels: Dict[str, Any]):
+        for i in range(self.num_electrodes):
+            samples_ac = electrode_channels[electrode_name(i, 'ac')]
+            num_samples = len(samples_ac)
+
+            if num_samples == 0:
+                continue
+
+            from_row = self.matrix_rows_used[i]
+            to_row = from_row + num_samples
+
+            if to_row > len(self.matrix_buffer_ac):
+                self.grow_matrix_buffers(to_row)
+
+            self.matrix_buffer_ac[from_row:to_row, i] = samples_ac
+
+            if self.can_sample_dc:
+                self.matrix_buffer_dc[from_row:to_row, i] = electrode_channels[electrode_name(i, 'dc')]
+
+            self.matrix_rows_used[i] = to_row
+
+        # Rows can only be written once all the electrodes have filled them.
+        if min(self.matrix_rows_used) < BUFFER_SIZE:
+            return
+
+        buffer_ac = self.matrix_buffer_ac
+        buffer_dc = self.matrix_buffer_dc
+        max_rows_used = max(self.matrix_rows_used)
+
+        # Hand the full buffers over to the writer thread, and carry the samples
+        # beyond the written rows over to new buffers.
+        self.matrix_buffer_ac = np.empty_like(buffer_ac)
+        self.matrix_buffer_ac[:max_rows_used - BUFFER_SIZE] = buffer_ac[BUFFER_SIZE:max_rows_used]
+
+        if self.can_sample_dc:
+            self.matrix_buffer_dc = np.empty_like(buffer_dc)
+            self.matrix_buffer_dc[:max_rows_used - BUFFER_SIZE] = buffer_dc[BUFFER_SIZE:max_rows_used]
+
+        self.matrix_rows_used = [rows_used - BUFFER_SIZE for rows_used in self.matrix_rows_used]
+        self.segment_has_writes = True
+        self.queue_write(self.write_matrix_to_file, buffer_ac, buffer_dc, BUFFER_SIZE)
+
+    def is_flush_due(self) -> bool:
+        return self.config.flush_interval_sec is not None and \
+            time.time() - self.flushed_at >= self.config.flush_interval_sec
+
+    def is_rotation_due(self) -> bool:
+        if not self.config.rotates():
+            return False
+
+        if self.rotate_samples is not None and self.segment_samples_received >= self.rotate_samples:
+            return True
+
+        # Don't go by the size of a segment that has no samples yet: that is the NWB metadata.
+        if self.rotate_bytes is not None and self.segment_has_writes:
+            # The file lags behind by the chunks in the write queue, which is negligible
+            # next to a segment size in GB.
+            try:
+                return os.path.getsize(segment_file_path(self.config.file_path, self.segment_num)) >= self.rotate_bytes
+            except OSError:
+                return False
+
+        return False
+
+    def rotate(self):
+        """
+        End the current segment at the last sample that all the electrodes have, and carry
+        the samples beyond it over to the next segment, so that no sample is lost or repeated.
+        """
+        if self.config.layout == LAYOUT_MATRIX:
+            segment_end = None
+            self.flush_buffers()
+            num_carried_over = self.matrix_rows_used[0]
+        else:
+            segment_end = self.flush_buffers()
+            self.segment_samples_handed_off = [0 for _ in range(self.num_electrodes)]
+            num_carried_over = self.buffer_space_used[0]
+
+        self.segment_num += 1
+        self.segment_samples_received = num_carried_over
+        self.segment_has_writes = False
+        self.queue_write(self.close_segment, segment_end)
+        self.queue_write(self.open_segment, segment_file_path(self.config.file_path, self.segment_num))
+
+        self.log.info(f'Continuing the recording in {segment_file_path(self.config.file_path, self.segment_num)}')
+
+    def flush_buffers(self) -> Optional[int]:
+        """
+        Hand the samples that all the electrodes have over to the writer thread, even though
+        the buffers aren't full, and keep the rest in the buffers. In the per-electrode layout,
+        returns the number of samples of the segment that all the electrodes have.
+        """
+        self.flushed_at = time.time()
+        self.segment_has_writes = True
+
+        if self.config.layout == LAYOUT_MATRIX:
+            num_rows = min(self.matrix_rows_used)
+            max_rows_used = max(self.matrix_rows_used)
+            buffer_ac = self.matrix_buffer_ac
+            buffer_dc = self.matrix_buffer_dc
+
+            self.matrix_buffer_ac = np.empty_like(buffer_ac)
+            self.matrix_buffer_ac[:max_rows_used - num_rows] = buffer_ac[num_rows:max_rows_used]
+
+            if self.can_sample_dc:
+                self.matrix_buffer_dc = np.empty_like(buffer_dc)
+                self.matrix_buffer_dc[:max_rows_used - num_rows] = buffer_dc[num_rows:max_rows_used]
+
+            self.matrix_rows_used = [rows_used - num_rows for rows_used in self.matrix_rows_used]
+            self.queue_write(self.write_matrix_to_file, buffer_ac, buffer_dc, num_rows)
+            return None
+
+        # The electrodes hand their buffers over independently, so the same position
+        # in the buffers may not be the same sample of the recording.
+        segment_end = min(handed_off + space_used
+                          for handed_off, space_used in zip(self.segment_samples_handed_off, self.buffer_space_used))
+        buffers_ac = self.buffers_ac
+        buffers_dc = self.buffers_dc
+        buffer_space_used = self.buffer_space_used
+        chunk_sizes = []
+        self.init_per_electrode_buffers()
+
+        for i, space_used in enumerate(buffer_space_used):
+            # Electrodes that have already handed more than that over are trimmed by close_segment().
+            num_samples = min(max(segment_end - self.segment_samples_handed_off[i], 0), space_used)
+            chunk_sizes.append(num_samples)
+            self.segment_samples_handed_off[i] += num_samples
+
+            self.buffers_ac[i][:space_used - num_samples] = buffers_ac[i][num_samples:space_used]
+            self.buffers_dc[i][:space_used - num_samples] = buffers_dc[i][num_samples:space_used]
+            self.buffer_space_used[i] = space_used - num_samples
+
+        self.queue_write(self.write_to_file, buffers_ac, buffers_dc, chunk_sizes)
+        return segment_end
+
+    def grow_matrix_buffers(self, min_rows: int):
+        num_rows = max(min_rows, 2 * len(self.matrix_buffer_ac))
+        extra_rows = ((0, num_rows - len(self.matrix_buffer_ac)), (0, 0))
+        self.matrix_buffer_ac = np.pad(self.matrix_buffer_ac, extra_rows)
+
+        if self.can_sample_dc:
+            self.matrix_buffer_dc = np.pad(self.matrix_buffer_dc, extra_rows)
+
+    def queue_write(self, write_function, *args):
+        # The chunks are written in the order they're queued. This blocks if the
+        # writer thread has fallen WRITE_QUEUE_SIZE chunks behind.
+        self.write_queue.put((write_function, args, time.perf_counter()))
+
+    def run_write_thread(self):
+        """Writes the queued chunks to the file until the None that finalize() queues."""
+        num_writes = 0
+        total_latency = 0.
+        max_latency = 0.
+        max_queue_depth = 0
+        stats_logged_at = time.perf_counter()
+
+        while True:
+            item = self.write_queue.get()
+
+            if item is None:
+                break
+
+            write_function, args, queued_at = item
+            max_queue_depth = max(max_queue_depth, self.write_queue.qsize() + 1)
+
+            try:
+                write_function(*args)
+            except Exception as e:
+                # Keep consuming the queue, so that the engine doesn't block on a full queue.
+                self.log.error(f'Could not write to {self.segment_path}: {e}')
+
+            # The latency includes the time that the chunk has waited in the queue.
+            latency = time.perf_counter() - queued_at
+            num_writes += 1
+            total_latency += latency
+            max_latency = max(max_latency, latency)
+
+            now = time.perf_counter()
+
+            if now - stats_logged_at >= WRITE_STATS_INTERVAL_SEC:
+                self.log.info(f'{os.path.basename(self.config.file_path)}: {num_writes} writes, '
+                              f'latency avg {total_latency / num_writes * 1000:.0f} ms, '
+                              f'max {max_latency * 1000:.0f} ms, max queue depth {max_queue_depth}')
+
+                num_writes = 0
+                total_latency = 0.
+                max_latency = 0.
+                max_queue_depth = 0
+                stats_logged_at = now
 
     def write_to_file(self, chunks_ac: List, chunks_dc: List, chunk_sizes: List[int]):
-        file_path = self.config.file_path
         samples_written_per_series = self.samples_written_per_series
 
-        io = NWBHDF5IO(file_path, 'a')
-        nwb_file = io.read()
-
         for i in range(self.num_electrodes):
             chunk_ac = chunks_ac[i]
             chunk_size = chunk_sizes[i]
@@ -227,20 +965,87 @@ class NwbFileWriter(EngineStep):
             old_length = samples_written_per_series[i]
             new_length = old_length + chunk_size
 
-            time_series_ac_data = nwb_file.get_acquisition(electrode_name(i, 'ac')).data
+            time_series_ac_data = self.datasets_ac[i]
             time_series_ac_data.resize((new_length,))
-            time_series_ac_data[old_length:new_length] = chunk_ac[:chunk_size]
+            time_series_ac_data[old_length:new_length] = self.encode(chunk_ac[:chunk_size], 'ac')
 
             if self.can_sample_dc:
                 chunk_dc = chunks_dc[i]
-                time_series_dc_data = nwb_file.get_acquisition(electrode_name(i, 'dc')).data
+                time_series_dc_data = self.datasets_dc[i]
                 time_series_dc_data.resize((new_length,))
-                time_series_dc_data[old_length:new_length] = chunk_dc[:chunk_size]
+                time_series_dc_data[old_length:new_length] = self.encode(chunk_dc[:chunk_size], 'dc')
 
             samples_written_per_series[i] += chunk_size
 
-        io.close()
+        self.flush_file(min(samples_written_per_series, default=0))
+
+    def write_matrix_to_file(self, chunk_ac: np.ndarray, chunk_dc: Optional[np.ndarray], num_rows: int):
+        if num_rows == 0:
+            return
+
+        old_length = self.matrix_rows_written
+        new_length = old_length + num_rows
+
+        self.datasets_ac[0].resize((new_length, self.num_electrodes))
+        self.datasets_ac[0][old_length:new_length] = self.encode(chunk_ac[:num_rows], 'ac')
+
+        if self.can_sample_dc:
+            self.datasets_dc[0].resize((new_length, self.num_electrodes))
+            self.datasets_dc[0][old_length:new_length] = self.encode(chunk_dc[:num_rows], 'dc')
+
+        self.matrix_rows_written = new_length
+        self.flush_file(new_length)
+
+    def flush_file(self, consistent_samples: int):
+        # Only record the new length once the samples themselves have been flushed, so
+        # that it never points past what is in the file.
+        self.h5_file.flush()
+        self.h5_file.attrs[CONSISTENT_SAMPLES_ATTR] = consistent_samples
+        self.h5_file.flush()
 
     def finalize(self):
-        # Write the data accumulated so far.
-        _thread.start_new_thread(self.write_to_file, (self.buffers_ac, self.buffers_dc, self.buffer_space_used))
+        if self.write_thread is None:
+            return
+
+        # Write the data accumulated so far, and wait for everything to reach the file.
+        if self.config.layout == LAYOUT_MATRIX:
+            # Only the rows that all the electrodes have filled are kept.
+            self.queue_write(self.write_matrix_to_file,
+                             self.matrix_buffer_ac,
+                             self.matrix_buffer_dc,
+                             min(self.matrix_rows_used, default=0))
+        else:
+            self.queue_write(self.write_to_file, self.buffers_ac, self.buffers_dc, list(self.buffer_space_used))
+
+        self.write_queue.put(None)
+        self.write_thread.join()
+        self.write_thread = None
+
+        self.close_segment()
+
+        try:
+            self.write_stimulus_events()
+        except Exception as e:
+            self.log.error(f'Could not write the stimulus events of {self.config.file_path}: {e}')
+
+    def write_stimulus_events(self):
+        if len(self.stimulus_events) == 0:
+            return
+
+        rate = self.config.samples_per_sec
+
+        if self.manifest is None:
+            write_stimulus_intervals(self.config.file_path, self.stimulus_events, self.start_sample,
+                                     self.segment_start_sample, self.series_start_time, rate)
+            return
+
+        manifest_dir = os.path.dirname(self.config.file_path)
+
+        for segment in self.manifest['segments']:
+            write_stimulus_intervals(os.path.join(manifest_dir, segment['file']),
+                                     self.stimulus_events,
+                                     self.start_sample + segment['startSample'],
+                                     segment['numSamples'],
+                                     self.series_start_time + segment['startSample'] / rate,
+                                     rate)
+
@@ -0,0 +1,369 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from pynwb import NWBHDF5IO
+from pynwb.ecephys import ElectricalSeries, EventWaveform, LFP, SpikeEventSeries
+from scipy.signal import butter, sosfilt
+
+from constants import EVENTS_STEP_NAME
+from engine_step import EngineStep
+from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig, MODE_SPIKES, compression_args, \
+    make_nwb_file, write_new_nwb_file, recording_start_sample, stimulus_events_of, write_stimulus_intervals
+from stores.ring_buffer import RingBuffer
+from util import electrode_name
+
+# The noise level of each electrode is the median absolute deviation of this many seconds
+# of the filtered signal, and it's updated this often. Nothing is detected before the first estimate.
+NOISE_WINDOW_SEC = 1
+NOISE_UPDATE_SEC = 10
+
+# Median absolute deviation / MAD_TO_STD estimates the standard deviation of Gaussian noise.
+MAD_TO_STD = 0.6745
+
+# Snippets are aligned on the lowest sample within this long after the threshold crossing.
+SPIKE_ALIGN_MS = 0.5
+
+# No spike is detected within this long after the previous one on the same electrode.
+SPIKE_REFRACTORY_MS = 1
+
+SPIKE_FILTER_ORDER = 2
+
+# The LFP is low-pass filtered at this fraction of its sampling rate before it is downsampled.
+LFP_CUTOFF_FRACTION = 0.4
+LFP_FILTER_ORDER = 4
+
+# HDF5 chunks of the spike series are this many events long.
+SPIKE_CHUNK_EVENTS = 256
+LFP_CHUNK_SAMPLES = 8192
+
+ECEPHYS_MODULE = 'ecephys'
+
+
+def create_nwb_file_writer(config: NwbFileWriterConfig) -> EngineStep:
+    """The writer for the recording mode of `config`."""
+    if config.mode == MODE_SPIKES:
+        return SpikeEventNwbFileWriter()
+
+    return NwbFileWriter()
+
+
+class SpikeEventNwbFileWriter(EngineStep):
+    """
+    The spikes mode of NwbFileWriter: instead of the raw samples, stores the threshold
+    crossings of each electrode as a SpikeEventSeries of the timestamps and the waveform
+    snippets around them, and optionally a downsampled LFP. A units table (one multi-unit
+    per electrode) is added when the recording is finished.
+
+    The signal is high-pass filtered, and a spike is a crossing of -spikeThresholdStd times
+    the noise level of the electrode. Timestamps are in the same clock as the starting_time
+    of the series that NwbFileWriter records. The snippets are the filtered signal, in volts.
+    """
+    name = NwbFileWriter.name
+
+    def __init__(self):
+        super().__init__()
+        self.config: Optional[NwbFileWriterConfig] = None
+        self.num_electrodes = 0
+        self.samples_per_sec = 0
+        self.series_start_time = 0.
+        self.h5_file: Optional[h5py.File] = None
+        self.spike_datasets: List[h5py.Dataset] = []
+        self.timestamp_datasets: List[h5py.Dataset] = []
+        self.lfp_datasets: List[h5py.Dataset] = []
+
+        self.pre_samples = 0
+        self.post_samples = 0
+        self.align_samples = 0
+        self.refractory_samples = 0
+
+        # Filter states, and the noise estimates of each electrode (None until the first).
+        # The filter states have the shape (sections, electrodes, 2).
+        self.spike_sos = None
+        self.spike_zi: Optional[np.ndarray] = None
+        self.noise_rings: List[RingBuffer] = []
+        self.noise_levels: List[Optional[float]] = []
+        self.noise_updated_at: List[int] = []
+
+        # The filtered samples that are kept for the next step, the index of their first
+        # sample since the start of the recording, and where the search for crossings resumes.
+        self.tails: List[np.ndarray] = []
+        self.tail_starts: List[int] = []
+        self.scan_from: List[int] = []
+        self.last_spikes: List[int] = []
+
+        self.lfp_sos = None
+        self.lfp_zi: Optional[np.ndarray] = None
+        self.lfp_decimation = 1
+        self.lfp_phases: List[int] = []
+
+        # Waiting to be written: spike snippets, timestamps and LFP samples of each electrode.
+        self.pending_spikes: List[List[np.ndarray]] = []
+        self.pending_timestamps: List[List[float]] = []
+        self.pending_lfp: List[List[np.ndarray]] = []
+        self.written_at = 0.
+
+        # The stimulus events, as in NwbFileWriter.
+        self.events_step: Optional[EngineStep] = None
+        self.stimulus_events: List[Dict] = []
+        self.start_sample = 0
+        self.num_samples_received = 0
+        self.log = logging.getLogger(__name__)
+
+    def configure(self, config: NwbFileWriterConfig, engine):
+        self.config = config
+        device_props = engine.device.get_properties()
+        num_electrodes = config.num_electrodes
+        rate = config.samples_per_sec
+
+        self.num_electrodes = num_electrodes
+        self.samples_per_sec = rate
+        self.series_start_time = time.time()
+        self.written_at = self.series_start_time
+        self.start_sample = recording_start_sample(config, engine)
+        self.events_step = engine.published_steps.get(EVENTS_STEP_NAME)
+
+        self.pre_samples = int(round(config.spike_pre_ms / 1000 * rate))
+        self.post_samples = int(round(config.spike_post_ms / 1000 * rate))
+        self.align_samples = max(1, int(round(SPIKE_ALIGN_MS / 1000 * rate)))
+        self.refractory_samples = int(round(SPIKE_REFRACTORY_MS / 1000 * rate))
+
+        self.spike_sos = butter(SPIKE_FILTER_ORDER, config.spike_high_pass_hz, btype='highpass', output='sos', fs=rate)
+        self.spike_zi = np.zeros((self.spike_sos.shape[0], num_electrodes, 2))
+        self.noise_rings = [RingBuffer(int(NOISE_WINDOW_SEC * rate)) for _ in range(num_electrodes)]
+        self.noise_levels = [None for _ in range(num_electrodes)]
+        self.noise_updated_at = [0 for _ in range(num_electrodes)]
+
+        self.tails = [np.zeros(0, 'f4') for _ in range(num_electrodes)]
+        self.tail_starts = [0 for _ in range(num_electrodes)]
+        self.scan_from = [self.pre_samples + 1 for _ in range(num_electrodes)]
+        self.last_spikes = [-self.refractory_samples for _ in range(num_electrodes)]
+
+        self.pending_spikes = [[] for _ in range(num_electrodes)]
+        self.pending_timestamps = [[] for _ in range(num_electrodes)]
+        self.pending_lfp = [[] for _ in range(num_electrodes)]
+
+        if config.lfp_samples_per_sec is not None:
+            self.lfp_decimation = max(1, int(round(rate / config.lfp_samples_per_sec)))
+            lfp_rate = rate / self.lfp_decimation
+            self.lfp_sos = butter(LFP_FILTER_ORDER, LFP_CUTOFF_FRACTION * lfp_rate, output='sos', fs=rate)
+            self.lfp_zi = np.zeros((self.lfp_sos.shape[0], num_electrodes, 2))
+            self.lfp_phases = [0 for _ in range(num_electrodes)]
+
+        self.create_file(device_props)
+
+    def create_file(self, device_props: Dict):
+        config = self.config
+        snippet_samples = self.pre_samples + self.post_samples
+        nwb_file = make_nwb_file(config.file_path, device_props, self.num_electrodes)
+        ecephys = nwb_file.create_processing_module(ECEPHYS_MODULE, 'Spikes and LFP of each electrode')
+        event_waveform = EventWaveform()
+        lfp = LFP() if self.lfp_sos is not None else None
+        compression = compression_args(config.compression, config.compression_level)
+
+        for i in range(self.num_electrodes):
+            electrode_table_region = nwb_file.create_electrode_table_region([i], f'electrode {i}')
+            snippets = H5DataIO(data=np.empty((0, snippet_samples), 'f4'),
+                                maxshape=(None, snippet_samples),
+                                chunks=(SPIKE_CHUNK_EVENTS, snippet_samples),
+                                shuffle=config.shuffle,
+                                **compression)
+            timestamps = H5DataIO(data=np.empty(0, 'f8'),
+                                  maxshape=(None,),
+                                  chunks=(SPIKE_CHUNK_EVENTS,),
+                                  **compression)
+            event_waveform.add_spike_event_series(SpikeEventSeries(electrode_name(i, 'spikes'),
+                                                                   snippets,
+                                                                   timestamps,
+                                                                   electrode_table_region,
+                                                                   resolution=config.resolution))
+
+            if lfp is not None:
+                lfp_samples = H5DataIO(data=np.empty(0, 'f4'),
+                                       maxshape=(None,),
+                                       chunks=(LFP_CHUNK_SAMPLES,),
+                                       shuffle=config.shuffle,
+                                       **compression)
+                lfp.add_electrical_series(ElectricalSeries(electrode_name(i, 'lfp'),
+                                                           lfp_samples,
+                                                           electrode_table_region,
+                                                           resolution=config.resolution,
+                                                           starting_time=self.series_start_time,
+                                                           rate=self.samples_per_sec / self.lfp_decimation))
+
+        ecephys.add(event_waveform)
+
+        if lfp is not None:
+            ecephys.add(lfp)
+
+        write_new_nwb_file(nwb_file, config.file_path)
+
+        self.h5_file = h5py.File(config.file_path, 'a')
+        ecephys_group = self.h5_file['processing'][ECEPHYS_MODULE]
+        self.spike_datasets = []
+        self.timestamp_datasets = []
+
+        for i in range(self.num_electrodes):
+            series_group = ecephys_group[event_waveform.name][electrode_name(i, 'spikes')]
+            self.spike_datasets.append(series_group['data'])
+            self.timestamp_datasets.append(series_group['timestamps'])
+
+        if lfp is not None:
+            self.lfp_datasets = [ecephys_group[lfp.name][electrode_name(i, 'lfp')]['data']
+                                 for i in range(self.num_electrodes)]
+
+    def input_steps(self) -> List[EngineStep]:
+        return [self.events_step] if self.events_step is not None else []
+
+    def add_stimulus_events(self, events: List[Dict]):
+        self.stimulus_events += stimulus_events_of(events)
+
+    def do_step(self, electrode_channels: Dict[str, np.ndarray]):
+        if self.events_step is not None:
+            self.add_stimulus_events(self.events_step.result or [])
+
+        if electrode_channels is None or len(electrode_channels) == 0:
+            return
+
+        electrode_samples = [electrode_channels[electrode_name(i, 'ac')] for i in range(self.num_electrodes)]
+        self.num_samples_received += len(electrode_samples[0])
+        all_filtered = filter_electrodes(self.spike_sos, self.spike_zi, electrode_samples)
+
+        for i, filtered in enumerate(all_filtered):
+            if len(filtered) == 0:
+                continue
+
+            self.update_noise_level(i, filtered)
+            self.detect_spikes(i, filtered)
+
+        if self.lfp_sos is not None:
+            for i, low_passed in enumerate(filter_electrodes(self.lfp_sos, self.lfp_zi, electrode_samples)):
+                phase = self.lfp_phases[i]
+                self.pending_lfp[i].append(low_passed[phase::self.lfp_decimation])
+                self.lfp_phases[i] = (phase - len(low_passed)) % self.lfp_decimation
+
+        if self.config.flush_interval_sec is not None and \
+                time.time() - self.written_at >= self.config.flush_interval_sec:
+            self.write_to_file()
+
+    def update_noise_level(self, electrode: int, filtered: np.ndarray):
+        ring = self.noise_rings[electrode]
+        ring.push(filtered)
+
+        is_first = self.noise_levels[electrode] is None and ring.num_pushed >= ring.size
+        is_due = ring.num_pushed - self.noise_updated_at[electrode] >= NOISE_UPDATE_SEC * self.samples_per_sec
+
+        if is_first or (self.noise_levels[electrode] is not None and is_due):
+            self.noise_levels[electrode] = float(np.median(np.abs(ring.latest(ring.size)))) / MAD_TO_STD
+            self.noise_updated_at[electrode] = ring.num_pushed
+
+    def detect_spikes(self, electrode: int, filtered: np.ndarray):
+        signal = np.concatenate([self.tails[electrode], filtered])
+        signal_start = self.tail_starts[electrode]
+        signal_end = signal_start + len(signal)
+
+        # Crossings are only looked for where the whole snippet around them is available.
+        scan_from = self.scan_from[electrode]
+        scan_to = signal_end - self.align_samples - self.post_samples
+
+        if scan_to <= scan_from:
+            return
+
+        noise_level = self.noise_levels[electrode]
+
+        if noise_level is not None and noise_level > 0:
+            threshold = -self.config.spike_threshold_std * noise_level
+            window = signal[scan_from - signal_start - 1:scan_to - signal_start]
+            crossings = np.flatnonzero((window[1:] < threshold) & (window[:-1] >= threshold)) + scan_from
+
+            for crossing in crossings:
+                position = crossing - signal_start
+                trough = crossing + int(np.argmin(signal[position:position + self.align_samples]))
+
+                if trough - self.last_spikes[electrode] < self.refractory_samples:
+                    continue
+
+                self.last_spikes[electrode] = trough
+                trough_position = trough - signal_start
+                self.pending_spikes[electrode].append(
+                    signal[trough_position - self.pre_samples:trough_position + self.post_samples])
+                self.pending_timestamps[electrode].append(self.series_start_time + trough / self.samples_per_sec)
+
+        # Keep what the next step needs: the samples before the next crossing to look at.
+        self.scan_from[electrode] = scan_to
+        keep_from = scan_to - self.pre_samples - 1
+        self.tails[electrode] = signal[keep_from - signal_start:]
+        self.tail_starts[electrode] = keep_from
+
+    def write_to_file(self):
+        self.written_at = time.time()
+
+        for i in range(self.num_electrodes):
+            if len(self.pending_spikes[i]) > 0:
+                append(self.spike_datasets[i], np.stack(self.pending_spikes[i]))
+                append(self.timestamp_datasets[i], np.array(self.pending_timestamps[i], 'f8'))
+                self.pending_spikes[i] = []
+                self.pending_timestamps[i] = []
+
+            if len(self.pending_lfp[i]) > 0:
+                append(self.lfp_datasets[i], np.concatenate(self.pending_lfp[i]))
+                self.pending_lfp[i] = []
+
+        self.h5_file.flush()
+
+    def finalize(self):
+        if self.h5_file is None:
+            return
+
+        self.write_to_file()
+        self.h5_file.close()
+        self.h5_file = None
+        self.write_units()
+        write_stimulus_intervals(self.config.file_path, self.stimulus_events, self.start_sample,
+                                 self.num_samples_received, self.series_start_time, self.samples_per_sec)
+
+    def write_units(self):
+        """Add a units table with the spike times of each electrode, for analysis tools that look for units."""
+        file_io = NWBHDF5IO(self.config.file_path, 'a')
+
+        try:
+            nwb_file = file_io.read()
+            event_waveform = nwb_file.processing[ECEPHYS_MODULE]['EventWaveform']
+
+            for i in range(self.num_electrodes):
+                spike_times = event_waveform[electrode_name(i, 'spikes')].timestamps[:]
+                nwb_file.add_unit(spike_times=spike_times, electrodes=[i])
+
+            file_io.write(nwb_file)
+
+        finally:
+            file_io.close()
+
+
+def filter_electrodes(sos: np.ndarray, zi: np.ndarray, electrode_samples: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Filter the samples of each electrode, and update the filter states in `zi` in place. The
+    electrodes normally have the same number of samples, and are then filtered in one go.
+    """
+    lengths = set(len(samples) for samples in electrode_samples)
+
+    if len(lengths) == 1:
+        filtered, zi[:] = sosfilt(sos, np.stack(electrode_samples), axis=-1, zi=zi)
+        return list(filtered.astype('f4'))
+
+    results = []
+
+    for i, samples in enumerate(electrode_samples):
+        filtered, zi[:, i, :] = sosfilt(sos, samples, zi=zi[:, i, :])
+        results.append(filtered.astype('f4'))
+
+    return results
+
+
+def append(dataset: h5py.Dataset, values: np.ndarray):
+    old_length = len(dataset)
+    dataset.resize((old_length + len(values),) + dataset.shape[1:])
+    dataset[old_length:] = values
@@ -0,0 +1,316 @@
+import logging
+from typing import Dict, List, Optional
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from constants import EVENTS_STEP_NAME
+from engine_step import EngineStep, EngineStepConfig
+from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig
+from stores.ring_buffer import RingBuffer
+from util import electrode_name
+
+# Kinds of triggers. 'stimulation' and 'manual' come from the engine's events step;
+# 'threshold' is detected here, on the AC samples.
+TRIGGER_STIMULATION = 'stimulation'
+TRIGGER_MANUAL = 'manual'
+TRIGGER_THRESHOLD = 'threshold'
+TRIGGER_KINDS = [TRIGGER_STIMULATION, TRIGGER_MANUAL, TRIGGER_THRESHOLD]
+
+DEFAULT_PRE_TRIGGER_SEC = 1
+DEFAULT_POST_TRIGGER_SEC = 2
+
+
+class TriggeredNwbFileWriterConfig(EngineStepConfig):
+    @staticmethod
+    def from_json(json: Dict):
+        config = TriggeredNwbFileWriterConfig()
+
+        # The file itself is configured the same way as for NwbFileWriter.
+        config.writer_config = NwbFileWriterConfig.from_json(json)
+        config.pre_trigger_sec = json.get('preTriggerSec', DEFAULT_PRE_TRIGGER_SEC)
+        config.post_trigger_sec = json.get('postTriggerSec', DEFAULT_POST_TRIGGER_SEC)
+        config.trigger_kinds = json.get('triggerKinds', [TRIGGER_STIMULATION, TRIGGER_MANUAL])
+        config.threshold_volts = json.get('thresholdVolts', None)
+        config.threshold_electrodes = json.get('thresholdElectrodes', None)
+
+        for kind in config.trigger_kinds:
+            if kind not in TRIGGER_KINDS:
+                raise Exception(f'Unknown trigger "{kind}"')
+
+        if TRIGGER_THRESHOLD in config.trigger_kinds and config.threshold_volts is None:
+            raise Exception('Threshold triggers need thresholdVolts')
+
+        if config.writer_config.rotates():
+            raise Exception('Triggered recordings can not be rotated')
+
+        return config
+
+    def __init__(self):
+        super().__init__()
+        self.writer_config = NwbFileWriterConfig()
+        self.pre_trigger_sec = DEFAULT_PRE_TRIGGER_SEC
+        self.post_trigger_sec = DEFAULT_POST_TRIGGER_SEC
+        self.trigger_kinds: List[str] = [TRIGGER_STIMULATION, TRIGGER_MANUAL]
+
+        # Any AC sample of these electrodes (all of them if None) beyond +/- this many volts is a trigger.
+        self.threshold_volts: Optional[float] = None
+        self.threshold_electrodes: Optional[List[int]] = None
+
+
+class TriggeredNwbFileWriter(EngineStep):
+    """
+    Records only the windows around triggers, instead of the whole session. The last
+    `preTriggerSec` of every series are kept in ring buffers, so that a window can start
+    before its trigger. Windows that overlap are merged.
+
+    The windows are stored back to back in the time series of an `NwbFileWriter` file, and
+    each is an epoch of the file: its start and stop time (in the same clock as the
+    starting_time of the series), what triggered it, and where its samples are stored.
+    Between windows, the cost is copying the samples into the ring buffers.
+
+    Windows are placed by sample: a trigger is at the sample of its stimulus, at the first
+    sample beyond the threshold, or at the sample of its time, and it's counted from the
+    first sample that this step got.
+    """
+    name = 'TriggeredNwbFileWriter'
+
+    def __init__(self):
+        super().__init__()
+        self.config: Optional[TriggeredNwbFileWriterConfig] = None
+        self.writer = NwbFileWriter()
+        self.events_step: Optional[EngineStep] = None
+        self.series_names: List[str] = []
+        self.rings: Dict[str, RingBuffer] = dict()
+        self.samples_per_sec = 0
+        self.pre_trigger_samples = 0
+        self.post_trigger_samples = 0
+
+        # Triggers that came in while there were no samples.
+        self.pending_triggers: List[Dict] = []
+
+        # Samples received so far. Positions of samples and windows are counted in these.
+        self.num_received = 0
+
+        # The window being recorded (None between windows), with its 'start' and 'end'
+        # positions, and the position up to which its samples have been written.
+        self.window: Optional[Dict] = None
+        self.written_to = 0
+
+        # Where the last window ended. A window's pre-trigger samples never reach back
+        # into the previous window.
+        self.last_window_end = 0
+
+        # Samples stored in the file so far, counted on the first series.
+        self.num_stored_samples = 0
+        self.epochs: List[Dict] = []
+        self.log = logging.getLogger(__name__)
+
+    def configure(self, config: TriggeredNwbFileWriterConfig, engine):
+        self.config = config
+        writer_config = config.writer_config
+        can_sample_dc = engine.device.get_properties()['canSampleDC']
+
+        self.series_names = []
+
+        for i in range(writer_config.num_electrodes):
+            self.series_names.append(electrode_name(i, 'ac'))
+
+            if can_sample_dc:
+                self.series_names.append(electrode_name(i, 'dc'))
+
+        self.samples_per_sec = writer_config.samples_per_sec
+        self.pre_trigger_samples = int(round(config.pre_trigger_sec * self.samples_per_sec))
+        self.post_trigger_samples = int(round(config.post_trigger_sec * self.samples_per_sec))
+        self.rings = {name: RingBuffer(max(self.pre_trigger_samples, 1)) for name in self.series_names}
+        self.num_received = 0
+        self.last_window_end = 0
+
+        self.events_step = engine.get_published_step(EVENTS_STEP_NAME)
+        self.writer.configure(writer_config, engine)
+
+        # The windows aren't a continuous stretch of samples, so the writer can't place the
+        # stimulus events in them. Stimulation triggers are in the epochs instead.
+        self.writer.events_step = None
+
+    def input_steps(self) -> List[EngineStep]:
+        return [self.events_step]
+
+    def do_step(self, electrode_channels: Dict[str, np.ndarray]):
+        events = self.events_step.result or []
+        self.pending_triggers += [event for event in events if event['kind'] in self.config.trigger_kinds]
+
+        if electrode_channels is None or len(electrode_channels) == 0:
+            return
+
+        step_start = self.num_received
+        step_end = step_start + len(electrode_channels[self.series_names[0]])
+
+        triggers = self.pending_triggers
+        self.pending_triggers = []
+
+        # The triggers are placed in this step, even if they came in late.
+        positions = [min(max(self.trigger_position(trigger), step_start), step_end) for trigger in triggers]
+
+        if TRIGGER_THRESHOLD in self.config.trigger_kinds:
+            positions_and_triggers = self.find_threshold_crossings(electrode_channels, step_start)
+            positions += [position for position, _ in positions_and_triggers]
+            triggers += [trigger for _, trigger in positions_and_triggers]
+
+        for position, trigger in sorted(zip(positions, triggers), key=lambda pair: pair[0]):
+            self.trigger(position, trigger, electrode_channels, step_start)
+
+        if self.window is not None:
+            self.write_window_until(min(self.window['end'], step_end), electrode_channels, step_start)
+
+            if self.written_to == self.window['end']:
+                self.end_window()
+
+        # The samples of this step are the pre-trigger samples of the next triggers.
+        for name in self.series_names:
+            self.rings[name].push(electrode_channels[name])
+
+        self.num_received = step_end
+
+    def trigger_position(self, trigger: Dict) -> int:
+        """The position of an event's trigger: the sample of its stimulus, or else the sample at its time."""
+        if trigger.get('sample') is not None:
+            return trigger['sample'] - self.writer.start_sample
+
+        return int(round((trigger['time'] - self.writer.series_start_time) * self.samples_per_sec))
+
+    def find_threshold_crossings(self, electrode_channels: Dict[str, np.ndarray], step_start: int) -> List:
+        """
+        (position, trigger) pairs at the samples beyond the threshold in this step that start a
+        window: the first one at or after the end of the window being recorded, and then the
+        first one after the end of the window of the one before.
+        """
+        electrodes = self.config.threshold_electrodes
+
+        if electrodes is None:
+            electrodes = range(self.config.writer_config.num_electrodes)
+
+        crossings_by_electrode = dict()
+
+        for i in electrodes:
+            crossings = np.flatnonzero(np.abs(electrode_channels[electrode_name(i, 'ac')]) >= self.config.threshold_volts)
+
+            if len(crossings) > 0:
+                crossings_by_electrode[i] = crossings + step_start
+
+        if len(crossings_by_electrode) == 0:
+            return []
+
+        all_crossings = np.unique(np.concatenate(list(crossings_by_electrode.values())))
+        window_end = self.window['end'] if self.window is not None else step_start
+        positions_and_triggers = []
+
+        while True:
+            next_index = np.searchsorted(all_crossings, window_end)
+
+            if next_index == len(all_crossings):
+                break
+
+            position = int(all_crossings[next_index])
+            window_end = position + max(self.post_trigger_samples, 1)
+
+            # The electrodes that cross the threshold in the window of this trigger.
+            crossing_electrodes = [str(i) for i, crossings in crossings_by_electrode.items()
+                                   if np.any((crossings >= position) & (crossings < window_end))]
+
+            positions_and_triggers.append((position, {'kind': TRIGGER_THRESHOLD,
+                                                      'time': self.position_time(position),
+                                                      'label': f'electrodes {", ".join(crossing_electrodes)}'}))
+
+        return positions_and_triggers
+
+    def trigger(self, position: int, trigger: Dict, electrode_channels: Dict[str, np.ndarray], step_start: int):
+        """Start a window for a trigger at `position`, or extend the window that is being recorded."""
+        if self.window is not None and position >= self.window['end']:
+            self.write_window_until(self.window['end'], electrode_channels, step_start)
+            self.end_window()
+
+        if self.window is None:
+            start = max(position - self.pre_trigger_samples, self.last_window_end, 0)
+            self.window = {
+                'start': start,
+                'end': start,
+                'storedStartSample': self.num_stored_samples,
+                'triggers': []
+            }
+            self.written_to = start
+
+        self.window['end'] = max(self.window['end'], position + self.post_trigger_samples)
+        self.window['triggers'].append(trigger)
+
+    def write_window_until(self, to_position: int, electrode_channels: Dict[str, np.ndarray], step_start: int):
+        """Write the samples of the window up to `to_position`, which is at most the end of this step."""
+        if to_position <= self.written_to:
+            return
+
+        window_data = dict()
+
+        for name in self.series_names:
+            # Samples before this step come from the ring buffer.
+            from_ring = self.rings[name].latest(max(step_start - self.written_to, 0))
+            from_step = electrode_channels[name][max(self.written_to - step_start, 0):to_position - step_start]
+            window_data[name] = np.concatenate([from_ring, from_step])
+
+        self.writer.do_step(window_data)
+        self.num_stored_samples += to_position - self.written_to
+        self.written_to = to_position
+
+    def position_time(self, position: int) -> float:
+        """The time of a sample, in the clock of the series."""
+        return self.writer.series_start_time + position / self.samples_per_sec
+
+    def end_window(self):
+        window = self.window
+        window['end'] = self.written_to
+        num_samples = self.num_stored_samples - window['storedStartSample']
+
+        self.epochs.append({
+            'startTime': self.position_time(window['start']),
+            'stopTime': self.position_time(window['end']),
+            'kinds': sorted(set(trigger['kind'] for trigger in window['triggers'])),
+            'labels': '; '.join(trigger['label'] for trigger in window['triggers'] if trigger['label']),
+            'storedStartSample': window['storedStartSample'],
+            'storedNumSamples': num_samples
+        })
+
+        self.window = None
+        self.last_window_end = window['end']
+
+        # Get the window into the file now, rather than with the next window.
+        self.writer.flush_buffers()
+
+    def finalize(self):
+        if self.window is not None:
+            self.end_window()
+
+        self.writer.finalize()
+
+        if len(self.epochs) > 0:
+            self.write_epochs()
+
+    def write_epochs(self):
+        file_io = NWBHDF5IO(self.config.writer_config.file_path, 'a')
+
+        try:
+            nwb_file = file_io.read()
+            nwb_file.add_epoch_column('stored_start_sample', 'First sample of the epoch in the time series')
+            nwb_file.add_epoch_column('stored_num_samples', 'Number of samples of the epoch in the time series')
+            nwb_file.add_epoch_column('triggers', 'What triggered the recording of the epoch')
+
+            for epoch in self.epochs:
+                nwb_file.add_epoch(epoch['startTime'],
+                                   epoch['stopTime'],
+                                   tags=epoch['kinds'],
+                                   stored_start_sample=epoch['storedStartSample'],
+                                   stored_num_samples=epoch['storedNumSamples'],
+                                   triggers=epoch['labels'])
+
+            file_io.write(nwb_file)
+
+        finally:
+            file_io.close()
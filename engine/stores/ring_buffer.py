@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class RingBuffer:
+    """Keeps the latest `size` samples of a series, without reallocating as samples come in."""
+    def __init__(self, size: int, dtype='f4'):
+        self.buffer = np.zeros(size, dtype)
+        self.size = size
+
+        # Total number of samples pushed so far. The next sample goes to position % size.
+        self.num_pushed = 0
+
+    def push(self, samples: np.ndarray):
+        num_samples = len(samples)
+
+        if num_samples >= self.size:
+            # Only the last `size` samples are kept, each at the position it would have
+            # had if the samples had been pushed one by one.
+            self.num_pushed += num_samples
+            last_samples = samples[-self.size:]
+            position = self.num_pushed % self.size
+            self.buffer[position:] = last_samples[:self.size - position]
+            self.buffer[:position] = last_samples[self.size - position:]
+            return
+
+        position = self.num_pushed % self.size
+        num_to_end = min(num_samples, self.size - position)
+        self.buffer[position:position + num_to_end] = samples[:num_to_end]
+        self.buffer[:num_samples - num_to_end] = samples[num_to_end:]
+        self.num_pushed += num_samples
+
+    def latest(self, num_samples: int) -> np.ndarray:
+        """The last `num_samples` samples (fewer if not that many were pushed), oldest first."""
+        num_samples = min(num_samples, self.size, self.num_pushed)
+        end = self.num_pushed % self.size
+        start = end - num_samples
+
+        if start >= 0:
+            return self.buffer[start:end].copy()
+
+        return np.concatenate([self.buffer[start:], self.buffer[:end]])
+
+    def clear(self):
+        self.num_pushed = 0
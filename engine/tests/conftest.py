@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The engine modules import each other as top-level modules, the same as when main.py runs.
+enginedir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if enginedir not in sys.path:
+    sys.path.insert(0, enginedir)
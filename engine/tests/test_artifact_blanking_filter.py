@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from constants import STIMULUS_EVENT_KIND
+from engine_step import EngineStep
+from filters.artifact_blanking_filter import ArtifactBlankingFilter, ArtifactBlankingFilterConfig, \
+    BLANKING_HOLD, BLANKING_INTERPOLATE
+from sample_clock import SampleClock
+
+SAMPLES_PER_SEC = 20000
+PRE_SAMPLES = 4    # 0.2 ms
+POST_SAMPLES = 40  # 2 ms
+
+
+class FakeEngine:
+    def __init__(self):
+        self.sample_clock = SampleClock()
+        self.events_step = EngineStep()
+
+    def get_published_step(self, name: str):
+        return self.events_step
+
+
+def blank_mask(num_samples: int, stimulus_samples) -> np.ndarray:
+    mask = np.zeros(num_samples, dtype=bool)
+
+    for sample in stimulus_samples:
+        mask[max(sample - PRE_SAMPLES, 0):sample + POST_SAMPLES] = True
+
+    return mask
+
+
+def reference_output(samples: np.ndarray, mask: np.ndarray, mode: str) -> np.ndarray:
+    """The samples blanked one by one."""
+    output = samples.copy()
+    last_value = 0.
+
+    for i in range(len(samples)):
+        if not mask[i]:
+            last_value = samples[i]
+        elif mode == BLANKING_HOLD:
+            output[i] = last_value
+        else:
+            next_unblanked = i + np.argmin(mask[i:]) if not mask[i:].all() else None
+            prev_unblanked = i - 1
+            while prev_unblanked >= 0 and mask[prev_unblanked]:
+                prev_unblanked -= 1
+
+            prev_value = samples[prev_unblanked] if prev_unblanked >= 0 else 0.
+            output[i] = np.interp(i, [prev_unblanked, next_unblanked], [prev_value, samples[next_unblanked]])
+
+    return output
+
+
+@pytest.mark.parametrize('mode', [BLANKING_HOLD, BLANKING_INTERPOLATE])
+def test_blanks_around_each_stimulus(mode):
+    rng = np.random.default_rng(1)
+    num_samples = 20000
+    samples = rng.normal(size=num_samples)
+
+    # A 500 Hz train, whose blanks overlap, and single stimuli, one of them at the very start.
+    stimulus_samples = sorted(list(range(1000, 3000, 40)) + [2, 8000, 8030, num_samples - 500])
+
+    engine = FakeEngine()
+    blanking = ArtifactBlankingFilter()
+    blanking.configure(ArtifactBlankingFilterConfig.from_json({'samplesPerSec': SAMPLES_PER_SEC, 'mode': mode}),
+                       engine)
+
+    outputs = []
+    position = 0
+
+    while position < num_samples:
+        step = samples[position:position + int(rng.integers(1, 400))]
+        engine.sample_clock.add_samples(len(step), 0)
+        engine.events_step.result = [{'kind': STIMULUS_EVENT_KIND, 'sample': sample}
+                                     for sample in stimulus_samples if position <= sample < position + len(step)]
+        blanking.do_step(step)
+        position += len(step)
+
+        if blanking.result is not None:
+            outputs.append(blanking.result)
+
+    output = np.concatenate(outputs)
+    expected = reference_output(samples, blank_mask(num_samples, stimulus_samples), mode)
+
+    # The last samples are held back for the blanks that may still start before them.
+    assert num_samples - PRE_SAMPLES - POST_SAMPLES <= len(output) <= num_samples
+    np.testing.assert_allclose(output, expected[:len(output)])
+
+
+def test_other_events_are_not_blanked():
+    engine = FakeEngine()
+    blanking = ArtifactBlankingFilter()
+    blanking.configure(ArtifactBlankingFilterConfig.from_json({'samplesPerSec': SAMPLES_PER_SEC, 'mode': BLANKING_HOLD}),
+                       engine)
+
+    samples = np.ones(1000)
+    engine.sample_clock.add_samples(len(samples), 0)
+    engine.events_step.result = [{'kind': 'manual', 'sample': 500}]
+    blanking.do_step(samples)
+
+    np.testing.assert_array_equal(blanking.result, np.ones(1000 - PRE_SAMPLES))
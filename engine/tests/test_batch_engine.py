@@ -0,0 +1,104 @@
+import os
+
+import h5py
+import numpy as np
+
+from batch_engine import BatchEngine, make_batch_tasks, merge_batch_results, result_path, run_batch_task
+from sources_and_sinks.nwb_file_writer import LAYOUT_MATRIX, SAMPLE_FORMAT_FLOAT32
+from util import electrode_name
+from web_server import get_step
+
+NUM_ELECTRODES = 4
+SAMPLES_PER_SEC = 10000
+NUM_SAMPLES = 5 * SAMPLES_PER_SEC
+CHUNK_SEC = 0.5
+
+PIPELINES = [
+    ['electrodes[*].ac', {'name': 'RescalingFilter', 'offset': 1e-3, 'multiplier': 2}],
+    ['electrodes[0].ac', {'name': 'AddAnotherSeriesFilter', 'addSeriesName': 'electrodes[1].ac',
+                          'thisSeriesFactor': 1, 'otherSeriesFactor': -1}],
+    ['electrodes[2].ac', {'name': 'BandFilter', 'samplesPerSec': SAMPLES_PER_SEC, 'highOrder': 2,
+                          'high3dbFreq': 300}],
+    ['electrodes[3].ac', {'name': 'SubsamplingFilter', 'samplesPerSec': SAMPLES_PER_SEC, 'maxSubsamples': 333,
+                          'windowLengthSec': 1}],
+]
+
+# Pipelines 0-3 are the expanded wildcard pipeline.
+STATEFUL_PIPELINE_NUMS = [5, 6]
+
+
+def write_matrix_recording(file_path: str):
+    rng = np.random.default_rng(0)
+    engine = BatchEngine({
+        'name': 'Test',
+        'canSampleDC': False,
+        'numElectrodes': NUM_ELECTRODES,
+        'numElectrodeRows': 2,
+        'electrodeMap': [[0, 1], [2, 3]],
+        'electrodeExists': [True] * NUM_ELECTRODES,
+        'electrodeNames': [str(i) for i in range(NUM_ELECTRODES)],
+    })
+    writer = get_step(engine, {
+        'name': 'NwbFileWriter',
+        'filePath': file_path,
+        'offset': 0,
+        'conversion': 1e-6,
+        'resolution': 1e-6,
+        'samplesPerSec': SAMPLES_PER_SEC,
+        'numElectrodes': NUM_ELECTRODES,
+        'layout': LAYOUT_MATRIX,
+        'sampleFormat': SAMPLE_FORMAT_FLOAT32,
+    })
+
+    step_samples = SAMPLES_PER_SEC // 10
+
+    for step_from in range(0, NUM_SAMPLES, step_samples):
+        writer.do_step({electrode_name(i, 'ac'): rng.normal(0, 1e-4, step_samples).astype('f4')
+                        for i in range(NUM_ELECTRODES)})
+
+    writer.finalize()
+
+
+def run_batch(recording_path: str, output_dir: str, num_workers: int):
+    os.makedirs(output_dir)
+    tasks = make_batch_tasks(recording_path, output_dir, PIPELINES, CHUNK_SEC, num_workers)
+
+    for task in tasks:
+        run_batch_task(task)
+
+    merge_batch_results(tasks)
+
+    return tasks
+
+
+def read_result(output_dir: str, pipeline_num: int) -> np.ndarray:
+    with h5py.File(result_path(output_dir, pipeline_num), 'r') as result_file:
+        return result_file['result'][:]
+
+
+def test_time_range_split_matches_single_task(tmp_path):
+    recording_path = os.path.join(tmp_path, 'recording.nwb')
+    write_matrix_recording(recording_path)
+
+    single_dir = os.path.join(tmp_path, 'single')
+    split_dir = os.path.join(tmp_path, 'split')
+    run_batch(recording_path, single_dir, 1)
+    split_tasks = run_batch(recording_path, split_dir, 4)
+
+    # The stateless pipelines are split by time range, the others run over the whole recording.
+    assert any(task.part_num is not None for task in split_tasks)
+
+    for task in split_tasks:
+        if any(pipeline_num in STATEFUL_PIPELINE_NUMS for pipeline_num in task.pipeline_nums):
+            assert task.part_num is None
+            assert task.from_sample == 0 and task.to_sample is None
+
+    for pipeline_num in range(NUM_ELECTRODES + len(PIPELINES) - 1):
+        single = read_result(single_dir, pipeline_num)
+        split = read_result(split_dir, pipeline_num)
+
+        assert len(single) > 0
+        np.testing.assert_array_equal(split, single)
+
+    # Only the merged results are left behind.
+    assert sorted(os.listdir(split_dir)) == sorted(os.listdir(single_dir))
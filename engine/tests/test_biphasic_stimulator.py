@@ -0,0 +1,159 @@
+import math
+from io import BytesIO
+from typing import Dict, List
+
+import numpy as np
+import pytest
+
+import devices.openmea.biphasic_stimulator as biphasic_stimulator
+from devices.openmea.rsh2116 import COMMAND_READ_CHIP_ID, REG_CHARGE_RECOV_SWITCH, REG_STIM_ON, REG_STIM_POLARITY, \
+    STIM_STEP_SIZES, rsh2116_electrode_bit, rsh2116_write_current, rsh2116_write_register
+
+ELECTRODES_PER_CHIP = 16
+MAX_FREQ = 20000
+STEP_SIZE_INDEX = 6
+
+PULSE_CONFIG = {
+    'phase1Duration': 0.0005,
+    'interphaseDuration': 0.0001,
+    'phase2Duration': 0.0005,
+    'phase1Current': 20e-6,
+    'phase2Current': -20e-6,
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(biphasic_stimulator, 'time', fake_clock)
+    return fake_clock
+
+
+def chip_of(electrode: int) -> int:
+    return math.floor(electrode / ELECTRODES_PER_CHIP)
+
+
+def reference_pulse(electrodes: List[int], pulse_config: Dict) -> Dict[int, bytes]:
+    """The commands of one biphasic pulse, made one command at a time."""
+    stim_step_size = STIM_STEP_SIZES[STEP_SIZE_INDEX]
+    chips_used = sorted(set(chip_of(electrode) for electrode in electrodes))
+    commands = {chip: BytesIO() for chip in chips_used}
+    electrode_flags = {chip: 0 for chip in chips_used}
+    setup_counts = {chip: 0 for chip in chips_used}
+
+    phase1_current = int(round(pulse_config['phase1Current'] / stim_step_size))
+    phase2_current = int(round(pulse_config['phase2Current'] / stim_step_size))
+
+    for electrode in electrodes:
+        chip_electrode = electrode % ELECTRODES_PER_CHIP
+        commands[chip_of(electrode)].write(rsh2116_write_current(chip_electrode, phase1_current))
+        electrode_flags[chip_of(electrode)] |= rsh2116_electrode_bit(chip_electrode)
+        setup_counts[chip_of(electrode)] += 1
+
+    # The setup is padded so that the two trigger commands end a block of 4 commands.
+    num_setup_commands = max(setup_counts.values())
+    pad_to_commands = num_setup_commands + (4 - (num_setup_commands + 2) % 4) % 4
+
+    for chip in chips_used:
+        for _ in range(setup_counts[chip], pad_to_commands):
+            commands[chip].write(COMMAND_READ_CHIP_ID)
+
+    def trigger_phase(current: int):
+        for chip in chips_used:
+            commands[chip].write(rsh2116_write_register(REG_STIM_POLARITY, electrode_flags[chip] if current > 0 else 0))
+            commands[chip].write(rsh2116_write_register(REG_STIM_ON, electrode_flags[chip], trigger=True))
+
+    trigger_phase(phase1_current)
+
+    for electrode in electrodes:
+        commands[chip_of(electrode)].write(rsh2116_write_current(electrode % ELECTRODES_PER_CHIP, phase2_current))
+
+    phase1_commands = 4 * int(round(pulse_config['phase1Duration'] * MAX_FREQ))
+    for chip in chips_used:
+        for _ in range(max(2, phase1_commands - num_setup_commands - 2)):
+            commands[chip].write(COMMAND_READ_CHIP_ID)
+
+    interphase_commands = 4 * int(round(pulse_config['interphaseDuration'] * MAX_FREQ))
+    if interphase_commands > 0:
+        for chip in chips_used:
+            commands[chip].write(COMMAND_READ_CHIP_ID)
+            commands[chip].write(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))
+            for _ in range(interphase_commands):
+                commands[chip].write(COMMAND_READ_CHIP_ID)
+
+    trigger_phase(phase2_current)
+
+    phase2_commands = max(4, 4 * int(round(pulse_config['phase2Duration'] * MAX_FREQ)))
+    for chip in chips_used:
+        for _ in range(phase2_commands - 1):
+            commands[chip].write(COMMAND_READ_CHIP_ID)
+
+        # Stop, then recover the charge.
+        commands[chip].write(rsh2116_write_register(REG_STIM_ON, 0, trigger=True))
+        commands[chip].write(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH, electrode_flags[chip], trigger=True))
+        for _ in range(10):
+            commands[chip].write(COMMAND_READ_CHIP_ID)
+        commands[chip].write(rsh2116_write_register(REG_CHARGE_RECOV_SWITCH, 0, trigger=True))
+
+    return {chip: chip_commands.getvalue() for chip, chip_commands in commands.items()}
+
+
+def make_stimulator(electrodes: List[int], pulse_config: Dict) -> biphasic_stimulator.BiphasicStimulator:
+    config = {
+        'maxFrequency': MAX_FREQ,
+        'stimStepSizeIndex': STEP_SIZE_INDEX,
+        'pulseConfig': pulse_config,
+        'electrodesByPulse': [electrodes],
+    }
+
+    return biphasic_stimulator.BiphasicStimulator(config, STEP_SIZE_INDEX, MAX_FREQ)
+
+
+@pytest.mark.parametrize('electrodes', [[3], [0, 5, 17, 40, 41, 42], [63, 1]])
+@pytest.mark.parametrize('interphase_duration', [0, 0.0001])
+def test_pulse_matches_command_by_command(clock, electrodes, interphase_duration):
+    pulse_config = {**PULSE_CONFIG, 'interphaseDuration': interphase_duration}
+    stimulator = make_stimulator(electrodes, pulse_config)
+    stimulator.on_stimulation_starting()
+    emitted = {chip: chip_commands.getvalue() for chip, chip_commands in stimulator.emit_next_commands().items()}
+
+    assert emitted == reference_pulse(electrodes, pulse_config)
+    assert stimulator.is_done()
+
+
+def test_train_repeats_the_pulse(clock):
+    electrodes = [0, 17, 18]
+    pulse_config = {**PULSE_CONFIG, 'pulseCount': 5, 'pulseInterval': 0.01, 'burstCount': 3, 'burstInterval': 0.5}
+    stimulator = make_stimulator(electrodes, pulse_config)
+    stimulator.set_emit_ahead(0.05)
+    stimulator.on_stimulation_starting()
+
+    emitted = {chip: b'' for chip in [0, 1]}
+    while not stimulator.is_done():
+        for chip, chip_commands in stimulator.emit_next_commands().items():
+            emitted[chip] += chip_commands.getvalue()
+        clock.now += 0.001
+
+    pulse = reference_pulse(electrodes, pulse_config)
+    pulse_interval = 4 * int(0.01 * MAX_FREQ)
+    burst_interval = 4 * int(0.5 * MAX_FREQ)
+    num_commands = 2 * burst_interval + 5 * pulse_interval
+
+    for chip in emitted:
+        chip_pulse = np.frombuffer(pulse[chip], dtype='<u4')
+        expected = np.full(num_commands, int.from_bytes(COMMAND_READ_CHIP_ID, byteorder='little'), dtype='<u4')
+
+        for burst in range(3):
+            for pulse_num in range(5):
+                start = burst * burst_interval + pulse_num * pulse_interval
+                expected[start:start + len(chip_pulse)] = chip_pulse
+
+        np.testing.assert_array_equal(np.frombuffer(emitted[chip], dtype='<u4'), expected)
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+import pytest
+
+from batch_engine import BatchEngine
+from devices.nwb_file.segmented_nwb_file_reader import open_recording
+from sources_and_sinks.nwb_file_writer import LAYOUT_MATRIX, LAYOUT_PER_ELECTRODE, SAMPLE_FORMAT_FLOAT32, \
+    SAMPLE_FORMAT_UINT16, segment_manifest_path
+from util import electrode_name
+from web_server import get_step
+
+NUM_ELECTRODES = 4
+SAMPLES_PER_SEC = 10000
+NUM_SAMPLES = 3 * SAMPLES_PER_SEC
+MAX_STEP_SAMPLES = 500
+MAX_LAG_SAMPLES = 200
+
+# Volts = (ADC code + offset) * conversion
+OFFSET = -32768
+CONVERSION = 0.195e-6
+DC_OFFSET = -512
+DC_CONVERSION = -0.01923
+
+
+def make_samples(rng, offset: float, conversion: float) -> np.ndarray:
+    """Samples in volts that are exactly representable as ADC codes."""
+    codes = rng.integers(0, 1 << 16, size=NUM_SAMPLES)
+    return ((codes + offset) * conversion).astype('f4')
+
+
+@pytest.mark.parametrize('layout', [LAYOUT_PER_ELECTRODE, LAYOUT_MATRIX])
+@pytest.mark.parametrize('sample_format', [SAMPLE_FORMAT_FLOAT32, SAMPLE_FORMAT_UINT16])
+@pytest.mark.parametrize('rotates', [False, True])
+def test_round_trip(tmp_path, layout, sample_format, rotates):
+    rng = np.random.default_rng(0)
+    file_path = os.path.join(tmp_path, 'recording.nwb')
+    engine = BatchEngine({'name': 'Test', 'numElectrodes': NUM_ELECTRODES, 'canSampleDC': True})
+
+    writer_json = {
+        'name': 'NwbFileWriter',
+        'filePath': file_path,
+        'offset': OFFSET,
+        'conversion': CONVERSION,
+        'dcOffset': DC_OFFSET,
+        'dcConversion': DC_CONVERSION,
+        'resolution': CONVERSION,
+        'samplesPerSec': SAMPLES_PER_SEC,
+        'numElectrodes': NUM_ELECTRODES,
+        'layout': layout,
+        'sampleFormat': sample_format,
+    }
+
+    if rotates:
+        # A new segment every second.
+        writer_json['rotateMinutes'] = 1 / 60
+
+    writer = get_step(engine, writer_json)
+
+    series = {}
+    for i in range(NUM_ELECTRODES):
+        series[electrode_name(i, 'ac')] = make_samples(rng, OFFSET, CONVERSION)
+        series[electrode_name(i, 'dc')] = make_samples(rng, DC_OFFSET, DC_CONVERSION)
+
+    # Like the packets of a device, each step has a different number of samples of each
+    # electrode: the electrodes are up to MAX_LAG_SAMPLES apart until the end.
+    positions = [0] * NUM_ELECTRODES
+    step_end = 0
+
+    while min(positions) < NUM_SAMPLES:
+        step = {}
+        step_end += int(rng.integers(1, MAX_STEP_SAMPLES))
+
+        for i in range(NUM_ELECTRODES):
+            lag = int(rng.integers(0, MAX_LAG_SAMPLES))
+            step_to = min(max(step_end - lag, positions[i]), NUM_SAMPLES)
+
+            for kind in ['ac', 'dc']:
+                step[electrode_name(i, kind)] = series[electrode_name(i, kind)][positions[i]:step_to]
+
+            positions[i] = step_to
+
+        writer.do_step(step)
+
+    writer.finalize()
+
+    reader = open_recording(segment_manifest_path(file_path) if rotates else file_path)
+
+    try:
+        if rotates:
+            assert len(reader.segments) == 3
+
+        assert reader.num_samples == NUM_SAMPLES
+        assert reader.samples_per_sec == SAMPLES_PER_SEC
+
+        # Read across the segment boundaries, if any.
+        read_from = SAMPLES_PER_SEC // 2
+        read_samples = reader.read(series.keys(), read_from, NUM_SAMPLES)
+
+        for name, samples in series.items():
+            # The uint16 samples are turned back into volts in float32, which is only that exact.
+            conversion = DC_CONVERSION if name.endswith('.dc') else CONVERSION
+            np.testing.assert_allclose(read_samples[name], samples[read_from:], rtol=0, atol=abs(conversion) / 100)
+    finally:
+        reader.close()
@@ -0,0 +1,54 @@
+import numpy as np
+
+from stores.ring_buffer import RingBuffer
+
+
+def test_keeps_the_latest_samples_in_order():
+    rng = np.random.default_rng(0)
+    ring = RingBuffer(16)
+    pushed = np.zeros(0, dtype='f4')
+
+    for _ in range(200):
+        # Pushes both smaller and larger than the ring.
+        samples = rng.normal(size=int(rng.integers(0, 40))).astype('f4')
+        ring.push(samples)
+        pushed = np.concatenate([pushed, samples])
+
+        assert ring.num_pushed == len(pushed)
+        np.testing.assert_array_equal(ring.latest(16), pushed[-16:])
+        np.testing.assert_array_equal(ring.latest(5), pushed[-5:])
+
+
+def test_counts_every_sample_of_large_pushes():
+    ring = RingBuffer(10)
+    ring.push(np.arange(3, dtype='f4'))
+    ring.push(np.arange(25, dtype='f4'))
+    ring.push(np.arange(10, dtype='f4'))
+
+    assert ring.num_pushed == 38
+
+
+def test_large_push_places_samples_as_if_pushed_one_by_one():
+    one_by_one = RingBuffer(7)
+    at_once = RingBuffer(7)
+    samples = np.arange(30, dtype='f4')
+
+    one_by_one.push(samples[:4])
+    at_once.push(samples[:4])
+
+    for sample in samples[4:]:
+        one_by_one.push(np.array([sample], dtype='f4'))
+    at_once.push(samples[4:])
+
+    np.testing.assert_array_equal(at_once.buffer, one_by_one.buffer)
+    np.testing.assert_array_equal(at_once.latest(7), samples[-7:])
+
+
+def test_latest_of_a_short_history():
+    ring = RingBuffer(8)
+    ring.push(np.array([1, 2, 3], dtype='f4'))
+
+    np.testing.assert_array_equal(ring.latest(8), [1, 2, 3])
+
+    ring.clear()
+    assert len(ring.latest(8)) == 0
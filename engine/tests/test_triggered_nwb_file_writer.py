@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from pynwb import NWBHDF5IO
+
+from batch_engine import BatchEngine
+from sources_and_sinks.triggered_nwb_file_writer import TRIGGER_THRESHOLD
+from util import electrode_name
+from web_server import get_step
+
+NUM_ELECTRODES = 2
+SAMPLES_PER_SEC = 10000
+NUM_SAMPLES = 10 * SAMPLES_PER_SEC
+THRESHOLD_VOLTS = 1e-3
+PRE_TRIGGER_SEC = 0.1
+POST_TRIGGER_SEC = 0.2
+
+
+def test_threshold_crossings_in_one_step_start_windows(tmp_path):
+    file_path = os.path.join(tmp_path, 'triggered.nwb')
+    engine = BatchEngine({'name': 'Test', 'numElectrodes': NUM_ELECTRODES, 'canSampleDC': False})
+    writer = get_step(engine, {
+        'name': 'TriggeredNwbFileWriter',
+        'filePath': file_path,
+        'offset': 0,
+        'conversion': 1e-6,
+        'resolution': 1e-6,
+        'samplesPerSec': SAMPLES_PER_SEC,
+        'numElectrodes': NUM_ELECTRODES,
+        'preTriggerSec': PRE_TRIGGER_SEC,
+        'postTriggerSec': POST_TRIGGER_SEC,
+        'triggerKinds': [TRIGGER_THRESHOLD],
+        'thresholdVolts': THRESHOLD_VOLTS,
+    })
+
+    series = {electrode_name(i, 'ac'): np.zeros(NUM_SAMPLES, dtype='f4') for i in range(NUM_ELECTRODES)}
+
+    # Two windows: electrode 1 crosses within the window of the first crossing of electrode 0.
+    series[electrode_name(0, 'ac')][[10000, 50000]] = 2 * THRESHOLD_VOLTS
+    series[electrode_name(1, 'ac')][10500] = -2 * THRESHOLD_VOLTS
+
+    # All of them in one step.
+    writer.do_step(series)
+    writer.finalize()
+
+    file_io = NWBHDF5IO(file_path, 'r')
+
+    try:
+        epochs = file_io.read().epochs.to_dataframe()
+        start_time = writer.writer.series_start_time
+        atol = 0.1 / SAMPLES_PER_SEC
+
+        assert len(epochs) == 2
+        np.testing.assert_allclose(epochs['start_time'] - start_time, [1 - PRE_TRIGGER_SEC, 5 - PRE_TRIGGER_SEC], atol=atol)
+        np.testing.assert_allclose(epochs['stop_time'] - start_time, [1 + POST_TRIGGER_SEC, 5 + POST_TRIGGER_SEC], atol=atol)
+        assert list(epochs['triggers']) == ['electrodes 0, 1', 'electrodes 0']
+    finally:
+        file_io.close()
@@ -0,0 +1,200 @@
+import math
+import wave
+from io import BytesIO
+from typing import Dict, List
+
+import numpy as np
+import pytest
+
+import devices.openmea.wav_command_cache as wav_command_cache
+import devices.openmea.wav_stimulator as wav_stimulator
+from devices.openmea.rsh2116 import COMMAND_READ_CHIP_ID, REG_STIM_POLARITY, rsh2116_electrode_bit, \
+    rsh2116_write_current, rsh2116_write_register
+
+ELECTRODES_PER_CHIP = 16
+MAX_FREQ = 20000
+
+# Electrodes on several chips, one of them on two files, and uneven numbers per chip.
+ELECTRODES_BY_FILE = [[0, 5, 17, 40], [1, 5, 33], [63, 20, 2]]
+
+# The emitted batches are longer than the shorter files, which start over more than once in a batch.
+FILE_LENGTHS = [3000, 1500, 1234]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake_clock = FakeClock()
+    monkeypatch.setattr(wav_stimulator, 'time', fake_clock)
+    return fake_clock
+
+
+def chip_of(electrode: int) -> int:
+    return math.floor(electrode / ELECTRODES_PER_CHIP)
+
+
+def write_wav_files(directory) -> List[str]:
+    rng = np.random.default_rng(1)
+    paths = []
+
+    for file_num, num_frames in enumerate(FILE_LENGTHS):
+        path = str(directory / f'stim{file_num}.wav')
+
+        with wave.open(path, 'wb') as file:
+            file.setnchannels(1)
+            file.setsampwidth(1)
+            file.setframerate(MAX_FREQ)
+            file.writeframes(rng.integers(0, 256, num_frames, dtype=np.uint8).tobytes())
+
+        paths.append(path)
+
+    return paths
+
+
+def reference_wav_frames(paths: List[str], from_frame: int, to_frame: int, loop: bool) -> Dict[int, bytes]:
+    """The commands of the .wav frames in [from_frame, to_frame), made one frame at a time."""
+    files_samples = []
+    for path in paths:
+        with wave.open(path, 'rb') as file:
+            files_samples.append(file.readframes(file.getnframes()))
+
+    num_electrodes_per_chip = {chip: 0 for chip in range(4)}
+    for electrodes in ELECTRODES_BY_FILE:
+        for electrode in electrodes:
+            num_electrodes_per_chip[chip_of(electrode)] += 1
+
+    chips_used = [chip for chip, count in num_electrodes_per_chip.items() if count > 0]
+    pad_to_commands = 4 * math.ceil((max(num_electrodes_per_chip.values()) + 1) / 4)
+    commands = {chip: BytesIO() for chip in chips_used}
+
+    for frame_num in range(from_frame, to_frame):
+        positive_flags = {chip: 0 for chip in chips_used}
+
+        for file_samples, electrodes in zip(files_samples, ELECTRODES_BY_FILE):
+            if loop:
+                value = file_samples[frame_num % len(file_samples)] - 128
+            else:
+                value = file_samples[frame_num] - 128 if frame_num < len(file_samples) else 0
+
+            for electrode in electrodes:
+                chip_electrode = electrode % ELECTRODES_PER_CHIP
+                commands[chip_of(electrode)].write(rsh2116_write_current(chip_electrode, value))
+
+                if value >= 0:
+                    positive_flags[chip_of(electrode)] |= rsh2116_electrode_bit(chip_electrode)
+
+        for chip in chips_used:
+            for _ in range(pad_to_commands - num_electrodes_per_chip[chip] - 1):
+                commands[chip].write(COMMAND_READ_CHIP_ID)
+
+            commands[chip].write(rsh2116_write_register(REG_STIM_POLARITY, positive_flags[chip], trigger=True))
+
+    return {chip: chip_commands.getvalue() for chip, chip_commands in commands.items()}
+
+
+def make_wav_stimulator(paths: List[str], loop: bool, cache_dir) -> wav_stimulator.WavStimulator:
+    return wav_stimulator.WavStimulator({
+        'maxFrequency': MAX_FREQ,
+        'stimStepSizeIndex': 0,
+        'pulseConfig': {'filePaths': paths},
+        'electrodesByPulse': ELECTRODES_BY_FILE,
+        'loopForever': loop,
+    }, cache_dir=str(cache_dir))
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+@pytest.mark.parametrize('loop', [False, True])
+def test_wav_commands_match_frame_by_frame(tmp_path, monkeypatch, clock, compiled, loop):
+    paths = write_wav_files(tmp_path)
+
+    if not compiled:
+        monkeypatch.setattr(wav_command_cache, 'MAX_COMPILED_BYTES', 0)
+
+    stimulator = make_wav_stimulator(paths, loop, tmp_path / 'cache')
+    stimulator.set_emit_ahead(0)
+    stimulator.on_stimulation_starting()
+    assert (stimulator.compiled is not None) == compiled
+
+    # Emit in uneven batches, past the end of the files.
+    emitted = {chip: b'' for chip in stimulator.chips_used}
+
+    for batch_sec in [0, 0.0371, 0.05, 0.1, 0.03]:
+        clock.now += batch_sec
+        for chip, chip_commands in stimulator.emit_next_commands().items():
+            emitted[chip] += chip_commands.getvalue()
+
+    num_frames = round((clock.now - stimulator.emit_start_time) * MAX_FREQ)
+    if not loop:
+        num_frames = min(num_frames, max(FILE_LENGTHS))
+
+    expected = reference_wav_frames(paths, 0, num_frames, loop)
+
+    for chip in stimulator.chips_used:
+        # The electrodes are turned on first, in one block of 4 commands.
+        frames = emitted[chip][16:16 + len(expected[chip])]
+        assert frames == expected[chip]
+
+    assert stimulator.is_done() == (not loop)
+
+
+def test_wav_file_stats_come_from_the_cache(tmp_path, monkeypatch, clock):
+    paths = write_wav_files(tmp_path)
+    stimulator = make_wav_stimulator(paths, True, tmp_path / 'cache')
+    stimulator.on_stimulation_starting()
+    stats = (stimulator.file_lengths, stimulator.file_amplitudes)
+    stimulator.on_stimulation_done()
+
+    # On a cache hit, the files aren't read again.
+    def read_wav_samples(file_path):
+        raise AssertionError(f'{file_path} was read')
+
+    monkeypatch.setattr(wav_stimulator, 'read_wav_samples', read_wav_samples)
+    stimulator = make_wav_stimulator(paths, True, tmp_path / 'cache')
+    stimulator.on_stimulation_starting()
+
+    assert (stimulator.file_lengths, stimulator.file_amplitudes) == stats
+    assert stimulator.file_lengths == FILE_LENGTHS
+
+
+@pytest.mark.parametrize('compiled', [True, False])
+def test_shorter_emit_ahead_does_not_repeat_frames(tmp_path, monkeypatch, clock, compiled):
+    paths = write_wav_files(tmp_path)
+
+    if not compiled:
+        monkeypatch.setattr(wav_command_cache, 'MAX_COMPILED_BYTES', 0)
+
+    stimulator = make_wav_stimulator(paths, True, tmp_path / 'cache')
+    stimulator.set_emit_ahead(0.2)
+    stimulator.on_stimulation_starting()
+
+    emitted = {chip: b'' for chip in stimulator.chips_used}
+
+    def emit():
+        for chip, chip_commands in stimulator.emit_next_commands().items():
+            emitted[chip] += chip_commands.getvalue()
+
+    emit()
+    emitted_lengths = {chip: len(chip_commands) for chip, chip_commands in emitted.items()}
+
+    # Streaming the commands after a reconnect only emits 0.05 s ahead. Nothing is emitted
+    # until the frames that were emitted before are used up.
+    stimulator.set_emit_ahead(0.05)
+    clock.now += 0.01
+    emit()
+    assert {chip: len(chip_commands) for chip, chip_commands in emitted.items()} == emitted_lengths
+
+    clock.now += 0.3
+    emit()
+
+    num_frames = round((clock.now + 0.05 - stimulator.emit_start_time) * MAX_FREQ)
+    expected = reference_wav_frames(paths, 0, num_frames, True)
+
+    for chip in stimulator.chips_used:
+        assert emitted[chip][16:] == expected[chip]
@@ -6,8 +6,11 @@ from aiohttp import web
 from aiohttp.web_response import Response
 
 from filters.add_another_series_filter import AddAnotherSeriesFilter, AddAnotherSeriesFilterConfig
+from filters.artifact_blanking_filter import ArtifactBlankingFilter, ArtifactBlankingFilterConfig
 from filters.resampling_filter import ResamplingFilter, ResamplingFilterConfig
-from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig
+from sources_and_sinks.nwb_file_writer import NwbFileWriter, NwbFileWriterConfig, MODE_SPIKES
+from sources_and_sinks.spike_event_nwb_file_writer import SpikeEventNwbFileWriter
+from sources_and_sinks.triggered_nwb_file_writer import TriggeredNwbFileWriter, TriggeredNwbFileWriterConfig
 from engine import Engine
 from filters.band_filter import BandFilter, BandFilterConfig
 from filters.comb_filter import CombFilter, CombFilterConfig
@@ -72,6 +75,12 @@ class WebServer:
         self.engine.handle_device_command(command_json)
         return Response(status=200)
 
+    # POST /events
+    async def events_post(self, request):
+        event_json = await request.json()
+        self.engine.add_event(event_json.get('kind', 'manual'), event_json.get('label', ''))
+        return Response(status=200)
+
 
 
 def get_step(engine: Engine, step_json: Union[str, Dict]):
@@ -85,6 +94,10 @@ def get_step(engine: Engine, step_json: Union[str, Dict]):
         config = AddAnotherSeriesFilterConfig.from_json(step_json)
         step_type = AddAnotherSeriesFilter
 
+    elif step_json['name'] == ArtifactBlankingFilter.name:
+        config = ArtifactBlankingFilterConfig.from_json(step_json)
+        step_type = ArtifactBlankingFilter
+
     elif step_json['name'] == BandFilter.name:
         config = BandFilterConfig.from_json(step_json)
         step_type = BandFilter
@@ -95,7 +108,11 @@ def get_step(engine: Engine, step_json: Union[str, Dict]):
 
     elif step_json['name'] == NwbFileWriter.name:
         config = NwbFileWriterConfig.from_json(step_json)
-        step_type = NwbFileWriter
+        step_type = SpikeEventNwbFileWriter if config.mode == MODE_SPIKES else NwbFileWriter
+
+    elif step_json['name'] == TriggeredNwbFileWriter.name:
+        config = TriggeredNwbFileWriterConfig.from_json(step_json)
+        step_type = TriggeredNwbFileWriter
 
     elif step_json['name'] == ResamplingFilter.name:
         config = ResamplingFilterConfig.from_json(step_json)
@@ -124,5 +141,6 @@ async def setup_server(app, engine: Engine):
                     web.delete('/pipelines/{id}', server.pipelines_delete),
                     web.post('/modules/{module_name}', server.module_post),
                     web.post('/device', server.device_post),
-                    web.post('/device/commands', server.device_commands_post)])
+                    web.post('/device/commands', server.device_commands_post),
+                    web.post('/events', server.events_post)])
     return server
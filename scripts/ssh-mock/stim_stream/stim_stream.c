@@ -0,0 +1,197 @@
+/*
+ * Feeds stimulation commands from stdin into the command FIFOs of the chips, so that
+ * the engine can stream them over one SSH channel instead of uploading a file for
+ * every batch.
+ *
+ * Usage:  stim_stream [--append] <fifo_0> [<fifo_1> ...]
+ *
+ * The input is a sequence of frames: an 8-byte header with the chip number and the
+ * length of the payload in bytes (both little-endian uint32), and then the payload.
+ * A frame with chip number END_OF_BATCH and no payload ends a batch. The payloads of
+ * a batch are then written to the FIFOs in small pieces, one chip after the other, so
+ * that the chips get their commands at about the same time (like write_evenly does).
+ *
+ * The tool prints READY_MESSAGE once the FIFOs are open, and exits at the end of its
+ * input.
+ */
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define END_OF_BATCH 0xffffffffu
+#define READY_MESSAGE "stim_stream ready"
+
+/* A multiple of 4 commands of 4 bytes each. */
+#define WRITE_PIECE_BYTES 64
+
+typedef struct {
+    int file;
+    unsigned char *buffer;
+    size_t buffer_size;
+    size_t num_bytes;
+} Chip;
+
+static int read_exactly(unsigned char *buffer, size_t num_bytes) {
+    size_t done = 0;
+
+    while (done < num_bytes) {
+        ssize_t result = read(STDIN_FILENO, buffer + done, num_bytes - done);
+
+        if (result == 0) {
+            return 0;
+        }
+
+        if (result < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+
+            perror("Could not read the input");
+            exit(1);
+        }
+
+        done += result;
+    }
+
+    return 1;
+}
+
+static void write_all(int file, const unsigned char *buffer, size_t num_bytes) {
+    size_t done = 0;
+
+    while (done < num_bytes) {
+        ssize_t result = write(file, buffer + done, num_bytes - done);
+
+        if (result < 0) {
+            if (errno == EINTR) {
+                continue;
+            }
+
+            perror("Could not write to a FIFO");
+            exit(1);
+        }
+
+        done += result;
+    }
+}
+
+static uint32_t decode_uint32(const unsigned char *bytes) {
+    return bytes[0] | (bytes[1] << 8) | (bytes[2] << 16) | ((uint32_t) bytes[3] << 24);
+}
+
+static void write_batch(Chip *chips, int num_chips) {
+    size_t offset = 0;
+    int has_more = 1;
+
+    while (has_more) {
+        has_more = 0;
+
+        for (int i = 0; i < num_chips; i++) {
+            if (offset >= chips[i].num_bytes) {
+                continue;
+            }
+
+            size_t piece = chips[i].num_bytes - offset;
+            if (piece > WRITE_PIECE_BYTES) {
+                piece = WRITE_PIECE_BYTES;
+            }
+
+            write_all(chips[i].file, chips[i].buffer + offset, piece);
+
+            if (offset + piece < chips[i].num_bytes) {
+                has_more = 1;
+            }
+        }
+
+        offset += WRITE_PIECE_BYTES;
+    }
+
+    for (int i = 0; i < num_chips; i++) {
+        chips[i].num_bytes = 0;
+    }
+}
+
+int main(int argc, char *argv[]) {
+    int is_append_mode = 0;
+    char **fifo_paths = argv + 1;
+    int num_chips = argc - 1;
+
+    if (argc > 1 && strcmp(argv[1], "--append") == 0) {
+        /* For debugging with regular files instead of the FIFO devices. */
+        is_append_mode = 1;
+        fifo_paths++;
+        num_chips--;
+    }
+
+    if (num_chips < 1) {
+        printf("Usage:  stim_stream [--append] <fifo_0> [<fifo_1> ...]\n");
+        exit(1);
+    }
+
+    int open_flags = O_WRONLY;
+    if (is_append_mode) {
+        open_flags |= (O_APPEND | O_CREAT);
+    }
+
+    mode_t access_if_created = S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP | S_IROTH | S_IWOTH;
+    Chip *chips = calloc(num_chips, sizeof(Chip));
+
+    for (int i = 0; i < num_chips; i++) {
+        chips[i].file = open(fifo_paths[i], open_flags, access_if_created);
+
+        if (chips[i].file < 0) {
+            int err = errno;
+            printf("Could not open file %s for writing: %s\n", fifo_paths[i], strerror(err));
+            exit(1);
+        }
+    }
+
+    printf("%s\n", READY_MESSAGE);
+    fflush(stdout);
+
+    unsigned char header[8];
+
+    while (read_exactly(header, sizeof(header))) {
+        uint32_t chip = decode_uint32(header);
+        uint32_t length = decode_uint32(header + 4);
+
+        if (chip == END_OF_BATCH) {
+            write_batch(chips, num_chips);
+            continue;
+        }
+
+        if (chip >= (uint32_t) num_chips) {
+            printf("Invalid chip number %u\n", chip);
+            exit(1);
+        }
+
+        Chip *target = &chips[chip];
+
+        if (target->num_bytes + length > target->buffer_size) {
+            target->buffer_size = 2 * (target->num_bytes + length);
+            target->buffer = realloc(target->buffer, target->buffer_size);
+        }
+
+        if (!read_exactly(target->buffer + target->num_bytes, length)) {
+            break;
+        }
+
+        target->num_bytes += length;
+    }
+
+    /* Whatever came in after the last complete batch is still written. */
+    write_batch(chips, num_chips);
+
+    for (int i = 0; i < num_chips; i++) {
+        close(chips[i].file);
+        free(chips[i].buffer);
+    }
+
+    free(chips);
+    return 0;
+}
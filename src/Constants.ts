@@ -9,6 +9,16 @@ export const RESCALING_FILTER_CONFIG = {
     multiplier: 0.195 / 1000 / 1000
 }
 
+// Recording to a file with this extension captures the raw UDP packets instead of
+// writing NWB. Convert the capture with engine/convert_raw_log.py.
+export const RAW_PACKET_LOG_EXTENSION = 'omraw'
+
+// Rescaling of the 10-bit DC samples, the same way as the AC rescaling above.
+export const DC_RESCALING_CONFIG = {
+    offset: -512,
+    multiplier: -19.23 / 1000
+}
+
 // ============== OpenMEA electrode config ==================
 export const NUM_OPENMEA_ELECTRODES = 64
 
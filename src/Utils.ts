@@ -103,13 +103,22 @@ export function buildPipelineBase(context: AppContext, electrodeNum: number): Ba
     const resampleToFreq = toNearbyFreqMultiple(samplesPerSec, combFilterConfig.freq)
 
     const baseFilters: PipelineElement[] = [
-        `electrodes[${electrodeNum}].ac`,
-        {
-            name: 'BandFilter',
-            ...context.bandFilterConfig
-        }
+        `electrodes[${electrodeNum}].ac`
     ]
 
+    // Stimulation artifacts are blanked before they can make the filters ring.
+    if (context.artifactBlankingConfig.mode != 'none') {
+        baseFilters.push({
+            name: 'ArtifactBlankingFilter',
+            ...context.artifactBlankingConfig
+        })
+    }
+
+    baseFilters.push({
+        name: 'BandFilter',
+        ...context.bandFilterConfig
+    })
+
     if (deviceProps!!.canSampleDC) {
         const acDcMixConfig = context.acDcMixConfig
         
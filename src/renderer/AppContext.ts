@@ -3,6 +3,7 @@ import { PythonInstallerRendererProxy } from "client/services/python-installer/P
 import { DeviceManager } from "./DeviceManager";
 import { EngineClient } from "./engine/EngineClient";
 import { AcDcMixConfig } from "./model/AcDcMixConfig";
+import { ArtifactBlankingConfig } from "./model/ArtifactBlankingConfig";
 import { BandFilterConfig } from "./model/BandFilterConfig";
 import { CombFilterConfig } from "./model/CombFilterConfig";
 import { DeviceState } from "./model/DeviceState";
@@ -27,6 +28,7 @@ export interface AppContext {
 
     chartConfig: ChartConfig
     acDcMixConfig: AcDcMixConfig
+    artifactBlankingConfig: ArtifactBlankingConfig
     bandFilterConfig: BandFilterConfig
     combFilterConfig: CombFilterConfig
     saveFileConfig: SaveFileConfig | null
@@ -37,6 +39,7 @@ export interface AppContext {
 
     setChartConfig: (chartConfig: ChartConfig) => void
     setAcDcMixConfig: (config: AcDcMixConfig) => void
+    setArtifactBlankingConfig: (config: ArtifactBlankingConfig) => void
     setBandFilterConfig: (config: BandFilterConfig) => void
     setCombFilterConfig: (config: CombFilterConfig) => void
     setSaveFileConfig: (config: SaveFileConfig) => Promise<void>
@@ -1,4 +1,4 @@
-import { OPENMEA_ELECTRODE_EXISTS, RESCALING_FILTER_CONFIG, INIT_SAMPLES_PER_SEC } from 'client/Constants';
+import { OPENMEA_ELECTRODE_EXISTS, RESCALING_FILTER_CONFIG, DC_RESCALING_CONFIG, INIT_SAMPLES_PER_SEC, RAW_PACKET_LOG_EXTENSION } from 'client/Constants';
 import { ArrangeChannels, ChartConfig } from 'client/renderer/model/ChartConfig';
 import { PythonInstallerRendererProxy } from 'client/services/python-installer/PythonInstallerRendererProxy';
 import * as React from 'react'
@@ -10,6 +10,7 @@ import { CombFilterConfig } from './model/CombFilterConfig';
 import { SaveFileConfig } from './model/SaveFileConfig';
 import { StimConfig } from './model/StimConfig';
 import { AcDcMixConfig } from './model/AcDcMixConfig';
+import { ArtifactBlankingConfig } from './model/ArtifactBlankingConfig';
 import { DeviceManager } from './DeviceManager';
 
 export interface AppServiceState {
@@ -18,6 +19,7 @@ export interface AppServiceState {
     
     chartConfig: ChartConfig
     acDcMixConfig: AcDcMixConfig
+    artifactBlankingConfig: ArtifactBlankingConfig
     bandFilterConfig: BandFilterConfig
     combFilterConfig: CombFilterConfig
     saveFileConfig: SaveFileConfig | null
@@ -91,6 +93,13 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
                 dcMultiplier: 0.0005
             },
 
+            artifactBlankingConfig: {
+                samplesPerSec: INIT_SAMPLES_PER_SEC,
+                mode: "none",
+                preMs: 0.2,
+                postMs: 2
+            },
+
             bandFilterConfig: {
                 samplesPerSec: INIT_SAMPLES_PER_SEC,
                 
@@ -140,6 +149,7 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
 
             chartConfig: state.chartConfig,
             acDcMixConfig: state.acDcMixConfig,
+            artifactBlankingConfig: state.artifactBlankingConfig,
             bandFilterConfig: state.bandFilterConfig,
             combFilterConfig: state.combFilterConfig,
             saveFileConfig: state.saveFileConfig,
@@ -150,6 +160,7 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
 
             setChartConfig: this.setChartConfig,
             setAcDcMixConfig: this.setAcDcMixConfig,
+            setArtifactBlankingConfig: this.setArtifactBlankingConfig,
             setBandFilterConfig: this.setBandFilterConfig,
             setCombFilterConfig: this.setCombFilterConfig,
             setSaveFileConfig: this.setSaveFileConfig,
@@ -198,6 +209,7 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
         
         this.setState({
             chartConfig: chartConfig,
+            artifactBlankingConfig: {...state.artifactBlankingConfig, samplesPerSec: samplesPerSec},
             bandFilterConfig: {...state.bandFilterConfig, samplesPerSec: samplesPerSec},
             combFilterConfig: {...state.combFilterConfig, samplesPerSec: samplesPerSec},
             stimConfig: {...state.stimConfig, maxFrequency: samplesPerSec},
@@ -215,6 +227,13 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
         })
     }
 
+    private setArtifactBlankingConfig = (config: ArtifactBlankingConfig) => {
+        this.setState({
+            artifactBlankingConfig: config,
+            lastFilterConfigChangeTimestamp: Date.now()
+        })
+    }
+
     private setBandFilterConfig = (config: BandFilterConfig) => {
         this.setState({
             bandFilterConfig: config,
@@ -234,22 +253,43 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
 
         const samplesPerSec = this.state.chartConfig.samplesPerSec
 
+        // Devices that can record directly do so next to the data acquisition, so that
+        // the recording doesn't depend on how busy the engine is with the display.
+        const recordsDirectly = this._deviceManager.deviceProps?.canRecordDirectly ?? false
+        const capturesRaw = recordsDirectly && (config.filePath?.endsWith(`.${RAW_PACKET_LOG_EXTENSION}`) ?? false)
+
         if (config.recording && config.filePath) {
-            this._savingFilePipeline = await this._engineClient.createPipeline([
-                'electrodes',
-                {
-                    name: 'NwbFileWriter',
-                    filePath: config.filePath,
-                    offset: RESCALING_FILTER_CONFIG.offset,
-                    conversion: RESCALING_FILTER_CONFIG.multiplier,
-                    resolution: RESCALING_FILTER_CONFIG.multiplier,
-                    samplesPerSec: samplesPerSec,
-                    numElectrodes: this._deviceManager.deviceProps?.numElectrodes ?? 0
-                }
-            ])
+            const writerConfig = {
+                name: 'NwbFileWriter',
+                filePath: config.filePath,
+                offset: RESCALING_FILTER_CONFIG.offset,
+                conversion: RESCALING_FILTER_CONFIG.multiplier,
+                dcOffset: DC_RESCALING_CONFIG.offset,
+                dcConversion: DC_RESCALING_CONFIG.multiplier,
+                resolution: RESCALING_FILTER_CONFIG.multiplier,
+                samplesPerSec: samplesPerSec,
+                numElectrodes: this._deviceManager.deviceProps?.numElectrodes ?? 0,
+                layout: config.layout,
+                sampleFormat: config.sampleFormat
+            }
+
+            if (capturesRaw) {
+                await this._engineClient.startRawCapture(config.filePath, samplesPerSec)
+            } else if (recordsDirectly) {
+                await this._engineClient.startRecording(writerConfig)
+            } else {
+                this._savingFilePipeline = await this._engineClient.createPipeline(['electrodes', writerConfig])
+            }
             
+        } else if (!config.recording && capturesRaw) {
+            await this._engineClient.stopRawCapture()
+
+        } else if (!config.recording && recordsDirectly) {
+            await this._engineClient.stopRecording()
+
         } else if (!config.recording && this._savingFilePipeline) {
             await this._savingFilePipeline.delete()
+            this._savingFilePipeline = null
         }
     }
 
@@ -297,6 +337,7 @@ export class AppService extends React.Component<AppServiceProps, AppServiceState
     private handleDeviceSamplesPerSecChanged = (samplesPerSec: number) => {
         const state = this.state
         this.setState({
+            artifactBlankingConfig: {...state.artifactBlankingConfig, samplesPerSec: samplesPerSec},
             bandFilterConfig: {...state.bandFilterConfig, samplesPerSec: samplesPerSec},
             combFilterConfig: {...state.combFilterConfig, samplesPerSec: samplesPerSec},
             stimConfig: {...state.stimConfig, maxFrequency: samplesPerSec},
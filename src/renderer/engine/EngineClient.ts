@@ -2,7 +2,7 @@ import { StimConfig } from '../model/StimConfig'
 import { ApiClient } from './ApiClient'
 import { Pipeline, PipelineElement } from './Pipeline'
 import { PipelinePostResponse } from './PipelinePostResponse'
-import { DeviceState } from '../model/DeviceState'
+import { DeviceState, PlaybackRate } from '../model/DeviceState'
 
 export class EngineClient {
     constructor() {
@@ -83,6 +83,36 @@ export class EngineClient {
         })
     }
 
+    setPlaybackRate = async (playbackRate: PlaybackRate) => {
+        await this._apiClient.sendPost('/device/commands', {
+            setPlaybackRate: playbackRate
+        })
+    }
+
+    startRecording = async (writerConfig: object) => {
+        await this._apiClient.sendPost('/device/commands', {
+            startRecording: writerConfig
+        })
+    }
+
+    stopRecording = async () => {
+        await this._apiClient.sendPost('/device/commands', {
+            stopRecording: true
+        })
+    }
+
+    startRawCapture = async (filePath: string, samplesPerSec: number) => {
+        await this._apiClient.sendPost('/device/commands', {
+            startRawCapture: {filePath, samplesPerSec}
+        })
+    }
+
+    stopRawCapture = async () => {
+        await this._apiClient.sendPost('/device/commands', {
+            stopRawCapture: true
+        })
+    }
+
     connectToDevice = async (deviceName: string) => {
         await this._apiClient.sendPost('/device', {
             connectToDevice: deviceName
@@ -0,0 +1,8 @@
+export interface ArtifactBlankingConfig {
+    samplesPerSec: number
+
+    // 'none', 'hold' or 'interpolate'
+    mode: string
+    preMs: number
+    postMs: number
+}
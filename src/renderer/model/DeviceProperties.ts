@@ -1,6 +1,7 @@
 export class DeviceProperties {
     name: string = ""
     canRecordToFile: boolean = false
+    canRecordDirectly: boolean = false
     canStimulate: boolean = false
     canControlSampling: boolean = false
     canControlReplay: boolean = false
@@ -6,15 +6,18 @@ export class DeviceState {
     initState: DeviceInitState = DeviceInitState.UNKNOWN
     isSampling: boolean = false
     isStimulating: boolean = false
+    isRecording: boolean = false
     initStepDone: number|null = null
     numInitSteps: number|null = null
     samplesPerSec: number = INIT_SAMPLES_PER_SEC
     
     replayLengthSamples: number|null = null
     replayPositionSample: number|null = null
+    playbackRate: PlaybackRate = 1
     error: string|null = null
     lastResetTime: number|null = null
     deviceProps: DeviceProperties | null = null
+    closedLoopLatency: ClosedLoopLatency | null = null
 
     constructor(init?: Partial<DeviceState>) {
         if (!init) return
@@ -32,19 +35,36 @@ export function deviceStateDidNotChange(oldState: DeviceState, newState: DeviceS
     if (oldState.initState !== newState.initState) return false
     if (oldState.isSampling !== newState.isSampling) return false
     if (oldState.isStimulating !== newState.isStimulating) return false
+    if (oldState.isRecording !== newState.isRecording) return false
     if (oldState.initStepDone !== newState.initStepDone) return false
     if (oldState.numInitSteps !== newState.numInitSteps) return false
     if (oldState.samplesPerSec !== newState.samplesPerSec) return false
     
     if (oldState.replayLengthSamples !== newState.replayLengthSamples) return false
     if (oldState.replayPositionSample !== newState.replayPositionSample) return false
+    if (oldState.playbackRate !== newState.playbackRate) return false
     if (oldState.error !== newState.error) return false
+    if (oldState.closedLoopLatency !== newState.closedLoopLatency) return false
 
     if (newState.deviceProps !== newState.deviceProps) return false
     
     return true
 }
 
+// The latencies of the closed-loop stimuli, from the detected sample to sending the pulses,
+// counted in bins of `binSec`. The last bin also has all the longer ones.
+export interface ClosedLoopLatency {
+    binSec: number
+    counts: number[]
+    numTriggers: number
+    medianSec?: number
+    p95Sec?: number
+    maxSec?: number
+}
+
+// Either a multiple of real time, or 'max' to replay as fast as possible.
+export type PlaybackRate = number | 'max'
+
 export enum DeviceInitState {
     UNKNOWN = "UNKNOWN",
     NOT_INITIALIZED = "NOT_INITIALIZED",
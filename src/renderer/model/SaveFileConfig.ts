@@ -1,4 +1,20 @@
 export interface SaveFileConfig {
     filePath: string | null
     recording: boolean
-}
\ No newline at end of file
+
+    // How the samples are stored in NWB recordings. The per-electrode layout, with one
+    // series per electrode, is what older NWB tools and analysis scripts expect.
+    layout: RecordingLayout
+
+    // float32 stores the volts; uint16 stores the raw codes of the chip, with the
+    // conversion to volts in the file, at half the size.
+    sampleFormat: SampleFormat
+}
+
+export type RecordingLayout = 'per_electrode' | 'matrix'
+
+export const DEFAULT_RECORDING_LAYOUT: RecordingLayout = 'per_electrode'
+
+export type SampleFormat = 'float32' | 'uint16'
+
+export const DEFAULT_SAMPLE_FORMAT: SampleFormat = 'float32'
@@ -10,6 +10,8 @@ export class StimConfig {
     loopForever: boolean = false
 
     electrodesByPulse: number[][] = [[]]
+
+    closedLoop: ClosedLoopConfig = new ClosedLoopConfig()
 }
 
 export enum PulseType {
@@ -28,6 +30,36 @@ export class BiphasicStimulationConfig {
 
     phase1Current: number = 0
     phase2Current: number = 0
+
+    // Pulse trains: `pulseCount` pulses every `pulseInterval` seconds make a burst,
+    // and `burstCount` bursts start every `burstInterval` seconds.
+    pulseCount: number = 1
+    pulseInterval: number = 0.01
+    burstCount: number = 1
+    burstInterval: number = 1
+}
+
+export enum ClosedLoopMode {
+    OFF = 'off',
+    THRESHOLD = 'threshold',
+    BAND_POWER = 'bandPower'
+}
+
+// With closed loop on, stimulation waits for the electrode to cross the thresholds,
+// or for its RMS in the band to exceed `powerThreshold`, and then sends the pulses.
+export class ClosedLoopConfig {
+    mode: ClosedLoopMode = ClosedLoopMode.OFF
+    electrode: number = 0
+
+    upperThreshold: number = 0.001
+    lowerThreshold: number = -0.0009
+
+    lowFreq: number = 300
+    highFreq: number = 3000
+    windowMs: number = 20
+    powerThreshold: number = 0.00005
+
+    refractoryMs: number = 100
 }
 
 export type PulseConfig = WavStimulationConfig | BiphasicStimulationConfig
@@ -4,6 +4,9 @@ import React, { useState } from "react"
 import format from 'format-duration'
 import Slider from 'rc-slider'
 import { VisibleIf } from "client/renderer/components/VisibleIf"
+import { PlaybackRate } from "client/renderer/model/DeviceState"
+
+const PLAYBACK_RATES: PlaybackRate[] = [0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 'max']
 
 export const FileReplayControl = (props: {context: AppContext}) => {
     const [filePath, setFilePath] = useState<string|null>(null)
@@ -31,6 +34,11 @@ export const FileReplayControl = (props: {context: AppContext}) => {
         }
     }
 
+    const onPlaybackRateSelected = (evt: React.ChangeEvent<HTMLSelectElement>) => {
+        const value = evt.target.value
+        engineClient.setPlaybackRate(value === 'max' ? 'max' : parseFloat(value))
+    }
+
     const onSliderDragged = (newValue:number|number[]) => {
         setElapsedSamplesBeforeMove(deviceState.replayPositionSample)
         setSliderBeingMoved(true)
@@ -117,6 +125,14 @@ export const FileReplayControl = (props: {context: AppContext}) => {
                     onClick={onTogglePlay}
                     style={{width: '100px'}}
                     disabled={!deviceState.isConnected || isLoadingFile}>{buttonText}</button>
+            <select className="ml-2"
+                    value={String(deviceState.playbackRate)}
+                    onChange={onPlaybackRateSelected}
+                    disabled={!deviceState.isConnected}>
+                {PLAYBACK_RATES.map(rate =>
+                    <option key={rate} value={String(rate)}>{rate === 'max' ? 'Fastest' : `${rate}×`}</option>
+                )}
+            </select>
             <span className="ml-4">{elapsedTimeMessage}</span>
         </div>
         <VisibleIf condition={deviceState.replayLengthSamples !== null}>
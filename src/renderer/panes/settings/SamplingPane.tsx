@@ -8,6 +8,7 @@ import { CombFilterConfig } from '../../model/CombFilterConfig';
 import { SaveFileConfigView } from './SaveFileConfigView';
 import { DeviceInitState } from 'client/renderer/model/DeviceState';
 import { AcDcMixConfig } from 'client/renderer/model/AcDcMixConfig';
+import { ArtifactBlankingConfig } from 'client/renderer/model/ArtifactBlankingConfig';
 import { DEVICE_NEUROPROBE, DEVICE_NWB_FILE, DEVICE_OPENMEA } from 'client/renderer/DeviceManager';
 import { VisibleIf } from 'client/renderer/components/VisibleIf';
 import { FileReplayControl } from './FileReplayControls';
@@ -143,6 +144,8 @@ export class SamplingPane extends React.Component<SamplingPaneProps, SamplingPan
             </div>
 
             <h2 className="mt-4 mb-2">Filtering</h2>
+            {this.renderArtifactBlankingDropdown()}
+            {this.renderArtifactBlankingOptions()}
             <div className="mt-2">
                 <label className="sidebar-label">Low pass filter</label>
                 <FilterPicker value={bandFilterConfig.lowFType}
@@ -249,6 +252,44 @@ export class SamplingPane extends React.Component<SamplingPaneProps, SamplingPan
         </div>
     }
 
+    private renderArtifactBlankingDropdown = () => {
+        const context = this.props.context
+        const artifactBlankingConfig = context.artifactBlankingConfig
+
+        return <div className="mt-2">
+            <label className="sidebar-label">Stim. artifacts</label>
+            <select value={artifactBlankingConfig.mode}
+                    onChange={evt => context.setArtifactBlankingConfig({...artifactBlankingConfig, mode: evt.target.value})}>
+                <option value="none">Keep</option>
+                <option value="hold">Hold</option>
+                <option value="interpolate">Interpolate</option>
+            </select>
+        </div>
+    }
+
+    private renderArtifactBlankingOptions = () => {
+        const artifactBlankingConfig = this.props.context.artifactBlankingConfig
+
+        if (artifactBlankingConfig.mode == 'none') {
+            return null
+        }
+
+        return <div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Before stimulus</label>
+                <SiNumberInput value={artifactBlankingConfig.preMs}
+                                onChange={this.handleArtifactBlankingConfigChange("preMs")} />
+                <span className="units">ms</span>
+            </div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">After stimulus</label>
+                <SiNumberInput value={artifactBlankingConfig.postMs}
+                                onChange={this.handleArtifactBlankingConfigChange("postMs")} />
+                <span className="units">ms</span>
+            </div>
+        </div>
+    }
+
     private renderCombFilterDropdown = () => {
         const combFilterConfig = this.props.context.combFilterConfig
         const onFreqChanged = this.handleCombFilterConfigChange('freq')
@@ -344,6 +385,18 @@ export class SamplingPane extends React.Component<SamplingPaneProps, SamplingPan
         }
     }
 
+    private handleArtifactBlankingConfigChange = (field: KeysMatching<ArtifactBlankingConfig, number>) => {
+        return (value: number) => {
+            const context = this.props.context
+            const oldConfig = context.artifactBlankingConfig
+
+            const newConfig = {...oldConfig}
+            newConfig[field] = value
+
+            context.setArtifactBlankingConfig(newConfig)
+        }
+    }
+
     private handleCombFilterConfigChange = (field: KeysMatching<CombFilterConfig, number>) => {
         return (value: number) => {
             const context = this.props.context
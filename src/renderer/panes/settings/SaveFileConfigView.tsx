@@ -1,7 +1,8 @@
 import * as React from 'react'
 import format from 'format-duration'
-import { SaveFileConfig } from "../../model/SaveFileConfig";
+import { DEFAULT_RECORDING_LAYOUT, DEFAULT_SAMPLE_FORMAT, RecordingLayout, SampleFormat, SaveFileConfig } from "../../model/SaveFileConfig";
 import { DialogType, FilePicker } from 'client/renderer/components/FilePicker';
+import { RAW_PACKET_LOG_EXTENSION } from 'client/Constants';
 
 export interface SaveFileConfigViewProps {
     config: SaveFileConfig | null
@@ -53,6 +54,32 @@ export class SaveFileConfigView extends React.Component<SaveFileConfigViewProps,
             </div>
         }
 
+        // Raw packet captures are stored as received.
+        let formatRows : JSX.Element | null = null
+
+        if (config?.filePath && !config.filePath.endsWith(`.${RAW_PACKET_LOG_EXTENSION}`)) {
+            formatRows = <div>
+                <div className="mt-2">
+                    <label className="sidebar-label">Layout</label>
+                    <select value={config.layout}
+                            disabled={config.recording}
+                            onChange={this.onLayoutChanged}>
+                        <option value="per_electrode">Series per electrode</option>
+                        <option value="matrix">One matrix</option>
+                    </select>
+                </div>
+                <div className="mt-2">
+                    <label className="sidebar-label">Sample format</label>
+                    <select value={config.sampleFormat}
+                            disabled={config.recording}
+                            onChange={this.onSampleFormatChanged}>
+                        <option value="float32">Volts (float32)</option>
+                        <option value="uint16">Raw codes (uint16)</option>
+                    </select>
+                </div>
+            </div>
+        }
+
         const overwriteWarning = state.doneRecording ? 
             <p className="text-sm text-gray-300 mt-1">Recording again will overwrite the file</p>
             : null
@@ -64,9 +91,11 @@ export class SaveFileConfigView extends React.Component<SaveFileConfigViewProps,
                         dialogType={DialogType.SAVE}
                         filters={[
                             {name: 'NWB Files', extensions: ['nwb']},
+                            {name: 'Raw Packet Captures', extensions: [RAW_PACKET_LOG_EXTENSION]},
                             {name: 'All Files', extensions: ['*']}
                         ]}
                         onChange={this.onFileSelected}/>
+            { formatRows }
             { recordButtonRow }
             { overwriteWarning }
         </div>
@@ -75,12 +104,24 @@ export class SaveFileConfigView extends React.Component<SaveFileConfigViewProps,
     // =================== Private =================
     private onFileSelected = (filePath: string) => {
         const oldConfig = this.props.config
-        const newConfig = oldConfig ? {...oldConfig, filePath} : {filePath, recording: false}
+        const newConfig = oldConfig ? {...oldConfig, filePath}
+                                    : {filePath,
+                                       recording: false,
+                                       layout: DEFAULT_RECORDING_LAYOUT,
+                                       sampleFormat: DEFAULT_SAMPLE_FORMAT}
 
         this.setState({doneRecording: false, recordingStartMillisec: null})
         this.props.onChange(newConfig)
     }
 
+    private onLayoutChanged = (evt: any) => {
+        this.props.onChange({...this.props.config!!, layout: evt.target.value as RecordingLayout})
+    }
+
+    private onSampleFormatChanged = (evt: any) => {
+        this.props.onChange({...this.props.config!!, sampleFormat: evt.target.value as SampleFormat})
+    }
+
     private onClickRecordButton = (evt:any) => {
         const oldConfig = this.props.config!!
         const newConfig = { ...oldConfig, recording: !oldConfig.recording }
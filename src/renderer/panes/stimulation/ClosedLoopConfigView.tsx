@@ -0,0 +1,139 @@
+import * as React from 'react'
+import { ClosedLoopConfig, ClosedLoopMode } from 'client/renderer/model/StimConfig';
+import { ClosedLoopLatency, DeviceState } from 'client/renderer/model/DeviceState';
+import { SiNumberInput } from 'client/renderer/components/SiNumberInput';
+import { VisibleIf } from 'client/renderer/components/VisibleIf';
+import { formatSI, KeysMatching } from 'client/Utils';
+
+export interface ClosedLoopConfigViewProps {
+    config: ClosedLoopConfig
+    selectedElectrode: number
+    deviceState: DeviceState
+    onChange: (config: ClosedLoopConfig) => void
+}
+
+export function ClosedLoopConfigView(props: ClosedLoopConfigViewProps) {
+    const config = props.config
+    const deviceProps = props.deviceState.deviceProps
+    const electrodeName = deviceProps ? deviceProps.electrodeNames[config.electrode] : `${config.electrode}`
+
+    const onModeChanged = (evt: any) => {
+        const mode = evt.target.value as ClosedLoopMode
+
+        // Turning closed loop on starts with the electrode that's on display.
+        const electrode = config.mode == ClosedLoopMode.OFF ? props.selectedElectrode : config.electrode
+        props.onChange({ ...config, mode: mode, electrode: electrode })
+    }
+
+    const onValueChanged = (setting: KeysMatching<ClosedLoopConfig, number>) => {
+        return (value: number) => {
+            const newConfig = { ...config }
+            newConfig[setting] = value
+            props.onChange(newConfig)
+        }
+    }
+
+    return <div>
+        <div className="mt-2">
+            <label className="sidebar-label">Closed loop</label>
+            <select onChange={onModeChanged} value={config.mode}>
+                <option value={ClosedLoopMode.OFF}>Off</option>
+                <option value={ClosedLoopMode.THRESHOLD}>Threshold</option>
+                <option value={ClosedLoopMode.BAND_POWER}>Band power</option>
+            </select>
+        </div>
+        <VisibleIf condition={config.mode != ClosedLoopMode.OFF}>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Detect on</label>
+                <span>{electrodeName}</span>
+                <VisibleIf condition={props.selectedElectrode != config.electrode}>
+                    <button className="text-xs ml-2"
+                            onClick={() => props.onChange({ ...config, electrode: props.selectedElectrode })}>
+                        Use selected
+                    </button>
+                </VisibleIf>
+            </div>
+        </VisibleIf>
+        <VisibleIf condition={config.mode == ClosedLoopMode.THRESHOLD}>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Upper threshold</label>
+                <SiNumberInput value={config.upperThreshold}
+                               onChange={onValueChanged("upperThreshold")} />
+                <span className="units">V</span>
+            </div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Lower threshold</label>
+                <SiNumberInput value={config.lowerThreshold}
+                               onChange={onValueChanged("lowerThreshold")} />
+                <span className="units">V</span>
+            </div>
+        </VisibleIf>
+        <VisibleIf condition={config.mode == ClosedLoopMode.BAND_POWER}>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Band from</label>
+                <SiNumberInput value={config.lowFreq}
+                               onChange={onValueChanged("lowFreq")} />
+                <span className="units">Hz</span>
+            </div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Band to</label>
+                <SiNumberInput value={config.highFreq}
+                               onChange={onValueChanged("highFreq")} />
+                <span className="units">Hz</span>
+            </div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Window</label>
+                <SiNumberInput value={config.windowMs}
+                               onChange={onValueChanged("windowMs")} />
+                <span className="units">ms</span>
+            </div>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">RMS threshold</label>
+                <SiNumberInput value={config.powerThreshold}
+                               onChange={onValueChanged("powerThreshold")} />
+                <span className="units">V</span>
+            </div>
+        </VisibleIf>
+        <VisibleIf condition={config.mode != ClosedLoopMode.OFF}>
+            <div className="mt-2">
+                <label className="sidebar-label pl-3">Refractory period</label>
+                <SiNumberInput value={config.refractoryMs}
+                               onChange={onValueChanged("refractoryMs")} />
+                <span className="units">ms</span>
+            </div>
+            <LatencyHistogramView latency={props.deviceState.closedLoopLatency} />
+        </VisibleIf>
+    </div>
+}
+
+const HISTOGRAM_HEIGHT_PX = 40
+
+function LatencyHistogramView(props: { latency: ClosedLoopLatency | null }) {
+    const latency = props.latency
+
+    if (!latency || latency.numTriggers == 0) {
+        return <div className="mt-2 text-xs text-gray-700">No closed-loop stimuli yet</div>
+    }
+
+    const maxCount = Math.max(...latency.counts)
+    const bars = latency.counts.map((count, i) =>
+        <div key={i}
+             className="flex-1 bg-blue-500"
+             title={`${formatSI(i * latency.binSec)}s: ${count}`}
+             style={{height: `${HISTOGRAM_HEIGHT_PX * count / maxCount}px`}} />
+    )
+
+    return <div className="mt-2">
+        <div className="flex items-end" style={{height: `${HISTOGRAM_HEIGHT_PX}px`}}>
+            {bars}
+        </div>
+        <div className="flex justify-between text-xs text-gray-700">
+            <span>0 s</span>
+            <span>{formatSI(latency.counts.length * latency.binSec)}s+</span>
+        </div>
+        <div className="mt-1 text-xs text-gray-700">
+            {latency.numTriggers} stimuli; latency median {formatSI(latency.medianSec ?? 0)}s,
+            95% {formatSI(latency.p95Sec ?? 0)}s, max {formatSI(latency.maxSec ?? 0)}s
+        </div>
+    </div>
+}
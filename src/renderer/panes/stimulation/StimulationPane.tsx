@@ -1,5 +1,5 @@
 import * as React from 'react'
-import { BiphasicStimulationConfig, isBiphasic, isWavFile, PulseConfig, PulseType, StimConfig, WavStimulationConfig } from 'client/renderer/model/StimConfig';
+import { BiphasicStimulationConfig, ClosedLoopConfig, ClosedLoopMode, isBiphasic, isWavFile, PulseConfig, PulseType, StimConfig, WavStimulationConfig } from 'client/renderer/model/StimConfig';
 import { SiNumberInput } from 'client/renderer/components/SiNumberInput';
 import { formatSI, KeysMatching } from 'client/Utils';
 import { STIM_STEP_SIZES } from 'client/Constants';
@@ -7,6 +7,7 @@ import { DeviceState } from 'client/renderer/model/DeviceState';
 import { ElectrodePicker } from 'client/renderer/components/ElectrodePicker';
 import { VisibleIf } from 'client/renderer/components/VisibleIf';
 import { WavConfigView } from './WavPulseConfigView';
+import { ClosedLoopConfigView } from './ClosedLoopConfigView';
 
 export interface StimulationPaneProps {
     stimConfig: StimConfig
@@ -34,6 +35,7 @@ export class StimulationPane extends React.Component<StimulationPaneProps, Stimu
         const isStimulating = deviceConfig.isStimulating
         const isSampling = deviceConfig.isSampling
         const isConnected = deviceConfig.isConnected
+        const isClosedLoop = isBiphasic(stimConfig.pulseConfig) && stimConfig.closedLoop.mode != ClosedLoopMode.OFF
         
         let hasElectrodes = false
         for (let electrodes of stimConfig.electrodesByPulse) {
@@ -87,6 +89,13 @@ export class StimulationPane extends React.Component<StimulationPaneProps, Stimu
 
             { pulseConfigView }
 
+            <VisibleIf condition={isBiphasic(stimConfig.pulseConfig)}>
+                <ClosedLoopConfigView config={stimConfig.closedLoop}
+                                      selectedElectrode={this.props.selectedElectrode}
+                                      deviceState={deviceConfig}
+                                      onChange={this.onClosedLoopConfigChange} />
+            </VisibleIf>
+
             <h2 className="mt-6 mb-0">
                 Electrodes to stimulate
             </h2>
@@ -100,7 +109,8 @@ export class StimulationPane extends React.Component<StimulationPaneProps, Stimu
                         disabled={!isConnected || !isSampling || isStimulating || !hasElectrodes}
                         style={{width: '120px'}}
                         onClick={() => this.props.startStim().then(() => {})}>
-                    { isStimulating ? "Stimulating..." : "↯ Stimulate"}
+                    { isStimulating ? (isClosedLoop ? "Armed..." : "Stimulating...")
+                                    : (isClosedLoop ? "↯ Arm" : "↯ Stimulate")}
                 </button>
                 <VisibleIf condition={isStimulating}>
                     <button className="danger ml-4"
@@ -141,7 +151,10 @@ export class StimulationPane extends React.Component<StimulationPaneProps, Stimu
             ...oldStimConfig,
             pulseType: pulseType,
             pulseConfig: pulseConfig,
-            electrodesByPulse: pulseType == PulseType.WAV_FILES? [] : [[]]
+            electrodesByPulse: pulseType == PulseType.WAV_FILES? [] : [[]],
+
+            // Only biphasic pulses can be triggered.
+            closedLoop: {...oldStimConfig.closedLoop, mode: ClosedLoopMode.OFF}
         })
     }
 
@@ -153,6 +166,13 @@ export class StimulationPane extends React.Component<StimulationPaneProps, Stimu
         })
     }
 
+    private onClosedLoopConfigChange = (closedLoop: ClosedLoopConfig) => {
+        this.props.setStimConfig({
+            ...this.props.stimConfig,
+            closedLoop: closedLoop
+        })
+    }
+
     private onElectrodeSelectionChanged = (electrodesByPulse: number[][]) => {
         const oldStimConfig = this.props.stimConfig
         this.props.setStimConfig({
@@ -199,6 +219,14 @@ function BiphasicConfigView(props: BiphasicPulseConfigView) {
         }
     }
 
+    const onCountChanged = (setting: KeysMatching<BiphasicStimulationConfig, number>) => {
+        return (value: number) => {
+            const newConfig = { ...config }
+            newConfig[setting] = Math.max(1, Math.round(value))
+            props.onChange(newConfig)
+        }
+    }
+
     const chargeBalance = config.phase1Duration * config.phase1Current +
                           config.phase2Duration * config.phase2Current
 
@@ -247,6 +275,32 @@ function BiphasicConfigView(props: BiphasicPulseConfigView) {
             <span className="units">A</span>
         </div>
         { chargeBalanceView }
+        <div className="mt-2">
+            <label className="sidebar-label">Pulses per burst</label>
+            <SiNumberInput value={config.pulseCount}
+                                onChange={onCountChanged("pulseCount")} />
+        </div>
+        <VisibleIf condition={config.pulseCount > 1}>
+            <div className="mt-2">
+                <label className="sidebar-label">Pulse interval</label>
+                <SiNumberInput value={config.pulseInterval}
+                                    onChange={onDurationChanged("pulseInterval")} />
+                <span className="units">s</span>
+            </div>
+        </VisibleIf>
+        <div className="mt-2">
+            <label className="sidebar-label">Bursts</label>
+            <SiNumberInput value={config.burstCount}
+                                onChange={onCountChanged("burstCount")} />
+        </div>
+        <VisibleIf condition={config.burstCount > 1}>
+            <div className="mt-2">
+                <label className="sidebar-label">Burst interval</label>
+                <SiNumberInput value={config.burstInterval}
+                                    onChange={onDurationChanged("burstInterval")} />
+                <span className="units">s</span>
+            </div>
+        </VisibleIf>
     </div>
 }
 